@@ -2,8 +2,11 @@ __author__ = "Jackson Murrell"
 
 import random
 
+import numpy as np
+
 from typing import Tuple
 from world import World, Node
+from profiling import LOOKUP, POLICY, REWARD, UPDATE, TERMINATION
 
 NONE = "None"
 PICKUP = "Pickup"
@@ -24,55 +27,105 @@ def q_learning(reward: int, learning: float, discount: float, current_q: float,
 def sarsa(reward: int, learning: float, discount: float, current_q: float, next_q: float) -> float:
     return current_q + (learning * (reward + discount * next_q - current_q))
 
+# Methods that spread each update back along an eligibility trace, rather than just the last move.
+TRACE_METHODS = ("sarsa_lambda", "q_lambda")
+# Traces smaller than this are dropped, so the work per step only depends on the recent path.
+TRACE_CUTOFF = 1e-3
+
+# How many random numbers a RandomStream generates at a time.
+RANDOM_BLOCK = 4096
+
+class RandomStream(object):
+    """
+        A seeded numpy Generator that hands out random() one float at a time, from blocks of RANDOM_BLOCK
+        generated at once, so each policy decision costs a list lookup rather than a call into numpy.
+
+        The numbers come out exactly as np.random.default_rng(seed).random() would give them one by one,
+        on any machine and in any process, so a seed always reproduces the same run.
+    """
+    def __init__(self, seed=None, block: int=RANDOM_BLOCK):
+        self.seed = seed
+        self.generator = np.random.default_rng(seed)
+        self.block = block
+        self._values = []
+        self._position = 0
+        # The generator's state just before the current block, so the stream can be saved mid-block.
+        self._block_state = None
+
+    def _refill(self):
+        self._block_state = self.generator.bit_generator.state
+        self._values = self.generator.random(self.block).tolist()
+        self._position = 0
+
+    def random(self) -> float:
+        if self._position >= len(self._values):
+            self._refill()
+        value = self._values[self._position]
+        self._position += 1
+        return value
+
+    def get_state(self) -> dict:
+        if self._block_state is None:
+            return {"generator": self.generator.bit_generator.state, "position": None}
+        return {"generator": self._block_state, "position": self._position}
+
+    def set_state(self, state: dict):
+        self.generator.bit_generator.state = state["generator"]
+        if state["position"] is None:
+            self._values = []
+            self._position = 0
+            self._block_state = None
+        else:
+            self._refill()
+            self._position = state["position"]
+
 # These all need the same function signature.
-def policy_random(node: Node, carrying: bool, node_q_table: dict) -> Tuple[str, bool]:
-    actions = node.get_actions(carrying)
-    if "Pickup" in actions.keys():
+# rng is anything with a random() method returning a float in [0, 1), such as a RandomStream, the random
+# module or a numpy Generator.  Every random decision is made with rng.random(), so VectorAgent can replay them.
+def policy_random(node: Node, carrying: bool, node_q_table: dict, rng=random) -> Tuple[str, bool]:
+    actions = node.world.get_valid_actions(node, carrying)
+    if "Pickup" in actions:
         return ("Pickup", True)
-    elif "Dropoff" in actions.keys():
+    elif "Dropoff" in actions:
         return ("Dropoff", False)
-    random_action = random.choice([action for action in actions.keys()])
+    random_action = actions[int(rng.random() * len(actions))]
     return (random_action, carrying)
 
-def policy_greedy(node: Node, carrying: bool, node_q_table: dict) -> Tuple[str, bool]:
-    actions = node.get_actions(carrying)
-    if "Pickup" in actions.keys():
+def policy_greedy(node: Node, carrying: bool, node_q_table: dict, rng=random) -> Tuple[str, bool]:
+    actions = node.world.get_valid_actions(node, carrying)
+    if "Pickup" in actions:
         return ("Pickup", True)
-    elif "Dropoff" in actions.keys():
+    elif "Dropoff" in actions:
         return ("Dropoff", False)
     # Pick the highest, if multiple are the same, randomly choose.
-    q_values = []
-    highest_q = ()
-    for action in actions:
-        q_val = node_q_table[action]
-        if not highest_q:
-            highest_q = (q_val, action)
-            continue
-
-        if q_val > highest_q[0]:
-            highest_q = (q_val, action)
-            q_values = []
-
-        elif q_val == highest_q[0]:
-            q_values.append(action)
-
-    if q_values:
-        q_values.append(highest_q[1])
-        return (random.choice(q_values), carrying)
-    return (highest_q[1], carrying)
-
-def policy_exploit(node: Node, carrying: bool, node_q_table: dict) -> Tuple[str, bool]:
+    highest_q = max(node_q_table[action] for action in actions)
+    q_values = [action for action in actions if node_q_table[action] == highest_q]
+    if len(q_values) > 1:
+        return (q_values[int(rng.random() * len(q_values))], carrying)
+    return (q_values[0], carrying)
+
+def policy_exploit(node: Node, carrying: bool, node_q_table: dict, rng=random) -> Tuple[str, bool]:
     # 80% of the time, be greedy, 20% of the time, randomly choose/explore.
-    exploit_threshold = 80
-    rand_int = random.randint(1, 100)
-    if random.randint(1, 100) > exploit_threshold:
-        return policy_random(node, carrying, node_q_table)
-    return policy_greedy(node, carrying, node_q_table)
+    exploit_threshold = 0.8
+    if rng.random() >= exploit_threshold:
+        return policy_random(node, carrying, node_q_table, rng)
+    return policy_greedy(node, carrying, node_q_table, rng)
+
+# Policies by name, for command line arguments and reports.
+POLICIES = {"random": policy_random,
+            "greedy": policy_greedy,
+            "exploit": policy_exploit}
 
 class Agent(object):
     def __init__(self, world: World, start_coords: Tuple[int, int], method,
                  learning_rate: float=0.5, discount_rate: float=0.5, carrying: bool=False,
-                 capacity: int=1, policy=policy_greedy):
+                 capacity: int=1, policy=policy_greedy, rng=None, trace_decay: float=0.9, seed=None):
+        """
+            method: "q_learning", "sarsa", or with eligibility traces, "sarsa_lambda" or "q_lambda" (Watkins).
+            rng: Source of randomness for the policies.  Defaults to a RandomStream of seed.
+            seed: Seed for the default RandomStream.  None seeds it from the operating system.
+            trace_decay: Lambda, how quickly eligibility traces fade.  Only used by the trace methods.
+        """
         self.world = world
         self.start_node = self.world.nodes[start_coords]
         self.current_node = self.start_node
@@ -82,77 +135,211 @@ class Agent(object):
         self.carrying = carrying
         self.capcity = capacity
         self.policy = policy
+        self.rng = rng if rng is not None else RandomStream(seed)
+        # Set to a profiling.Profiler to time each phase of move.
+        self.profiler = None
+        # Set to a planning.PrioritizedSweeping to run simulated updates after every real one.
+        self.planner = None
+        # Set to a trajectory.TrajectoryRecorder to log every move.
+        self.recorder = None
+        # Set to a shaping.PotentialShaping to learn from shaped rewards.
+        self.shaping = None
+        # Set to a convergence.ConvergenceMonitor to report every q-value change to.
+        self.monitor = None
+        self.trace_decay = trace_decay
+        # Sparse eligibility traces, keyed by (node index, carrying, availability mask, action).
+        self.traces = {}
+        # The trace methods choose the move after a pickup or dropoff ahead of time, for their target, and
+        # keep it here to take once the pickup or dropoff is done.
+        self.future_move = None
         # We need to know what our "future" move is for SARSA.
         self.next_move = self.policy(self.current_node, self.carrying,
-                                     self.world.get_q_node_table(self.current_node, self.carrying))
+                                     self.world.get_q_node_table(self.current_node, self.carrying), self.rng)
         self.score = INITIAL_SCORE
 
-    def swap_pickup_dropoff(self):
+    def swap_pickup_dropoff(self, transfer: bool=False):
         # Update the world's information.
         self.world.swap_pickup_dropoff()
+        # Keep using what we learned, with the carrying and not-carrying q-values traded.
+        if transfer:
+            self.world.transfer_q_table()
+        self.layout_changed()
+
+    def layout_changed(self):
+        # Forget anything tied to the old pickup/dropoff layout, and plan again on the new one.
+        self.traces = {}
+        # The rewards the planner learned belong to the old layout.
+        if self.planner:
+            self.planner.clear()
         # Make sure our current states are updated, so we don't have invalid keys.
         # We can't simply switch "Pickup" with "Dropoff" or vice versa, because we don't know what the
         # carrying status is.  If we are carrying, and our dropoff becomes a pickup, we can't switch to a
         # "Pickup" action, as that's invalid.  So, just recalculate our next action.
+        self.future_move = None
         self.next_move = self.policy(self.current_node, self.carrying,
-                                     self.world.get_q_node_table(self.current_node, self.carrying))
+                                     self.world.get_q_node_table(self.current_node, self.carrying), self.rng)
 
     def move(self) -> Tuple[bool, int]:
         terminated = False
+        profiler = self.profiler
+        if profiler:
+            profiler.start()
 
         # Get the move we had already planned.
         current_action, self.carrying = self.next_move
-        next_node = self.world.nodes[self.current_node.get_actions()[current_action]]
-        # Figure out what our future move would be.
-        self.next_move = self.policy(next_node, self.carrying,
-                                     self.world.get_q_node_table(next_node, self.carrying))
+        next_node = self.world.get_next_node(self.current_node, current_action)
+        node_q_table = self.world.get_q_node_table(next_node, self.carrying)
+        if profiler:
+            profiler.lap(LOOKUP)
+        # Figure out what our future move would be, unless it was already chosen before a pickup or dropoff.
+        if self.future_move is not None:
+            self.next_move, self.future_move = self.future_move, None
+        else:
+            self.next_move = self.policy(next_node, self.carrying, node_q_table, self.rng)
+        if profiler:
+            profiler.lap(POLICY)
 
         # Essentially, if, by taking the next action, we are going to pickup or dropoff, apply
         # the reward for that as part of the traversal cost.
         next_action, carrying = self.next_move
         reward = self.get_current_reward(next_action)
+        if profiler:
+            profiler.lap(REWARD)
 
         # Only bother checking if we've terminated if we are doing a dropoff.
         if current_action == "Dropoff":
             self.current_node.dropoff()
             terminated = self.world.check_termination()
+            # The traces were for the old carrying status and availability mask.
+            self.traces = {}
+            if profiler:
+                profiler.lap(TERMINATION)
         elif current_action == "Pickup":
             self.current_node.pickup()
+            self.traces = {}
+            if profiler:
+                profiler.lap(UPDATE)
         # We can't compute the q-value for a pickup or dropoff action, as those are always taken.
         # We get rewarded based on moving into the square if the Pickup/Dropoff is applicable.
         # The 4 cardinal movement directions are the q-values we need to compute.
         else:
+            # Shaping only changes what we learn from, not the score.
+            learned_reward = reward
+            if self.shaping:
+                learned_reward = self.shaping.shape(reward, self.discount, self.current_node, self.carrying,
+                                                    next_node, carrying)
+            current_q = self.world.get_q_value(self.current_node, current_action, self.carrying)
             if self.method == "sarsa":
                 # We want to get the action to take after pickup up or dropping off the package.
                 # Thus, get the action performed after flipping whatever our current carrying bool is.
                 future_action, _ = self.policy(next_node, carrying,
-                                               self.world.get_q_node_table(next_node, carrying))
-                new_q_val = sarsa(reward, self.learning, self.discount,
-                                  self.world.get_q_value(self.current_node, current_action, self.carrying),
+                                               self.world.get_q_node_table(next_node, carrying), self.rng)
+                new_q_val = sarsa(learned_reward, self.learning, self.discount, current_q,
                                   self.world.get_q_value(next_node, future_action, carrying))
             elif self.method == "q_learning":
-                new_q_val = q_learning(reward, self.learning, self.discount,
-                                       self.world.get_q_value(self.current_node, current_action, self.carrying),
+                new_q_val = q_learning(learned_reward, self.learning, self.discount, current_q,
                                        self.world.get_max_q_value(self.current_node, self.carrying))
+            elif self.method in TRACE_METHODS:
+                if carrying != self.carrying:
+                    # A pickup or dropoff comes next, so choose the move after it now, and take that same
+                    # move once it's done.  The pickup or dropoff doesn't change the mask this move sees.
+                    self.future_move = self.policy(next_node, carrying,
+                                                   self.world.get_q_node_table(next_node, carrying), self.rng)
+                    future_action = self.future_move[0]
+                else:
+                    # Otherwise the move we just chose is the one we'll take.
+                    future_action = next_action
+                future_q = self.world.get_q_value(next_node, future_action, carrying)
+                next_q = future_q if self.method == "sarsa_lambda" else self.world.get_max_q_value(next_node, carrying)
+                error = learned_reward + self.discount * next_q - current_q
+                # Watkins' Q(lambda) only follows the trace back through greedy moves.
+                keep_traces = self.method == "sarsa_lambda" or future_q == next_q
 
-            self.world.update_q_table(new_q_val, self.current_node, current_action, self.carrying)
+            if self.method in TRACE_METHODS:
+                self.update_traces(error, self.current_node, current_action, self.carrying, keep=keep_traces)
+            else:
+                if self.monitor:
+                    self.monitor.update(self.current_node, self.carrying,
+                                        self.world.get_availability_mask(self.carrying), new_q_val - current_q)
+                self.world.update_q_table(new_q_val, self.current_node, current_action, self.carrying)
+            if self.planner:
+                self.planner.observe(self.current_node, current_action, self.carrying, learned_reward, next_node,
+                                     carrying)
+                self.planner.plan()
+            if profiler:
+                profiler.lap(UPDATE)
 
         self.score += reward
+        if self.recorder:
+            self.recorder.record(self.current_node, current_action, reward, self.carrying, next_node,
+                                 self.world.get_availability_mask(self.carrying), terminated, self.world._swapped)
         self.current_node = next_node
 
         return (terminated, reward)
 
+    def update_traces(self, error: float, node: Node, action: str, carrying: bool, keep: bool=True):
+        """
+            Mark (node, action) as just visited, move every traced q-value towards the TD error, then
+            fade the traces.  keep=False clears them instead, after an exploratory move in Q(lambda).
+        """
+        # Replacing traces: revisiting a state doesn't pile up more than a full trace.
+        self.traces[(node.index, carrying, self.world.get_availability_mask(carrying), action)] = 1.0
+        monitor = self.monitor
+        for (index, trace_carrying, mask, trace_action), trace in self.traces.items():
+            trace_node = self.world.node_list[index]
+            q_table = self.world.get_q_state_table(trace_node, trace_carrying, mask)
+            change = self.learning * error * trace
+            if monitor:
+                monitor.update(trace_node, trace_carrying, mask, change)
+            q_table[trace_action] = q_table[trace_action] + change
+        if not keep:
+            self.traces = {}
+            return
+        decay = self.discount * self.trace_decay
+        self.traces = {key: trace * decay for key, trace in self.traces.items() if trace * decay >= TRACE_CUTOFF}
+
+    def snapshot(self, qtable: bool=True) -> dict:
+        """
+            Everything restore() needs to put this agent and its world back exactly as they are now,
+            for search or planning code that wants to try moves and roll them back.  The q-table can be
+            left out with qtable=False.  A RandomStream's position is kept; other rngs, the planner's
+            model and the recorder are not.
+        """
+        return {"world": self.world.snapshot(qtable),
+                "node": self.current_node.index,
+                "carrying": self.carrying,
+                "next_move": self.next_move,
+                "future_move": self.future_move,
+                "score": self.score,
+                "traces": dict(self.traces),
+                "rng": self.rng.get_state() if isinstance(self.rng, RandomStream) else None}
+
+    def restore(self, snapshot: dict):
+        self.world.restore(snapshot["world"])
+        self.current_node = self.world.node_list[snapshot["node"]]
+        self.carrying = snapshot["carrying"]
+        self.next_move = snapshot["next_move"]
+        self.future_move = snapshot["future_move"]
+        self.score = snapshot["score"]
+        self.traces = dict(snapshot["traces"])
+        if snapshot["rng"] is not None:
+            self.rng.set_state(snapshot["rng"])
+
     def reset(self, policy=None, qtable: bool=False, score=True):
         """
             policy: If we want to reset and use a certain policy.
         """
+        if self.profiler:
+            self.profiler.episode()
+        self.traces = {}
+        self.future_move = None
         self.current_node = self.start_node
         self.score = INITIAL_SCORE if score else self.score
         self.world.reset(qtable=qtable)
         self.policy = policy if policy else self.policy
         # Recompute what our next move will be.
         self.next_move = self.policy(self.current_node, self.carrying,
-                                     self.world.get_q_node_table(self.current_node, self.carrying))
+                                     self.world.get_q_node_table(self.current_node, self.carrying), self.rng)
 
     def get_current_reward(self, action: str) -> int:
         if action == PICKUP:
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+
+__author__ = "Jackson Murrell"
+
+import sys, argparse, itertools, json, platform, time, tracemalloc
+
+import numpy as np
+
+from agent import POLICIES
+from driver import get_world_agent, get_template
+
+def make_layout(size: int, count: int) -> dict:
+    """
+        A square layout with count pickups and count dropoffs spread evenly over the grid.
+        The agent starts in the top right corner, like the 5x5 experiments.
+    """
+    start = (1, size)
+    cells = [(row, column) for row in range(1, size+1) for column in range(1, size+1) if (row, column) != start]
+    if 2*count > len(cells):
+        raise ValueError("A " + str(size) + "x" + str(size) + " grid cannot fit " + str(count) +
+                         " pickups and dropoffs.")
+    spots = [cells[int(i * len(cells) / (2*count))] for i in range(2*count)]
+    return {"size": (size, size), "start": start, "pickup": spots[0::2], "dropoff": spots[1::2],
+            "package_count": 5*count}
+
+def build(layout: dict, method, backend: str, seed: int, compact: bool=False, dtype: str="float64"):
+    return get_world_agent(layout["size"], method, dropoff=layout["dropoff"], pickup=layout["pickup"],
+                           package_count=layout["package_count"], start=layout["start"], backend=backend,
+                           seed=seed, compact=compact, dtype=dtype)
+
+def run_steps(agent, steps: int) -> int:
+    terminations = 0
+    for _ in range(steps):
+        terminated, _ = agent.move()
+        if terminated:
+            agent.reset()
+            terminations += 1
+    return terminations
+
+def bench_case(size: int, count: int, method, policy: str, backend: str, steps: int, repeat: int, seed: int,
+               compact: bool=False, dtype: str="float64") -> dict:
+    """
+        Time Agent.move on one configuration.  The best of repeat runs is reported, and peak memory is
+        measured in a separate, untimed run, since tracemalloc slows everything down.  That run builds
+        the layout from scratch rather than cloning a cached driver.get_template, so the build time and
+        memory don't depend on which cases ran before.
+    """
+    layout = make_layout(size, count)
+    best = None
+    terminations = 0
+    for _ in range(repeat):
+        agent = build(layout, method, backend, seed, compact, dtype)
+        agent.policy = POLICIES[policy]
+        start_time = time.perf_counter()
+        terminations = run_steps(agent, steps)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+
+    get_template.cache_clear()
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    agent = build(layout, method, backend, seed, compact, dtype)
+    build_time = time.perf_counter() - start_time
+    agent.policy = POLICIES[policy]
+    run_steps(agent, steps)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"size": size, "count": count, "method": method, "policy": policy, "backend": backend, "compact": compact,
+            "steps": steps, "seconds": best, "steps_per_second": steps / best,
+            "terminations": terminations, "seconds_per_episode": best / terminations if terminations else None,
+            "build_seconds_traced": build_time, "peak_memory_bytes": peak}
+
+def bench(sizes: list, counts: list, methods: list, policies: list, backends: list, steps: int=20000,
+          repeat: int=3, seed: int=0, compact: bool=False, dtype: str="float64") -> dict:
+    """
+        Benchmark every combination of the given settings.  Combinations that do not fit on the grid
+        are skipped.
+
+        compact: Build the worlds as CompactWorlds.
+        dtype: Type of the CompactWorlds' array q-values, "float64" or "float32".
+    """
+    results = []
+    for size, count, method, policy, backend in itertools.product(sizes, counts, methods, policies, backends):
+        if 2*count > size*size - 1:
+            continue
+        results.append(bench_case(size, count, method, policy, backend, steps, repeat, seed, compact, dtype))
+    return {"meta": {"python": platform.python_version(), "numpy": np.__version__,
+                     "machine": platform.machine(), "platform": platform.platform(),
+                     "steps": steps, "repeat": repeat, "seed": seed, "compact": compact, "dtype": dtype},
+            "results": results}
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark Agent.move throughput and memory.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 10, 20])
+    parser.add_argument("--counts", type=int, nargs="+", default=[3, 4, 6],
+                        help="Number of pickups, and of dropoffs.")
+    parser.add_argument("--methods", nargs="+", default=["q_learning", "sarsa"])
+    parser.add_argument("--policies", nargs="+", default=["random", "greedy", "exploit"], choices=sorted(POLICIES))
+    parser.add_argument("--backends", nargs="+", default=["dict", "array"], choices=["dict", "array"])
+    parser.add_argument("--steps", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compact", action="store_true", help="Store the grids in arrays, for very large sizes.")
+    parser.add_argument("--dtype", choices=["float64", "float32"], default="float64",
+                        help="Q-value type with --compact and the array backend.  float32 halves the q-table.")
+    parser.add_argument("-o", "--output", default=None, help="Write the JSON here instead of stdout.")
+    args = parser.parse_args()
+
+    report = bench(args.sizes, args.counts, args.methods, args.policies, args.backends, steps=args.steps,
+                   repeat=args.repeat, seed=args.seed, compact=args.compact, dtype=args.dtype)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+__author__ = "Jackson Murrell"
+
+import json
+import os
+import random
+import struct
+
+import numpy as np
+
+from world import World, ACTIONS
+from agent import RandomStream
+
+# File layout: MAGIC, a little-endian uint16 version and uint32 header length, the JSON header, then
+# zero padding up to a multiple of ALIGNMENT, and finally the raw q-value array in C order.
+MAGIC = b"PDQT"
+VERSION = 1
+PREFIX = struct.Struct("<4sHI")
+ALIGNMENT = 64
+
+def save_qtable(path: str, world: World, method=None, state: dict=None):
+    """
+        Write the world's q-table to path.
+
+        method: The learning method that produced the table, stored for reference.
+        state: Extra JSON-serializable information to keep alongside the table, such as training progress.
+    """
+    values = np.ascontiguousarray(world.get_q_array())
+    dtype = values.dtype.newbyteorder("<")
+    header = {"shape": list(values.shape),
+              "dtype": dtype.str,
+              "layout": ["node", "carrying", "availability_mask", "action"],
+              "actions": list(ACTIONS),
+              "size": [world.rows, world.columns],
+              "offset": world.offset,
+              "pickups": [list(pickup.coords) for pickup in world.pickups],
+              "dropoffs": [list(dropoff.coords) for dropoff in world.dropoffs],
+              "method": method,
+              "state": state or {}}
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_offset = PREFIX.size + len(header_bytes)
+    padding = -data_offset % ALIGNMENT
+
+    # Write to a temporary file and rename it over the old one, so an interrupted save never leaves a
+    # half-written checkpoint behind.
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as output:
+        output.write(PREFIX.pack(MAGIC, VERSION, len(header_bytes)))
+        output.write(header_bytes)
+        output.write(b"\0" * padding)
+        output.write(values.astype(dtype, copy=False).tobytes())
+    os.replace(temp_path, path)
+
+def read_header(path: str) -> dict:
+    """
+        Read just the header of a q-table file.  The byte offset of the array is stored in "data_offset".
+    """
+    with open(path, "rb") as source:
+        magic, version, length = PREFIX.unpack(source.read(PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError(path + " is not a q-table file.")
+        if version != VERSION:
+            raise ValueError(path + " has unsupported q-table file version " + str(version))
+        header = json.loads(source.read(length).decode("utf-8"))
+    data_offset = PREFIX.size + length
+    header["data_offset"] = data_offset + (-data_offset % ALIGNMENT)
+    return header
+
+def load_qtable(path: str, world: World=None, mode: str="r"):
+    """
+        Memory-map a q-table file.  Nothing is read until the values are used, so large tables open
+        instantly, and read-only maps of the same file share memory between processes.
+
+        world: If given, check the file matches the world's layout and install the table in it.
+        mode: "r" for read-only, "c" for copy-on-write (changes stay in memory), or "r+" to write through.
+
+        Returns the array and the header.
+    """
+    header = read_header(path)
+    values = np.memmap(path, dtype=np.dtype(header["dtype"]), mode=mode, offset=header["data_offset"],
+                       shape=tuple(header["shape"]))
+    if world is not None:
+        check_layout(header, world)
+        world.set_q_array(values)
+    return values, header
+
+def check_layout(header: dict, world: World):
+    layout = {"size": [world.rows, world.columns],
+              "offset": world.offset,
+              "pickups": [list(pickup.coords) for pickup in world.pickups],
+              "dropoffs": [list(dropoff.coords) for dropoff in world.dropoffs]}
+    for key, value in layout.items():
+        if header[key] != value:
+            raise ValueError("Q-table " + key + " " + str(header[key]) + " does not match the world's " + str(value))
+
+def get_rng_state(rng):
+    # Only private generators can be saved; the global random module is shared with everything else.
+    if isinstance(rng, RandomStream):
+        return {"type": "stream", "state": rng.get_state()}
+    if isinstance(rng, random.Random):
+        return {"type": "random", "state": rng.getstate()}
+    if isinstance(rng, np.random.Generator):
+        return {"type": "numpy", "state": rng.bit_generator.state}
+    return None
+
+def set_rng_state(rng, saved: dict):
+    if saved is None:
+        return
+    if saved["type"] == "stream" and isinstance(rng, RandomStream):
+        rng.set_state(saved["state"])
+    elif saved["type"] == "random" and isinstance(rng, random.Random):
+        version, internal, gauss = saved["state"]
+        rng.setstate((version, tuple(internal), gauss))
+    elif saved["type"] == "numpy" and isinstance(rng, np.random.Generator):
+        rng.bit_generator.state = saved["state"]
+
+def save_checkpoint(path: str, agent, progress: dict):
+    """
+        Save the agent's q-table, together with everything needed to carry on from this exact step,
+        including the model and queue of the agent's planner if it has one.
+
+        progress: JSON-serializable training progress from the caller, returned again by resume_checkpoint.
+    """
+    world = agent.world
+    state = {"progress": progress,
+             "swapped": world._swapped,
+             "pickups": [pickup.packages for pickup in world.pickups],
+             "dropoffs": [dropoff.packages for dropoff in world.dropoffs],
+             "agent": {"coords": list(agent.current_node.coords),
+                       "carrying": agent.carrying,
+                       "score": agent.score,
+                       "next_move": list(agent.next_move),
+                       "future_move": list(agent.future_move) if agent.future_move else None,
+                       "traces": [list(key) + [trace] for key, trace in agent.traces.items()],
+                       "rng": get_rng_state(agent.rng)},
+             "planner": agent.planner.get_state() if agent.planner else None}
+    save_qtable(path, world, method=agent.method, state=state)
+
+def resume_checkpoint(path: str, agent) -> dict:
+    """
+        Restore an agent and its world from a checkpoint written by save_checkpoint.
+        The q-table is memory-mapped copy-on-write, so the file itself is never changed.
+
+        Returns the progress dict passed to save_checkpoint.
+    """
+    world = agent.world
+    header = read_header(path)
+    state = header["state"]
+    if header["method"] != agent.method:
+        raise ValueError("Checkpoint was made with " + str(header["method"]) + ", not " + str(agent.method))
+    if state["swapped"] != world._swapped:
+        world.swap_pickup_dropoff()
+    load_qtable(path, world, mode="c")
+
+    for pickup, packages in zip(world.pickups, state["pickups"]):
+        pickup.packages = packages
+    for dropoff, packages in zip(world.dropoffs, state["dropoffs"]):
+        dropoff.packages = packages
+    world._rebuild_masks()
+
+    agent_state = state["agent"]
+    agent.current_node = world.nodes[tuple(agent_state["coords"])]
+    agent.carrying = agent_state["carrying"]
+    agent.score = agent_state["score"]
+    agent.next_move = tuple(agent_state["next_move"])
+    future_move = agent_state.get("future_move")
+    agent.future_move = tuple(future_move) if future_move else None
+    agent.traces = {(index, bool(carrying), mask, action): trace
+                    for index, carrying, mask, action, trace in agent_state.get("traces", [])}
+    set_rng_state(agent.rng, agent_state["rng"])
+    if agent.planner:
+        if state.get("planner") is None:
+            raise ValueError("Checkpoint was made without planning, so the planner's model can't be resumed.")
+        agent.planner.set_state(state["planner"])
+    return state["progress"]
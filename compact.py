@@ -0,0 +1,326 @@
+__author__ = "Jackson Murrell"
+
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+from typing import Tuple
+from world import World, ArrayQTable, ACTIONS, ACTION_INDEX, MOVES
+
+# Cell type codes used in CompactWorld.types, indexed by the names Node.type uses.
+TYPE_NAMES = ("None", "Pickup", "Dropoff")
+TYPE_CODES = {name: code for code, name in enumerate(TYPE_NAMES)}
+NONE_CODE, PICKUP_CODE, DROPOFF_CODE = range(len(TYPE_NAMES))
+
+class NodeView(object):
+    """
+        A stand-in for Node that reads and writes a CompactWorld's arrays.
+
+        A view only holds its world and cell index, so views are made whenever one is asked for and
+        thrown away again.  Two views of the same cell compare equal.
+    """
+    __slots__ = ("world", "index")
+
+    def __init__(self, world, index: int):
+        self.world = world
+        self.index = index
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, NodeView) and other.world is self.world and other.index == self.index
+
+    def __hash__(self) -> int:
+        return hash(self.index)
+
+    def __repr__(self) -> str:
+        return "NodeView(" + str(self.coords) + ", " + self.type + ")"
+
+    @property
+    def coords(self) -> Tuple[int, int]:
+        return self.world.get_coords(self.index)
+
+    @property
+    def y(self) -> int:
+        return self.coords[0]
+
+    @property
+    def x(self) -> int:
+        return self.coords[1]
+
+    @property
+    def row_edge(self):
+        row = self.y - self.world.offset
+        return "U" if row == 0 else "D" if row == self.world.rows - 1 else None
+
+    @property
+    def column_edge(self):
+        column = self.x - self.world.offset
+        return "L" if column == 0 else "R" if column == self.world.columns - 1 else None
+
+    @property
+    def type(self) -> str:
+        return TYPE_NAMES[self.world.types[self.index]]
+
+    @type.setter
+    def type(self, node_type: str):
+        self.world.types[self.index] = TYPE_CODES[node_type]
+
+    @property
+    def packages(self) -> int:
+        return int(self.world.packages[self.index])
+
+    @packages.setter
+    def packages(self, packages: int):
+        self.world.packages[self.index] = packages
+
+    @property
+    def starting_packages(self) -> int:
+        return int(self.world.starting_packages[self.index])
+
+    @starting_packages.setter
+    def starting_packages(self, packages: int):
+        self.world.starting_packages[self.index] = packages
+
+    @property
+    def capacity(self) -> int:
+        return int(self.world.capacities[self.index])
+
+    @capacity.setter
+    def capacity(self, capacity: int):
+        self.world.capacities[self.index] = capacity
+
+    @property
+    def slot(self):
+        return self.world.slots.get(self.index)
+
+    @slot.setter
+    def slot(self, slot: int):
+        self.world.slots[self.index] = slot
+
+    def pickup(self, packages: int=1):
+        world = self.world
+        if world.types[self.index] != PICKUP_CODE:
+            raise TypeError("Cannot pickup from a non-pickup node.")
+        if world.packages[self.index] - packages < 0:
+            raise ArithmeticError("Cannot have negative packages at a pickup.")
+        world.packages[self.index] -= packages
+        world.remaining_packages -= packages
+        if world.packages[self.index] == 0:
+            world.empty_pickups |= 1 << self.slot
+
+    def dropoff(self, packages: int=1):
+        world = self.world
+        if world.types[self.index] != DROPOFF_CODE:
+            raise TypeError("Cannot dropoff from a non-dropoff node.")
+        if world.packages[self.index] + packages > world.capacities[self.index]:
+            raise ArithmeticError("Cannot have packages over capacity at a dropoff.")
+        world.packages[self.index] += packages
+        if world.packages[self.index] == world.capacities[self.index]:
+            world.full_dropoffs |= 1 << self.slot
+
+    def _update_actions(self):
+        # Nothing is cached on a view; get_actions always reads the arrays.
+        pass
+
+    def get_actions(self, carrying=None) -> dict:
+        # Same as Node.get_actions.  With carrying = None, every action the cell can ever have.
+        y, x = self.coords
+        actions = {action: (y + MOVES[action][0], x + MOVES[action][1]) for action in self.world.get_moves(self)}
+        node_type = self.type
+        if node_type == "Pickup" and (carrying is None or (not carrying and self.packages > 0)):
+            actions["Pickup"] = (y, x)
+        if node_type == "Dropoff" and (carrying is None or (carrying and self.packages < self.capacity)):
+            actions["Dropoff"] = (y, x)
+        return actions
+
+class NodeMap(Mapping):
+    # World.nodes for a CompactWorld: coords to a fresh NodeView, in index order.
+    __slots__ = ("world",)
+
+    def __init__(self, world):
+        self.world = world
+
+    def __getitem__(self, coords: Tuple[int, int]) -> NodeView:
+        index = self.world.get_index(coords)
+        if index < 0:
+            raise KeyError(coords)
+        return NodeView(self.world, index)
+
+    def __contains__(self, coords) -> bool:
+        return self.world.get_index(coords) >= 0
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.world.get_coords(index)
+
+    def __len__(self) -> int:
+        return self.world.rows * self.world.columns
+
+class NodeList(Sequence):
+    # World.node_list for a CompactWorld: node index to a fresh NodeView.
+    __slots__ = ("world",)
+
+    def __init__(self, world):
+        self.world = world
+
+    def __getitem__(self, index: int) -> NodeView:
+        if isinstance(index, slice):
+            return [NodeView(self.world, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return NodeView(self.world, int(index))
+
+    def __len__(self) -> int:
+        return self.world.rows * self.world.columns
+
+class CompactWorld(World):
+    """
+        A World for large grids that stores cells in NumPy arrays instead of one Node per cell.
+
+        Cell types, package counts and capacities are arrays indexed by node index, which is row major
+        from the top left, the same order get_world_agent adds nodes in.  world.nodes and
+        world.node_list hand out NodeViews on demand, so Agent, the policies and the visualizer work
+        unchanged.  Only the pickups and dropoffs keep views around, in world.pickups and world.dropoffs.
+
+        The cells are fixed once built, so add_node is not supported.  The array backend is the
+        default, since the dict backend still builds one dict per cell.
+    """
+    def __init__(self, size: Tuple[int, int], offset: int, pickups: list, dropoffs: list, packages=0,
+                 capacity=0, backend: str="array", dtype=np.float64):
+        """
+            pickups, dropoffs: Coordinates of the pickup and dropoff cells.
+            packages: Starting packages at each pickup, either one number or one per pickup.
+            capacity: Capacity of each dropoff, either one number or one per dropoff.
+            dtype: Type of the array backend's q-values.  float32 halves the q-table.
+        """
+        super().__init__(size, offset, backend=backend)
+        self.dtype = dtype
+        self.nodes = NodeMap(self)
+        self.node_list = NodeList(self)
+        cell_count = self.rows * self.columns
+
+        self.types = np.zeros(cell_count, dtype=np.int8)
+        self.packages = np.zeros(cell_count, dtype=np.int32)
+        self.starting_packages = np.zeros(cell_count, dtype=np.int32)
+        self.capacities = np.zeros(cell_count, dtype=np.int32)
+        # Availability mask bit of each pickup and dropoff, by node index.
+        self.slots = {}
+
+        # Slots follow node index order, like a World built by add_node.
+        pickup_indices = self._indices(pickups)
+        dropoff_indices = self._indices(dropoffs)
+        pickup_order = np.argsort(pickup_indices, kind="stable")
+        dropoff_order = np.argsort(dropoff_indices, kind="stable")
+        self.pickup_indices = pickup_indices[pickup_order]
+        self.dropoff_indices = dropoff_indices[dropoff_order]
+        self.types[self.pickup_indices] = PICKUP_CODE
+        self.starting_packages[self.pickup_indices] = np.broadcast_to(packages, len(pickups))[pickup_order]
+        self.packages[self.pickup_indices] = self.starting_packages[self.pickup_indices]
+        # A cell listed as both ends up a dropoff, as in get_world_agent.
+        self.types[self.dropoff_indices] = DROPOFF_CODE
+        self.capacities[self.dropoff_indices] = np.broadcast_to(capacity, len(dropoffs))[dropoff_order]
+        self.pickup_indices = self.pickup_indices[self.types[self.pickup_indices] == PICKUP_CODE]
+        self.starting_packages[self.dropoff_indices] = 0
+        self.packages[self.dropoff_indices] = 0
+
+        self.pickups = [NodeView(self, int(index)) for index in self.pickup_indices]
+        self.dropoffs = [NodeView(self, int(index)) for index in self.dropoff_indices]
+        self._rebuild_masks()
+
+    def _indices(self, coords: list) -> np.ndarray:
+        indices = np.array([self.get_index(cell) for cell in coords], dtype=np.int64)
+        if (indices < 0).any():
+            raise ValueError("Pickup or dropoff outside of the " + str(self.rows) + "x" + str(self.columns) + " grid.")
+        return indices
+
+    def get_index(self, coords: Tuple[int, int]) -> int:
+        row = coords[0] - self.offset
+        column = coords[1] - self.offset
+        if 0 <= row < self.rows and 0 <= column < self.columns:
+            return row * self.columns + column
+        return -1
+
+    def get_coords(self, index: int) -> Tuple[int, int]:
+        row, column = divmod(int(index), self.columns)
+        return (row + self.offset, column + self.offset)
+
+    def add_node(self, coords: Tuple[int, int], state: str, packages: int=0, capacity: int=0):
+        raise TypeError("A CompactWorld's cells are fixed when it is built.")
+
+    def clone(self, qtable: bool=False):
+        # Copy the cell arrays, which is all the state a CompactWorld has per cell.
+        if self.transitions is None:
+            self.compile()
+        world = CompactWorld.__new__(CompactWorld)
+        world.__dict__.update(self.__dict__)
+        world.nodes = NodeMap(world)
+        world.node_list = NodeList(world)
+        for name in ("types", "packages", "starting_packages", "capacities"):
+            setattr(world, name, getattr(self, name).copy())
+        world.slots = dict(self.slots)
+        world.pickups = [NodeView(world, pickup.index) for pickup in self.pickups]
+        world.dropoffs = [NodeView(world, dropoff.index) for dropoff in self.dropoffs]
+        world.qtable = self._copy_qtable(self.qtable, world) if qtable else None
+        return world
+
+    def swap_pickup_dropoff(self, reset_packages=True):
+        super().swap_pickup_dropoff(reset_packages)
+        self.pickup_indices, self.dropoff_indices = self.dropoff_indices, self.pickup_indices
+
+    def compile(self):
+        """
+            Build the transition table with array arithmetic.  The transitions only depend on the grid
+            size, so this is cheap even for millions of cells.
+
+            The action masks are left for get_action_masks to build when something asks for them,
+            since with one row per (node, carrying, mask) they are far bigger than the grid.  The single
+            agent path reads the type and package arrays instead, see get_valid_actions.
+        """
+        grid = np.arange(self.rows * self.columns, dtype=np.int64).reshape(self.rows, self.columns)
+        transitions = np.full((self.rows, self.columns, len(ACTIONS)), -1, dtype=np.int64)
+        transitions[1:, :, ACTION_INDEX["Up"]] = grid[:-1, :]
+        transitions[:-1, :, ACTION_INDEX["Down"]] = grid[1:, :]
+        transitions[:, 1:, ACTION_INDEX["Left"]] = grid[:, :-1]
+        transitions[:, :-1, ACTION_INDEX["Right"]] = grid[:, 1:]
+        self.transitions = transitions.reshape(-1, len(ACTIONS))
+        self.action_masks = None
+
+        # Each cell's on-grid moves as a 4 bit code, and the action tuples for every code.
+        bits = 1 << np.arange(len(ACTIONS))
+        self._move_codes = ((self.transitions >= 0) * bits).sum(axis=1).astype(np.uint8)
+        self._move_sets = [tuple(action for bit, action in zip(bits, ACTIONS) if code & bit)
+                           for code in range(1 << len(ACTIONS))]
+        self._pickup_sets = [moves + ("Pickup",) for moves in self._move_sets]
+        self._dropoff_sets = [moves + ("Dropoff",) for moves in self._move_sets]
+
+    def get_moves(self, node: NodeView) -> tuple:
+        if self.transitions is None:
+            self.compile()
+        return self._move_sets[self._move_codes[node.index]]
+
+    def get_valid_actions(self, node: NodeView, carrying: bool) -> tuple:
+        if self.transitions is None:
+            self.compile()
+        index = node.index
+        code = self._move_codes[index]
+        node_type = self.types[index]
+        if node_type == PICKUP_CODE and not carrying and self.packages[index] > 0:
+            return self._pickup_sets[code]
+        if node_type == DROPOFF_CODE and carrying and self.packages[index] < self.capacities[index]:
+            return self._dropoff_sets[code]
+        return self._move_sets[code]
+
+    def get_next_node(self, node: NodeView, action: str) -> NodeView:
+        if action in ACTION_INDEX:
+            if self.transitions is None:
+                self.compile()
+            return NodeView(self, int(self.transitions[node.index, ACTION_INDEX[action]]))
+        # Picking up and dropping off leave us where we are.
+        return node
+
+    def _initialize_table(self):
+        if self.backend == "array":
+            self.qtable = ArrayQTable(self, dtype=self.dtype)
+            return
+        super()._initialize_table()
@@ -0,0 +1,113 @@
+__author__ = "Jackson Murrell"
+
+from world import World, Node
+
+class ConvergenceMonitor(object):
+    """
+        Watches a world's q-values for convergence while an experiment runs.
+
+        Attach one to an agent with agent.monitor, and to its planner with planner.monitor if it has one,
+        then call step() once per step.  Every q-value write reports its absolute change through update(),
+        and every window steps the monitor records the largest and mean of those changes, and the share of
+        states whose greedy action changed.  Only the states written to in the window are checked for a
+        new greedy action, so nothing is copied.  Once each of these that has a threshold stays at or
+        under it for patience windows in a row, the run has converged and step() returns True.
+
+        With a constant learning rate and an exploring policy a few q-values keep moving, so by default
+        only the mean change and the greedy policy are checked.
+    """
+    def __init__(self, world: World, window: int=500, max_delta_threshold: float=None,
+                 mean_delta_threshold: float=0.3, policy_threshold: float=0.02, patience: int=3, min_steps: int=0):
+        """
+            window: Steps between checks.
+            max_delta_threshold: Largest change of any one q-value update in a window that still counts as
+                                 converged.
+            mean_delta_threshold: Largest mean change per q-value update in a window.
+            policy_threshold: Largest share of states, from 0 to 1, whose greedy action may change.
+            patience: Windows in a row that have to be under every threshold.  Thresholds set to None
+                      are not checked.
+            min_steps: Never report convergence before this many steps.
+        """
+        self.world = world
+        self.window = window
+        # Thresholds by the history entry they apply to.
+        self.thresholds = {"max_delta": max_delta_threshold,
+                           "mean_delta": mean_delta_threshold,
+                           "policy_change": policy_threshold}
+        self.patience = patience
+        self.min_steps = min_steps
+        self.steps = 0
+        # One entry per window: the step it ended at, max_delta, mean_delta and policy_change.
+        self.history = []
+        self.streak = 0
+        self.converged_at = None
+        self.reason = None
+        self._clear_window()
+
+    def _clear_window(self):
+        # Running totals of the q-value changes in the current window.
+        self.max_delta = 0.0
+        self.delta_sum = 0.0
+        self.updates = 0
+        # (node, carrying, availability mask) of every state written to this window, to its greedy action
+        # from before the first write.
+        self.touched = {}
+
+    def restart(self):
+        # Forget any convergence so far, such as after the layout changes.  The history is kept.
+        self.streak = 0
+        self.converged_at = None
+        self.reason = None
+        self._clear_window()
+
+    def _greedy(self, node: Node, carrying: bool, mask: int) -> str:
+        q_table = self.world.get_q_state_table(node, carrying, mask)
+        return max(q_table.keys(), key=lambda action: q_table[action])
+
+    def update(self, node: Node, carrying: bool, mask: int, delta: float):
+        """
+            Report a q-value of the state (node, carrying, mask) that is about to change by delta.  Has to
+            be called before the new value is written, so the state's old greedy action can be noted.
+        """
+        delta = abs(delta)
+        if delta > self.max_delta:
+            self.max_delta = delta
+        self.delta_sum += delta
+        self.updates += 1
+        state = (node, carrying, mask)
+        if state not in self.touched:
+            self.touched[state] = self._greedy(node, carrying, mask)
+
+    def step(self) -> bool:
+        self.steps += 1
+        if self.steps % self.window:
+            return self.converged_at is not None
+        world = self.world
+        states = len(world.node_list) * 2 * (1 << max(len(world.pickups), len(world.dropoffs)))
+        changed = sum(1 for state, greedy in self.touched.items() if self._greedy(*state) != greedy)
+        stats = {"step": self.steps,
+                 "max_delta": self.max_delta,
+                 "mean_delta": self.delta_sum / self.updates if self.updates else 0.0,
+                 "policy_change": changed / states}
+        self.history.append(stats)
+        self._clear_window()
+
+        checks = {name: threshold for name, threshold in self.thresholds.items() if threshold is not None}
+        if all(stats[name] <= threshold for name, threshold in checks.items()):
+            self.streak += 1
+        else:
+            self.streak = 0
+        if self.converged_at is None and self.streak >= self.patience and self.steps >= self.min_steps:
+            self.converged_at = self.steps
+            self.reason = (" and ".join(name + " " + str(round(stats[name], 6)) + " <= " + str(threshold)
+                                        for name, threshold in checks.items()) +
+                           " for " + str(self.streak) + " windows of " + str(self.window) + " steps")
+        return self.converged_at is not None
+
+    def report(self) -> dict:
+        return {"converged": self.converged_at is not None,
+                "converged_at": self.converged_at,
+                "reason": self.reason,
+                "window": self.window,
+                "thresholds": self.thresholds,
+                "history": self.history}
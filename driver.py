@@ -1,67 +1,243 @@
 __author__ = "Jackson Murrell"
 
+import functools
+import time
+
+import os
+
+import numpy as np
+
 import agent
+import checkpoint
+import planning
+import profiling
+import shaping
+import solver
+import team
+import trajectory
 
 from typing import Tuple
+from agent import RandomStream
 from world import World, Node
+from template import WorldTemplate
+from convergence import ConvergenceMonitor
+
+# Most layouts to keep a WorldTemplate around for in each process.
+TEMPLATE_CACHE_SIZE = 8
+
+# The pre-defined experiments, as the arguments to experiment():
+# (learning_rate, discount_rate, learning_method, policies, swap)
+EXPERIMENTS = {1: (0.3, 0.5, "q_learning", [(agent.policy_random, 4000), (agent.policy_greedy, 4000)], False),
+               2: (0.3, 0.5, "q_learning", [(agent.policy_random, 200), (agent.policy_exploit, 7800)], False),
+               3: (0.3, 0.5, "sarsa", [(agent.policy_random, 200), (agent.policy_exploit, 7800)], False),
+               4: (0.3, 1.0, "sarsa", [(agent.policy_random, 200), (agent.policy_exploit, 7800)], False),
+               5: (0.3, 0.5, "q_learning", [(agent.policy_random, 200), (agent.policy_exploit, 7800)], True)}
+
+def limit_steps(policies: list, steps: int) -> list:
+    """
+        Cut a policy schedule down to the given number of steps.  If the schedule is shorter, the
+        last policy runs for the remainder.
+    """
+    limited = []
+    for policy, iterations in policies:
+        if steps <= 0:
+            break
+        limited.append((policy, min(iterations, steps)))
+        steps -= iterations
+    if steps > 0:
+        policy, iterations = limited[-1]
+        limited[-1] = (policy, iterations + steps)
+    return limited
 
 def get_world_agent(size: Tuple[int, int], method, dropoff=None, pickup=None, package_count: int=3,
-                    even_split: bool=True, start=None, offset: int=1, capacity=None) -> agent.Agent:
+                    even_split: bool=True, start=None, offset: int=1, capacity=None,
+                    backend: str="dict", rng=None, compact: bool=False, seed=None, dtype=np.float64) -> agent.Agent:
     """
         Create a world of the specified size.
         size: A tuple containing rows and columns.
 
         even_split : True to make the dropoff and pickup points have the same amount of packages.
+        backend : The q-table backend to use, "dict" or "array".
+        rng : Source of randomness for the agent's policies, and its start if none is given.
+              Defaults to an agent.RandomStream of seed.
+        compact : True to store the grid in arrays with a CompactWorld, for very large sizes.
+        dtype : Type of a CompactWorld's q-values.  float32 halves the q-table.
     """
-    worldspace = World(size, offset)
-    rows, columns = size
-
-    # Offset the coordinates by a certain amount so we get better looking values.
-    for row in range(offset, rows+offset):
-        for column in range(offset, columns+offset):
-            state = "None"
-            coords = (row, column)
-            distribution = int(package_count / len(pickup))
-            packages = capacity = 0
-            if coords in pickup:
-                state = "Pickup"
-                packages = distribution
-            if coords in dropoff:
-                state = "Dropoff"
-                capacity = distribution
-            worldspace.add_node(coords, state, packages=packages, capacity=capacity)
-
-    if start == None:
-        start = (random.randint(1, self.rows), random.randint(1, self.columns))
-    else:
-        start = start
-
-    return agent.Agent(worldspace, start, method)
-
-def experiment(learning_rate: float, discount_rate: float, learning_method, policies: list, swap: bool=False):
+    template = get_template(tuple(size), tuple(pickup), tuple(dropoff), package_count, offset, backend, compact,
+                            np.dtype(dtype))
+    return template.agent(method, start, rng=rng, seed=seed)
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def get_template(size: Tuple[int, int], pickup: tuple, dropoff: tuple, package_count: int, offset: int,
+                 backend: str, compact: bool, dtype=np.float64) -> WorldTemplate:
+    # Layouts are built once per process, and every later world for them is a clone.
+    return WorldTemplate(size, pickup, dropoff, package_count, offset, backend, compact, dtype)
+
+def experiment(learning_rate: float, discount_rate: float, learning_method, policies: list, swap: bool=False,
+               backend: str="dict", seed=None, checkpoint_path: str=None, checkpoint_every: int=1000,
+               resume: bool=False, profile: bool=False, planning_steps: int=0, trace_decay: float=0.9,
+               agents: int=1, convergence: dict=None, trajectory_path: str=None, qtable_every: int=1000,
+               warm_start: bool=False, optimality_gap: bool=False,
+               transfer: bool=False, shaped: bool=False) -> dict:
+    """
+        Run the PD World experiment and return a summary of the run.
+
+        seed: Seed for the agent.RandomStream the policies draw from.  The same seed gives the same run,
+              in any process.  None seeds it from the operating system.
+        checkpoint_path: Save a checkpoint here every checkpoint_every steps, and at the end of the run.
+        resume: Carry on from the checkpoint at checkpoint_path, if there is one, exactly where it stopped.
+        profile: Time each phase of Agent.move, and add the profile to the results under "profile".
+        planning_steps: If above 0, run this many prioritized sweeping updates after each real q-update.
+        trace_decay: Lambda for the "sarsa_lambda" and "q_lambda" learning methods.
+        agents: Number of agents sharing the world and q-table.  With more than one, every step is a
+                team.Team tick that moves each agent once, and the score is the team's total.
+        convergence: Arguments for a convergence.ConvergenceMonitor.  If given, the run stops as soon as
+                     the q-table converges, or with swap, once it converges again after the swap.
+        trajectory_path: Log every move to this file with a trajectory.TrajectoryRecorder.
+        qtable_every: With trajectory_path, also save the q-table every this many steps, for playback.
+        warm_start: Start from the layout's optimal q-values, found with solver.value_iteration, instead of
+                    an empty q-table, so the random exploration at the start of a schedule can be skipped.
+        optimality_gap: Add "optimality_gap" to the results, comparing the greedy policy of the final
+                        q-table with the optimal one for the layout at the end of the run.
+        transfer: On swap, carry the q-table over to the new layout with World.transfer_q_table instead of
+                  carrying on with q-values learned for the old roles.
+        shaped: Learn from rewards shaped by a shaping.PotentialShaping, which pulls the agents towards the
+                nearest pickup or dropoff they can use.
+
+        Returns a dict with the number of terminations, the steps taken in each completed episode,
+        the score at the end of the run, the total number of steps and the wall time in seconds.
+        With convergence, "convergence" holds the monitor's report, including when and why it stopped.
+        With swap, "swap" holds the step the swap happened at, and the step of the first episode after it
+        that took no more steps than the last one before it, as "recovered_at" and "recovery_steps".
+    """
+    if agents > 1 and (checkpoint_path or profile or trajectory_path):
+        raise ValueError("Checkpoints, profiling and trajectories only support a single agent.")
+    start_time = time.perf_counter()
     world_size = (5, 5)
     start = (1, 5)
     dropoff = [(5, 1), (5, 3), (2, 5)]
     pickup = [(1, 1), (3, 3), (5, 5)]
+    rng = RandomStream(seed)
     agent = get_world_agent(world_size, learning_method, dropoff=dropoff, pickup=pickup, package_count=15,
-                            start=start)
+                            start=start, backend=backend, rng=rng)
+    agent.learning = learning_rate
+    agent.discount = discount_rate
+    agent.trace_decay = trace_decay
+    if profile:
+        agent.profiler = profiling.Profiler()
+    if agents > 1:
+        agent = team.Team(agent.world, [start] * agents, learning_method, learning_rate, discount_rate,
+                          policy=agent.policy, rng=rng, trace_decay=trace_decay)
+    if planning_steps:
+        for member in agent.agents if agents > 1 else [agent]:
+            member.planner = planning.PrioritizedSweeping(agent.world, learning_rate, discount_rate, planning_steps)
+    if shaped:
+        # One potential cache between the agents, since they share the world.
+        potential_shaping = shaping.PotentialShaping(agent.world)
+        for member in agent.agents if agents > 1 else [agent]:
+            member.shaping = potential_shaping
+    if warm_start:
+        solver.warm_start(agent.world, discount_rate)
+    monitor = ConvergenceMonitor(agent.world, **convergence) if convergence is not None else None
+    if monitor:
+        for member in agent.agents if agents > 1 else [agent]:
+            member.monitor = monitor
+            if member.planner:
+                member.planner.monitor = monitor
+    if trajectory_path:
+        # A resumed run carries on the trajectory from where the checkpoint left it, dropping anything the
+        # interrupted run logged after that.  Without a checkpoint to resume from, it starts over.
+        logged = None
+        if resume and checkpoint_path and os.path.exists(checkpoint_path) and os.path.exists(trajectory_path):
+            logged = checkpoint.read_header(checkpoint_path)["state"]["progress"].get("trajectory")
+        if logged:
+            trajectory.truncate(trajectory_path, logged["rows"], logged["snapshots"])
+        agent.recorder = trajectory.TrajectoryRecorder(trajectory_path, agent.world, method=learning_method,
+                                                       append=bool(logged), qtable_every=qtable_every)
 
-    index = 0
-    policy, iterations = policies[index]
     terminations = 0
+    steps = 0
+    episode_start = 0
+    steps_per_episode = []
+    swap_progress = None
+    if resume and checkpoint_path and os.path.exists(checkpoint_path):
+        progress = checkpoint.resume_checkpoint(checkpoint_path, agent)
+        terminations = progress["terminations"]
+        steps = progress["steps"]
+        episode_start = progress["episode_start"]
+        steps_per_episode = progress["steps_per_episode"]
+        swap_progress = progress.get("swap")
+
+    def save():
+        progress = {"terminations": terminations, "steps": steps, "episode_start": episode_start,
+                    "steps_per_episode": steps_per_episode, "swap": swap_progress}
+        if trajectory_path:
+            # Write out the trajectory so far, and note how long it is, for resume to cut it back to.
+            recorder = agent.recorder
+            recorder.flush()
+            progress["trajectory"] = {"rows": recorder.steps,
+                                      "snapshots": recorder.history.count if recorder.history else None}
+        checkpoint.save_checkpoint(checkpoint_path, agent, progress)
 
     # Keep looping until we get all the way through without terminating.
     # We need to restart the expirement if we terminate.
+    schedule_start = 0
+    converged = False
     for policy, iterations in policies:
+        if converged:
+            break
         agent.policy = policy
+        # Skip whatever part of this policy's iterations a resumed run already did.
+        first = min(max(steps - schedule_start, 0), iterations)
+        schedule_start += iterations
         # Do a large number of iterations to seed the qtable.
-        for _ in range(0, iterations):
+        for _ in range(first, iterations):
             # Reset the world if we terminated.
-            if agent.move():
+            terminated, _ = agent.move()
+            steps += 1
+            if terminated:
                 agent.reset()
                 terminations += 1
+                steps_per_episode.append(steps - episode_start)
+                episode_start = steps
+                if swap_progress and swap_progress["recovered_at"] is None and \
+                        steps_per_episode[-1] <= swap_progress["target_episode_steps"]:
+                    swap_progress["recovered_at"] = steps
+                    swap_progress["recovery_steps"] = steps - swap_progress["swapped_at"]
                 if terminations == 2 and swap:
-                    agent.swap_pickup_dropoff()
+                    agent.swap_pickup_dropoff(transfer)
+                    # Performance counts as recovered once an episode is as short as the last one before the swap.
+                    swap_progress = {"transfer": transfer, "swapped_at": steps,
+                                     "target_episode_steps": steps_per_episode[-1],
+                                     "recovered_at": None, "recovery_steps": None}
+                    if monitor:
+                        monitor.restart()
+            if checkpoint_path and steps % checkpoint_every == 0:
+                save()
+            if monitor and monitor.step() and (terminations >= 2 or not swap):
+                converged = True
+                break
+
+    if checkpoint_path:
+        save()
+    if trajectory_path:
+        agent.recorder.close()
+    results = {"terminations": terminations,
+               "steps_per_episode": steps_per_episode,
+               "final_score": agent.score,
+               "steps": steps,
+               "wall_time": time.perf_counter() - start_time}
+    if monitor:
+        results["convergence"] = monitor.report()
+    if swap_progress:
+        results["swap"] = swap_progress
+    if optimality_gap:
+        start_node = agent.agents[0].start_node if agents > 1 else agent.start_node
+        results["optimality_gap"] = solver.optimality_gap(agent.world, start_node, discount_rate)
+    if profile:
+        results["profile"] = agent.profiler.as_dict(agent.world)
+        results["profile_summary"] = agent.profiler.summary(agent.world)
+    return results
 
 def bp():
     import pdb;pdb.set_trace()
@@ -9,9 +9,7 @@ __credits__ = ["Jackson Murrell", "Kevin Mehta", "Duncan McPhie"]
 
 import sys, argparse
 
-import agent
-from driver import experiment
-from vis import visualize_experiment
+from driver import experiment, limit_steps, EXPERIMENTS
 
 def exception_handler(exception_type, exception, traceback, debug_hook=sys.excepthook):
     import pdb
@@ -21,25 +19,119 @@ def exception_handler(exception_type, exception, traceback, debug_hook=sys.excep
 def bp():
     import pdb;pdb.set_trace()
 
+def run_headless(args) -> int:
+    learning_rate, discount_rate, learning_method, policies, swap = EXPERIMENTS[args.experiment]
+    learning_method = args.method if args.method else learning_method
+    if args.steps is not None:
+        policies = limit_steps(policies, args.steps)
+    convergence = None
+    if args.converge:
+        convergence = {"window": args.window, "max_delta_threshold": args.max_delta,
+                       "mean_delta_threshold": args.mean_delta, "policy_threshold": args.policy_change,
+                       "patience": args.patience}
+    results = experiment(learning_rate, discount_rate, learning_method, policies, swap=swap,
+                         backend=args.backend, seed=args.seed, checkpoint_path=args.checkpoint,
+                         checkpoint_every=args.checkpoint_every, resume=args.resume, profile=args.profile,
+                         planning_steps=args.planning_steps, trace_decay=args.trace_decay, agents=args.agents,
+                         convergence=convergence, trajectory_path=args.trajectory,
+                         qtable_every=args.qtable_every, warm_start=args.warm_start,
+                         optimality_gap=args.optimality_gap, transfer=args.transfer,
+                         shaped=args.shaped)
+    print("Experiment " + str(args.experiment) + ": " + str(results["steps"]) + " steps, " +
+          str(results["terminations"]) + " terminations, final score " + str(results["final_score"]) +
+          ", " + str(round(results["wall_time"], 3)) + "s")
+    if args.converge:
+        report = results["convergence"]
+        if report["converged"]:
+            print("Stopped early at step " + str(report["converged_at"]) + ", after " + str(results["terminations"]) +
+                  " episodes: " + report["reason"])
+        else:
+            print("Did not converge.")
+    if "swap" in results:
+        recovery = results["swap"]
+        print("Swapped at step " + str(recovery["swapped_at"]) + (" with" if recovery["transfer"] else " without") +
+              " q-table transfer, " +
+              ("recovered the last pre-swap episode length of " + str(recovery["target_episode_steps"]) +
+               " steps after " + str(recovery["recovery_steps"]) + " steps."
+               if recovery["recovered_at"] is not None else "never recovered the pre-swap episode length."))
+    if args.optimality_gap:
+        gap = results["optimality_gap"]
+        print("Optimal return " + str(round(gap["optimal_return"], 4)) + ", greedy return " +
+              str(round(gap["greedy_return"], 4)) + ", gap " + str(round(gap["gap"], 4)) + ", " +
+              str(round(100 * gap["policy_agreement"], 1)) + "% of states agree with the optimal policy")
+    if args.profile:
+        print(results["profile_summary"])
+    return 0
+
 def main() -> int:
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--debug", required=False, action="store_true", default=False,
                         help="Enter a post-mortem debug shell if the program encounters an error. ")
+    subparsers = parser.add_subparsers(dest="command")
+    gui_parser = subparsers.add_parser("gui", help="Visualize the experiments with pygame (the default).")
+    gui_parser.add_argument("--playback", default=None,
+                            help="Replay a trajectory file recorded with run --trajectory instead of running live.")
+    gui_parser.add_argument("--qtable-history", default=None,
+                            help="Q-table history to show with --playback, defaults to the one saved with it.")
+    run_parser = subparsers.add_parser("run", help="Run an experiment headless, without pygame.")
+    run_parser.add_argument("-e", "--experiment", type=int, choices=sorted(EXPERIMENTS), default=1)
+    run_parser.add_argument("-s", "--steps", type=int, default=None,
+                            help="Number of steps to run, defaults to the experiment's full schedule.")
+    run_parser.add_argument("--seed", type=int, default=None)
+    run_parser.add_argument("--backend", choices=["dict", "array"], default="dict")
+    run_parser.add_argument("--checkpoint", default=None, help="Save the q-table and progress to this file.")
+    run_parser.add_argument("--checkpoint-every", type=int, default=1000)
+    run_parser.add_argument("--resume", action="store_true", default=False,
+                            help="Carry on from the checkpoint file, if it exists.")
+    run_parser.add_argument("-m", "--method", choices=["q_learning", "sarsa", "sarsa_lambda", "q_lambda"],
+                            default=None, help="Override the experiment's learning method.")
+    run_parser.add_argument("--trace-decay", type=float, default=0.9,
+                            help="Lambda for the sarsa_lambda and q_lambda methods.")
+    run_parser.add_argument("--planning-steps", type=int, default=0,
+                            help="Simulated prioritized sweeping updates to run after each real one.")
+    run_parser.add_argument("--profile", action="store_true", default=False,
+                            help="Print how long each phase of Agent.move took.")
+    run_parser.add_argument("--agents", type=int, default=1,
+                            help="Number of agents sharing the world and q-table.  Each step moves all of them.")
+    run_parser.add_argument("--trajectory", default=None, help="Log every move to this binary trajectory file.")
+    run_parser.add_argument("--qtable-every", type=int, default=1000,
+                            help="With --trajectory, save the q-table every this many steps for playback.")
+    run_parser.add_argument("--converge", action="store_true", default=False,
+                            help="Stop early once the q-table and greedy policy stop changing.")
+    run_parser.add_argument("--window", type=int, default=500, help="Steps between convergence checks.")
+    run_parser.add_argument("--max-delta", type=float, default=None,
+                            help="Largest change from any one q-value update per window that counts as converged.")
+    run_parser.add_argument("--mean-delta", type=float, default=0.3,
+                            help="Largest mean change per q-value update in a window that counts as converged.")
+    run_parser.add_argument("--policy-change", type=float, default=0.02,
+                            help="Largest share of states whose greedy action may change per window.")
+    run_parser.add_argument("--patience", type=int, default=3,
+                            help="Windows in a row that have to meet the thresholds.")
+    run_parser.add_argument("--transfer", action="store_true", default=False,
+                            help="On swap, move the learned q-values onto the new pickup/dropoff roles.")
+    run_parser.add_argument("--shaped", action="store_true", default=False,
+                            help="Learn from rewards shaped by the distance to the nearest usable pickup or dropoff.")
+    run_parser.add_argument("--warm-start", action="store_true", default=False,
+                            help="Start from the layout's exact optimal q-values instead of an empty q-table.")
+    run_parser.add_argument("--optimality-gap", action="store_true", default=False,
+                            help="Compare the final greedy policy with the layout's optimal one.")
 
     args = parser.parse_args()
 
     if args.debug:
         sys.excepthook = exception_handler
 
-    return visualize_experiment()
+    if args.command == "run":
+        return run_headless(args)
 
-    return 0
+    # Only pull in pygame when we actually want the GUI.
+    from vis import visualize_experiment
+    if args.command == "gui":
+        visualize_experiment(playback=args.playback, qtable_history=args.qtable_history)
+    else:
+        visualize_experiment()
 
-
-import pygame
-bp()
-pygame.init()
-pygame.display.list_modes()
+    return 0
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,118 @@
+__author__ = "Jackson Murrell"
+
+import heapq
+
+from world import World, Node
+from agent import q_learning
+
+class PrioritizedSweeping(object):
+    """
+        Dyna-Q planning with prioritized sweeping.
+
+        Attach one to an agent with agent.planner.  After every real q-update, Agent.move reports the
+        transition with observe(), then calls plan() to run up to planning_steps simulated q_learning
+        updates, most surprising (largest Bellman error) first.
+
+        States are (node index, carrying, availability mask) tuples.  The world is deterministic, so the
+        model keeps the last reward and next state seen for each (state, action).
+    """
+    def __init__(self, world: World, learning_rate: float=0.5, discount_rate: float=0.5, planning_steps: int=10,
+                 threshold: float=1e-4):
+        """
+            threshold: Smallest Bellman error worth queueing.
+        """
+        self.world = world
+        self.learning = learning_rate
+        self.discount = discount_rate
+        self.planning_steps = planning_steps
+        self.threshold = threshold
+        # Set to a convergence.ConvergenceMonitor to report every simulated q-value change to.
+        self.monitor = None
+        self.clear()
+
+    def clear(self):
+        # Forget the model, for when the layout changes under it, such as a pickup/dropoff swap.
+        self.model = {}
+        self.predecessors = {}
+        self.queue = []
+        self.queued = {}
+        self.updates = 0
+
+    def get_state(self) -> dict:
+        """
+            The model and queue as JSON-serializable lists, for checkpoint.save_checkpoint.  States are
+            flattened into their (node index, carrying, availability mask) fields.
+        """
+        return {"model": [list(state) + [action, reward] + list(next_state)
+                          for (state, action), (reward, next_state) in self.model.items()],
+                "predecessors": [list(next_state) + list(state) + [action]
+                                 for next_state, keys in self.predecessors.items() for state, action in keys],
+                "queue": [[priority] + list(state) + [action] for priority, (state, action) in self.queue],
+                "queued": [list(state) + [action, priority] for (state, action), priority in self.queued.items()],
+                "updates": self.updates}
+
+    def set_state(self, saved: dict):
+        # Put back a model and queue saved with get_state.
+        def state(fields) -> tuple:
+            return (fields[0], bool(fields[1]), fields[2])
+        self.clear()
+        for entry in saved["model"]:
+            self.model[(state(entry[:3]), entry[3])] = (entry[4], state(entry[5:]))
+        for entry in saved["predecessors"]:
+            self.predecessors.setdefault(state(entry[:3]), set()).add((state(entry[3:6]), entry[6]))
+        # Saved in heap order, so it is still a heap.
+        self.queue = [(entry[0], (state(entry[1:4]), entry[4])) for entry in saved["queue"]]
+        self.queued = {(state(entry[:3]), entry[3]): entry[4] for entry in saved["queued"]}
+        self.updates = saved["updates"]
+
+    def _q_table(self, state) -> dict:
+        node_index, carrying, mask = state
+        return self.world.get_q_state_table(self.world.node_list[node_index], carrying, mask)
+
+    def _error(self, state, action: str) -> float:
+        reward, next_state = self.model[(state, action)]
+        next_q = max(q_value for _, q_value in self._q_table(next_state).items())
+        return reward + self.discount * next_q - self._q_table(state)[action]
+
+    def _push(self, state, action: str):
+        priority = abs(self._error(state, action))
+        key = (state, action)
+        if priority > self.threshold and priority > self.queued.get(key, 0):
+            self.queued[key] = priority
+            heapq.heappush(self.queue, (-priority, key))
+
+    def observe(self, node: Node, action: str, carrying: bool, reward: int, next_node: Node, next_carrying: bool):
+        """
+            Record a real move into the model, and queue it if its q-value is out of date.
+            next_carrying is the carrying status once any pickup or dropoff at next_node is done.
+        """
+        state = (node.index, carrying, self.world.get_availability_mask(carrying))
+        next_state = (next_node.index, next_carrying, self.world.get_availability_mask(next_carrying))
+        self.model[(state, action)] = (reward, next_state)
+        self.predecessors.setdefault(next_state, set()).add((state, action))
+        self._push(state, action)
+
+    def plan(self):
+        for _ in range(self.planning_steps):
+            # Skip queue entries that were superseded by a higher priority push.
+            while self.queue:
+                priority, key = heapq.heappop(self.queue)
+                if self.queued.get(key) == -priority:
+                    break
+            else:
+                return
+            del self.queued[key]
+            state, action = key
+            reward, next_state = self.model[key]
+            q_table = self._q_table(state)
+            next_q = max(q_value for _, q_value in self._q_table(next_state).items())
+            new_q = q_learning(reward, self.learning, self.discount, q_table[action], next_q)
+            if self.monitor:
+                node_index, carrying, mask = state
+                self.monitor.update(self.world.node_list[node_index], carrying, mask, new_q - q_table[action])
+            q_table[action] = new_q
+            self.updates += 1
+
+            # Whatever leads into this state may now be out of date too.
+            for predecessor, predecessor_action in self.predecessors.get(state, ()):
+                self._push(predecessor, predecessor_action)
@@ -0,0 +1,136 @@
+__author__ = "Jackson Murrell"
+
+import os
+
+import numpy as np
+
+import driver
+import trajectory
+
+from world import ALL_ACTIONS
+
+def score(value: float):
+    # Rewards are stored as floats; show whole scores the way a live run does.
+    value = float(value)
+    return int(value) if value.is_integer() else round(value, 2)
+
+class Playback(object):
+    """
+        Replays a recorded trajectory onto a real world and agent, so they can be drawn like a live run.
+
+        seek(position) puts self.agent and its world in the state they were in after that many moves:
+        where the agent stood, what it carried, the package counts and the nearest saved q-table.
+        Package counts are rebuilt from the start of the episode, so seeking anywhere only costs one
+        episode's worth of moves, and stepping forward costs just the new moves.
+
+        The moves are read through a trajectory.TrajectoryReader, a chunk at a time, so only where each
+        episode starts and ends and what it scored are kept in memory, however long the run was.
+    """
+    def __init__(self, path: str, qtable_path: str=None):
+        """
+            qtable_path: Q-table history to show, defaults to the one saved next to the trajectory.
+        """
+        self.reader = trajectory.TrajectoryReader(path)
+        self.header = header = self.reader.header
+        self.length = self.reader.length
+        pickups = [tuple(coords) for coords in header["pickups"]]
+        dropoffs = [tuple(coords) for coords in header["dropoffs"]]
+        start = self.reader.read(0, 1)["node"][0] if self.length else 0
+        # Everything is redrawn from the arrays, so the array backend is the natural fit.
+        self.agent = driver.get_world_agent(tuple(header["size"]), header["method"], dropoff=dropoffs, pickup=pickups,
+                                            package_count=sum(header["packages"]), offset=header["offset"],
+                                            start=self._coords(start), backend="array")
+        self.world = self.agent.world
+
+        qtable_path = qtable_path or trajectory.history_path(path)
+        if os.path.exists(qtable_path):
+            self.snapshot_steps, self.snapshots = trajectory.load_qtable_history(qtable_path)
+        else:
+            self.snapshot_steps, self.snapshots = np.zeros(0, dtype=np.uint64), None
+        self.snapshot = None
+
+        # Moves that ended an episode, and the total reward up to and including each of them.
+        ends = []
+        end_rewards = []
+        total = 0.0
+        for first, columns in zip(self.reader.chunk_starts, self.reader.iter_range(0, self.length)):
+            rewards = np.cumsum(columns["reward"], dtype=np.float64) + total
+            chunk_ends = np.flatnonzero(columns["flags"] & trajectory.TERMINATED)
+            ends.append(chunk_ends + first)
+            end_rewards.append(rewards[chunk_ends])
+            total = float(rewards[-1])
+        self.ends = np.concatenate(ends) if ends else np.zeros(0, dtype=np.int64)
+        end_rewards = np.concatenate(end_rewards) if end_rewards else np.zeros(0)
+        # The move each episode starts at, and the total reward before it.
+        self.starts = np.concatenate(([0], self.ends + 1))
+        self.start_rewards = np.concatenate(([0.0], end_rewards))
+        self.position = None
+        self.episode_start = None
+        self.episode_reward = 0.0
+        self.seek(0)
+
+    def _coords(self, index: int):
+        row, column = divmod(int(index), self.header["size"][1])
+        return (row + self.header["offset"], column + self.header["offset"])
+
+    @property
+    def episode(self) -> int:
+        # Number of episodes finished before the current position.
+        return int(np.searchsorted(self.ends, self.position))
+
+    def seek(self, position: int):
+        position = min(max(int(position), 0), self.length)
+        episode_start = int(self.starts[np.searchsorted(self.starts, position, side="right") - 1])
+        if episode_start != self.episode_start or position < self.position:
+            self._reset(episode_start)
+        self._apply(self.position, position)
+        self.position = position
+        self._load_qtable()
+
+    def _reset(self, episode_start: int):
+        world = self.world
+        swapped = episode_start < self.length and \
+            bool(self.reader.read(episode_start, episode_start + 1)["flags"][0] & trajectory.SWAPPED)
+        world.reset()
+        if swapped != world._swapped:
+            world.swap_pickup_dropoff()
+        self.agent.current_node = self.agent.start_node
+        self.agent.carrying = False
+        self.agent.score = 0
+        self.episode_start = episode_start
+        self.episode_reward = 0.0
+        self.position = episode_start
+
+    def _apply(self, first: int, last: int):
+        # Play the moves in [first, last) of the current episode onto the world.
+        node_list = self.world.node_list
+        for columns in self.reader.iter_range(first, last):
+            nodes = columns["node"]
+            for row, action in enumerate(columns["action"]):
+                action = ALL_ACTIONS[action]
+                if action == "Pickup":
+                    node_list[int(nodes[row])].pickup()
+                elif action == "Dropoff":
+                    node_list[int(nodes[row])].dropoff()
+            self.episode_reward += float(columns["reward"].sum(dtype=np.float64))
+            self.agent.current_node = node_list[int(columns["next_node"][-1])]
+            self.agent.carrying = bool(columns["carrying"][-1])
+        self.agent.score = score(self.episode_reward)
+
+    def _load_qtable(self):
+        snapshot = int(np.searchsorted(self.snapshot_steps, self.position, side="right")) - 1
+        if snapshot < 0 or snapshot == self.snapshot:
+            return
+        self.snapshot = snapshot
+        self.world.set_q_array(np.array(self.snapshots[snapshot]))
+
+    def total_score(self) -> float:
+        return score(self.start_rewards[np.searchsorted(self.starts, self.episode_start)] + self.episode_reward)
+
+    def terminations(self, count: int) -> list:
+        """
+            The last count episodes finished before the current position, as (number, score, move).
+        """
+        finished = self.episode
+        return [(number, score(self.start_rewards[number + 1] - self.start_rewards[number]), int(self.ends[number]) + 1)
+                for number in range(max(0, finished - count), finished)]
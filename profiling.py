@@ -0,0 +1,87 @@
+__author__ = "Jackson Murrell"
+
+import sys
+
+from time import perf_counter
+
+# The phases Agent.move is split into, in the order they run.
+LOOKUP = "lookup"
+POLICY = "policy"
+REWARD = "reward"
+UPDATE = "update"
+TERMINATION = "termination"
+PHASES = (LOOKUP, POLICY, REWARD, UPDATE, TERMINATION)
+
+class Profiler(object):
+    """
+        Collects per-phase timings from Agent.move.
+
+        Set agent.profiler to a Profiler to turn it on.  Agent.move calls start() once, then lap(phase)
+        at the end of each phase, which charges the time since the previous call to that phase.  With
+        agent.profiler left as None, move only pays for a few falsy checks.
+    """
+    def __init__(self):
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.counts = dict.fromkeys(PHASES, 0)
+        self.moves = 0
+        self.episodes = 0
+        self._last = None
+
+    def start(self):
+        self.moves += 1
+        self._last = perf_counter()
+
+    def lap(self, phase: str):
+        now = perf_counter()
+        self.times[phase] += now - self._last
+        self.counts[phase] += 1
+        self._last = now
+
+    def episode(self):
+        self.episodes += 1
+
+    def as_dict(self, world=None) -> dict:
+        total = sum(self.times.values())
+        profile = {"moves": self.moves,
+                   "episodes": self.episodes,
+                   "total_seconds": total,
+                   "phases": {phase: {"seconds": self.times[phase],
+                                      "calls": self.counts[phase],
+                                      "share": self.times[phase] / total if total else 0.0}
+                              for phase in PHASES}}
+        if world is not None:
+            profile["qtable_bytes"] = qtable_memory(world)
+        return profile
+
+    def summary(self, world=None) -> str:
+        profile = self.as_dict(world)
+        lines = ["Moves: " + str(profile["moves"]) + "  Episodes: " + str(profile["episodes"]) +
+                 "  Time in move: " + str(round(profile["total_seconds"], 4)) + "s"]
+        for phase, stats in profile["phases"].items():
+            per_call = stats["seconds"] / stats["calls"] * 1e6 if stats["calls"] else 0.0
+            lines.append("  " + phase.ljust(12) + str(round(stats["seconds"], 4)).rjust(10) + "s " +
+                         str(round(100 * stats["share"], 1)).rjust(6) + "% " +
+                         str(stats["calls"]).rjust(9) + " calls " + str(round(per_call, 2)).rjust(8) + "us/call")
+        if world is not None:
+            lines.append("Q-table memory: " + str(profile["qtable_bytes"]) + " bytes")
+        return "\n".join(lines)
+
+def qtable_memory(world) -> int:
+    """
+        Approximate number of bytes used by a world's q-table, for either backend.
+    """
+    if world.qtable is None:
+        return 0
+    if world.backend == "array":
+        return world.qtable.values.nbytes
+
+    # Count each object once, since keys and small numbers are shared all over the tree.
+    seen = set()
+    def size(value) -> int:
+        if id(value) in seen:
+            return 0
+        seen.add(id(value))
+        if isinstance(value, dict):
+            return sys.getsizeof(value) + sum(size(key) + size(item) for key, item in value.items())
+        return sys.getsizeof(value)
+    return size(world.qtable)
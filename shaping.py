@@ -0,0 +1,67 @@
+__author__ = "Jackson Murrell"
+
+import numpy as np
+
+from world import World, Node
+
+class PotentialShaping(object):
+    """
+        Potential-based reward shaping, from Ng, Harada and Russell's "Policy invariance under reward
+        transformations".
+
+        Attach one to an agent with agent.shaping.  Agent.move then learns from
+        reward + discount * phi(next state) - phi(state) instead of the bare reward, where phi is minus the
+        number of moves to the nearest pickup that still has packages, or when carrying, the nearest dropoff
+        with room left.  Shaping of this form leaves the optimal policy as it was, but tells the agent which
+        way the goals are long before it first stumbles onto one.  The score still counts the bare rewards.
+
+        The moves come from World.get_distances.  Potentials for a carrying status and availability mask
+        are built the first time that mask comes up, so they follow the pickups emptying and the dropoffs
+        filling, and are thrown away when the layout changes.
+    """
+    def __init__(self, world: World, scale: float=1.0):
+        """
+            scale: Potential of each move away from the nearest goal.
+        """
+        self.world = world
+        self.scale = scale
+        self.clear()
+
+    def clear(self):
+        # (carrying, availability mask) to the potential of every node.
+        self.potentials = {}
+        self._distances = None
+
+    def get_potentials(self, carrying: bool, mask: int) -> np.ndarray:
+        world = self.world
+        distances = world.get_distances()
+        if distances is not self._distances:
+            # The world built new distances, so the layout changed under us, such as on a swap.
+            self.clear()
+            self._distances = distances
+        potentials = self.potentials.get((carrying, mask))
+        if potentials is not None:
+            return potentials
+
+        goals, first = (world.dropoffs, len(world.pickups)) if carrying else (world.pickups, 0)
+        rows = [first + goal.slot for goal in goals if not (mask >> goal.slot) & 1]
+        if rows:
+            nearest = distances[rows].min(axis=0, initial=np.iinfo(distances.dtype).max,
+                                          where=distances[rows] >= 0)
+            # Cells cut off from every goal count as further away than any that aren't.
+            nearest = np.minimum(nearest, len(world.node_list)).astype(np.float64)
+            potentials = -self.scale * nearest
+        else:
+            # Nothing left to go for, which is where episodes end.  Ending states have to be worth 0,
+            # or the shaping would change which policy is optimal.
+            potentials = np.zeros(len(world.node_list))
+        self.potentials[(carrying, mask)] = potentials
+        return potentials
+
+    def potential(self, node: Node, carrying: bool) -> float:
+        return self.get_potentials(carrying, self.world.get_availability_mask(carrying))[node.index]
+
+    def shape(self, reward: float, discount: float, node: Node, carrying: bool, next_node: Node,
+              next_carrying: bool) -> float:
+        # The reward to learn from for moving from (node, carrying) to (next_node, next_carrying).
+        return reward + discount * self.potential(next_node, next_carrying) - self.potential(node, carrying)
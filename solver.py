@@ -0,0 +1,252 @@
+__author__ = "Jackson Murrell"
+
+import itertools
+
+import numpy as np
+
+from world import World, ACTIONS, INITIAL_Q_VALUE
+from agent import REWARDS, NONE, PICKUP, DROPOFF
+
+class PDModel(object):
+    """
+        The exact PD World MDP of a layout, as arrays.
+
+        The availability mask the q-table uses is not enough to predict what happens next, since
+        whether a pickup empties depends on how many packages it has left.  So the model's states are
+        every reachable (package counts, carrying) configuration, times every cell:
+        state = configuration * cells + cell.
+
+        Moves follow Agent.move: a move costs REWARDS[NONE], unless a pickup or dropoff is available
+        in the cell it reaches, in which case it earns REWARDS[PICKUP] or REWARDS[DROPOFF] and carrying
+        flips there.  The dropoff that delivers the last package ends the episode.  The configurations
+        with every package delivered can't be reached without ending it, so every move from them ends the
+        episode for nothing, which keeps their value at 0 even without discounting.
+
+        next_states, rewards: (states, 4) arrays for each move in ACTIONS order.  Moves off the grid
+                              have a next state of -1.
+        terminal: (states, 4) boolean array of the moves that end the episode.
+    """
+    def __init__(self, world: World, max_states: int=20000000):
+        """
+            max_states: Refuse layouts with more states than this, since the count grows as the product
+                        of every pickup's and dropoff's package counts.
+        """
+        if world.transitions is None:
+            world.compile()
+        self.world = world
+        self.cells = len(world.node_list)
+        packages = [pickup.starting_packages for pickup in world.pickups]
+        capacities = [dropoff.capacity for dropoff in world.dropoffs]
+        total = sum(packages)
+
+        # Every count of packages left at the pickups and held at the dropoffs, plus whether one is being
+        # carried, where no package has gone missing.
+        ranges = [range(count + 1) for count in packages + capacities]
+        configurations = np.array([counts + (carrying,)
+                                   for counts in itertools.product(*ranges)
+                                   for carrying in (0, 1)
+                                   if total - sum(counts[:len(packages)]) == sum(counts[len(packages):]) + carrying],
+                                  dtype=np.int64).reshape(-1, len(ranges) + 1)
+        if len(configurations) * self.cells > max_states:
+            raise ValueError("The layout has " + str(len(configurations) * self.cells) + " states, more than " +
+                             str(max_states))
+        self.configurations = configurations
+        self.pickup_counts = configurations[:, :len(packages)]
+        self.dropoff_counts = configurations[:, len(packages):-1]
+        self.carrying = configurations[:, -1].astype(bool)
+        self.states = len(configurations) * self.cells
+
+        # Look configurations up by their mixed radix code.
+        radix = np.cumprod([1] + [count + 1 for count in packages + capacities] + [2])
+        codes = configurations @ radix[:-1]
+        lookup = np.full(radix[-1], -1, dtype=np.int64)
+        lookup[codes] = np.arange(len(configurations))
+        pickup_radix = radix[:len(packages)]
+        dropoff_radix = radix[len(packages):-2]
+        carrying_radix = radix[-2]
+
+        # The pickup and dropoff slot of each cell, -1 if it is neither.
+        pickup_slot = np.full(self.cells, -1, dtype=np.int64)
+        dropoff_slot = np.full(self.cells, -1, dtype=np.int64)
+        for slot, pickup in enumerate(world.pickups):
+            pickup_slot[pickup.index] = slot
+        for slot, dropoff in enumerate(world.dropoffs):
+            dropoff_slot[dropoff.index] = slot
+
+        # Everything below has shape (configurations, cells, 4).
+        targets = world.transitions
+        on_grid = np.broadcast_to(targets >= 0, (len(configurations),) + targets.shape)
+        safe_targets = np.where(targets >= 0, targets, 0)
+        target_pickup = pickup_slot[safe_targets]
+        target_dropoff = dropoff_slot[safe_targets]
+        configuration = np.arange(len(configurations))[:, None, None]
+        carrying = self.carrying[:, None, None]
+
+        left = self.pickup_counts[configuration, np.maximum(target_pickup, 0)]
+        picks_up = on_grid & ~carrying & (target_pickup >= 0) & (left > 0)
+        held = self.dropoff_counts[configuration, np.maximum(target_dropoff, 0)]
+        room = np.array(capacities)[np.maximum(target_dropoff, 0)] - held if capacities else held
+        drops_off = on_grid & carrying & (target_dropoff >= 0) & (room > 0)
+
+        next_configuration = np.broadcast_to(configuration, on_grid.shape).copy()
+        picked = codes[:, None, None] - pickup_radix[np.maximum(target_pickup, 0)] + carrying_radix
+        next_configuration[picks_up] = lookup[np.broadcast_to(picked, on_grid.shape)[picks_up]]
+        if len(capacities):
+            dropped = codes[:, None, None] + dropoff_radix[np.maximum(target_dropoff, 0)] - carrying_radix
+            next_configuration[drops_off] = lookup[np.broadcast_to(dropped, on_grid.shape)[drops_off]]
+
+        self.next_states = np.where(on_grid, next_configuration * self.cells + safe_targets, -1).reshape(-1, len(ACTIONS))
+        self.rewards = np.where(picks_up, REWARDS[PICKUP],
+                                np.where(drops_off, REWARDS[DROPOFF], REWARDS[NONE])).astype(np.float64)
+        self.rewards = self.rewards.reshape(-1, len(ACTIONS))
+        delivered = self.pickup_counts.sum(axis=1)[:, None, None] == 0
+        finished = np.broadcast_to(delivered & ~carrying, on_grid.shape)
+        self.rewards[finished.reshape(-1, len(ACTIONS))] = 0.0
+        self.terminal = ((drops_off & delivered) | (on_grid & finished)).reshape(-1, len(ACTIONS))
+        self.valid = self.next_states >= 0
+
+        # The availability mask the q-table would see in each configuration.
+        bits = 1 << np.arange(max(len(packages), len(capacities), 1))
+        self.masks = np.where(self.carrying,
+                              ((self.dropoff_counts == np.array(capacities, dtype=np.int64)) * bits[:len(capacities)]).sum(axis=1),
+                              ((self.pickup_counts == 0) * bits[:len(packages)]).sum(axis=1))
+        self.start_configuration = int(lookup[np.array(packages + [0] * len(capacities) + [0]) @ radix[:-1]])
+
+    def start_state(self, node) -> int:
+        # The state at the start of an episode, with the agent at node.
+        return self.start_configuration * self.cells + node.index
+
+    def backup(self, values: np.ndarray, discount: float) -> np.ndarray:
+        # One Bellman backup: the q-value of every (state, move) given the state values.
+        future = np.where(self.terminal | ~self.valid, 0.0, values[np.maximum(self.next_states, 0)])
+        return np.where(self.valid, self.rewards + discount * future, -np.inf)
+
+    def evaluate(self, policy: np.ndarray, discount: float, tolerance: float=1e-10, strict: bool=True) -> np.ndarray:
+        """
+            The value of every state when following policy, an array of one move index per state.
+
+            A policy takes each state down a single path, so rather than sweeping until the values
+            settle, this sums the rewards along every path at once, doubling the number of moves each
+            sum covers every round.  That takes a few dozen rounds at most, whatever the discount.
+
+            Without discounting, states whose path never ends have no finite value.  They raise a
+            ValueError, or with strict=False, are given -inf.
+        """
+        states = np.arange(self.states)
+        if not self.valid[states, policy].all():
+            raise ValueError("The policy makes moves off the grid.")
+        totals = self.rewards[states, policy]
+        jumps = self.next_states[states, policy]
+        stopped = self.terminal[states, policy]
+        # Discount of the move right after the ones each sum covers.
+        scale = discount
+        covered = 1
+        largest = np.abs(self.rewards).max() if self.states else 0.0
+        while not stopped.all():
+            if discount >= 1 and covered >= self.states:
+                # A path that hasn't ended after visiting every state is going round in circles.
+                break
+            if discount < 1 and scale * largest / (1 - discount) <= tolerance:
+                break
+            totals = totals + np.where(stopped, 0.0, scale * totals[jumps])
+            stopped = stopped | stopped[jumps]
+            jumps = jumps[jumps]
+            scale *= scale
+            covered *= 2
+        if discount >= 1 and not stopped.all():
+            if strict:
+                raise ValueError("The policy never ends an episode from " + str(int((~stopped).sum())) + " states.")
+            totals = np.where(stopped, totals, -np.inf)
+        return totals
+
+def value_iteration(model: PDModel, discount: float, tolerance: float=1e-10, max_iterations: int=10000):
+    """
+        Returns the optimal (states, 4) q-values and the number of iterations it took.
+        Raises a RuntimeError if the values haven't settled after max_iterations.
+    """
+    values = np.zeros(model.states)
+    for iteration in range(1, max_iterations + 1):
+        q_values = model.backup(values, discount)
+        updated = q_values.max(axis=1)
+        if np.abs(updated - values).max() <= tolerance:
+            return q_values, iteration
+        values = updated
+    raise RuntimeError("Value iteration did not converge in " + str(max_iterations) + " iterations.")
+
+def policy_iteration(model: PDModel, discount: float, tolerance: float=1e-10, max_iterations: int=1000):
+    """
+        Returns the optimal (states, 4) q-values and the number of improvement steps it took.
+        Raises a RuntimeError if the policy is still improving after max_iterations.
+    """
+    # Start from any move that stays on the grid.  Without discounting that policy can go round in
+    # circles, which is worth -inf until an improvement steers it somewhere the episode ends.
+    policy = model.valid.argmax(axis=1)
+    for iteration in range(1, max_iterations + 1):
+        q_values = model.backup(model.evaluate(policy, discount, tolerance, strict=False), discount)
+        best = q_values.max(axis=1, keepdims=True)
+        # Only switch moves for a real improvement, so ties can't make it cycle.
+        improved = np.where(q_values[np.arange(model.states), policy] >= best[:, 0] - tolerance,
+                            policy, q_values.argmax(axis=1))
+        if np.array_equal(improved, policy):
+            return q_values, iteration
+        policy = improved
+    raise RuntimeError("Policy iteration did not converge in " + str(max_iterations) + " iterations.")
+
+def solve(world: World, discount: float, method: str="value", tolerance: float=1e-10):
+    """
+        Solve a world's layout exactly with "value" or "policy" iteration.
+        Returns the model and its optimal (states, 4) q-values.
+    """
+    model = PDModel(world)
+    if method == "value":
+        q_values, _ = value_iteration(model, discount, tolerance)
+    elif method == "policy":
+        q_values, _ = policy_iteration(model, discount, tolerance)
+    else:
+        raise ValueError("Unknown solver method: " + str(method))
+    return model, q_values
+
+def to_qtable(model: PDModel, q_values: np.ndarray) -> np.ndarray:
+    """
+        Project the model's q-values onto the q-table layout, (nodes, carrying, availability mask, 4).
+
+        Several package counts share each availability mask, so each entry is the mean over the
+        configurations that show that mask.  Masks that never come up keep INITIAL_Q_VALUE.
+    """
+    world = model.world
+    shape = (model.cells, 2, 1 << max(len(world.pickups), len(world.dropoffs)), len(ACTIONS))
+    q_values = q_values.reshape(len(model.configurations), model.cells, len(ACTIONS))
+    keys = model.carrying.astype(np.int64) * shape[2] + model.masks
+    sums = np.zeros((2 * shape[2], model.cells, len(ACTIONS)))
+    np.add.at(sums, keys, np.where(np.isfinite(q_values), q_values, 0.0))
+    counts = np.bincount(keys, minlength=2 * shape[2])[:, None, None]
+    means = np.where(counts > 0, sums / np.maximum(counts, 1), INITIAL_Q_VALUE)
+    table = means.reshape(2, shape[2], model.cells, len(ACTIONS)).transpose(2, 0, 1, 3)
+    return np.where((world.transitions >= 0)[:, None, None, :], table, -np.inf)
+
+def warm_start(world: World, discount: float, method: str="value"):
+    """
+        Replace the world's q-table with the optimal q-values of its layout.
+    """
+    model, q_values = solve(world, discount, method)
+    world.set_q_array(to_qtable(model, q_values))
+    return model, q_values
+
+def optimality_gap(world: World, start_node, discount: float, model: PDModel=None, q_values: np.ndarray=None) -> dict:
+    """
+        Compare the greedy policy of the world's current q-table with the optimal one, by their exact
+        discounted return for an episode starting at start_node.  Ties between moves go to the first
+        in ACTIONS order.  Without discounting, a greedy policy that never finishes the episode has a
+        return of -inf.
+    """
+    if model is None or q_values is None:
+        model, q_values = solve(world, discount)
+    learned = world.get_q_array()
+    configurations = np.repeat(np.arange(len(model.configurations)), model.cells)
+    cells = np.tile(np.arange(model.cells), len(model.configurations))
+    policy = learned[cells, model.carrying[configurations].astype(np.int64), model.masks[configurations]].argmax(axis=1)
+    start = model.start_state(start_node)
+    optimal = float(q_values[start].max())
+    greedy = float(model.evaluate(policy, discount, strict=False)[start])
+    return {"optimal_return": optimal, "greedy_return": greedy, "gap": optimal - greedy,
+            "policy_agreement": float((policy == q_values.argmax(axis=1)).mean())}
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+__author__ = "Jackson Murrell"
+
+import sys, argparse, csv, itertools, os, statistics
+
+from concurrent.futures import ProcessPoolExecutor
+
+from agent import POLICIES
+from driver import experiment
+
+COLUMNS = ["learning_rate", "discount_rate", "learning_method", "policies", "swap", "transfer", "shaped", "seed",
+           "terminations", "mean_steps_per_episode", "steps_per_episode", "final_score", "steps", "wall_time",
+           "converged_at", "converged_episodes", "recovery_steps"]
+
+def parse_policies(schedule: str) -> list:
+    """
+        Turn a schedule like "random:200,exploit:7800" into experiment's list of (policy, iterations).
+    """
+    policies = []
+    for part in schedule.split(","):
+        name, iterations = part.split(":")
+        if name not in POLICIES:
+            raise ValueError("Unknown policy: " + name)
+        policies.append((POLICIES[name], int(iterations)))
+    return policies
+
+def run(params: dict) -> dict:
+    """
+        Run one experiment for a grid point, and flatten its results into a table row.
+    """
+    results = experiment(params["learning_rate"], params["discount_rate"], params["learning_method"],
+                         parse_policies(params["policies"]), swap=params["swap"], backend=params["backend"],
+                         seed=params["seed"], convergence=params.get("convergence"),
+                         transfer=params.get("transfer", False), shaped=params.get("shaped", False))
+    episodes = results["steps_per_episode"]
+    row = {column: params[column] for column in COLUMNS if column in params}
+    row["terminations"] = results["terminations"]
+    row["mean_steps_per_episode"] = sum(episodes) / len(episodes) if episodes else None
+    row["steps_per_episode"] = " ".join(str(steps) for steps in episodes)
+    row["final_score"] = results["final_score"]
+    row["steps"] = results["steps"]
+    row["wall_time"] = results["wall_time"]
+    if "convergence" in results:
+        row["converged_at"] = results["convergence"]["converged_at"]
+        # The run stops once it converges, so every episode it finished came before that.
+        row["converged_episodes"] = results["terminations"] if results["convergence"]["converged"] else None
+    if "swap" in results:
+        row["recovery_steps"] = results["swap"]["recovery_steps"]
+    return row
+
+def sweep(learning_rates: list, discount_rates: list, learning_methods: list, policies: list, swaps: list,
+          seeds: list, backend: str="dict", workers: int=None, convergence: dict=None,
+          transfers: list=(False,), shapings: list=(False,)) -> list:
+    """
+        Run experiment for every combination of the given parameters and seeds, spread over a process pool.
+
+        policies: Schedules in the form parsed by parse_policies.
+        workers: Number of processes to use, defaults to every core.
+        convergence: Arguments for a convergence.ConvergenceMonitor, to stop each run once it converges.
+        transfers: Whether swapping runs transfer their q-table.  Runs without a swap never transfer.
+        shapings: Whether runs learn from shaped rewards, see shaping.PotentialShaping.
+
+        Returns one row per run, in grid order.
+    """
+    grid = [{"learning_rate": learning_rate, "discount_rate": discount_rate, "learning_method": method,
+             "policies": schedule, "swap": swap, "transfer": transfer, "shaped": shaped, "seed": seed,
+             "backend": backend, "convergence": convergence}
+            for learning_rate, discount_rate, method, schedule, swap, transfer, shaped, seed
+            in itertools.product(learning_rates, discount_rates, learning_methods, policies, swaps, transfers,
+                                 shapings, seeds)
+            if swap or not transfer]
+    # Check the schedules before starting any workers.
+    for schedule in policies:
+        parse_policies(schedule)
+
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(grid) // (workers * 4))
+        return list(executor.map(run, grid, chunksize=chunksize))
+
+def shaping_summary(rows: list) -> list:
+    """
+        Compare the median episodes to convergence with and without shaping, for every grid point that
+        was run both ways.  Runs that never converged are left out of the medians, and counted instead.
+    """
+    groups = {}
+    for row in rows:
+        key = tuple(row[column] for column in ("learning_rate", "discount_rate", "learning_method", "policies",
+                                                "swap", "transfer"))
+        groups.setdefault(key, {}).setdefault(row["shaped"], []).append(row.get("converged_episodes"))
+    summary = []
+    for key, runs in groups.items():
+        if set(runs) != {False, True}:
+            continue
+        line = dict(zip(("learning_rate", "discount_rate", "learning_method", "policies", "swap", "transfer"), key))
+        for shaped, name in ((False, "unshaped"), (True, "shaped")):
+            converged = [episodes for episodes in runs[shaped] if episodes is not None]
+            line[name + "_episodes"] = statistics.median(converged) if converged else None
+            line[name + "_unconverged"] = len(runs[shaped]) - len(converged)
+        if line["unshaped_episodes"] and line["shaped_episodes"] is not None:
+            line["reduction"] = 1 - line["shaped_episodes"] / line["unshaped_episodes"]
+        else:
+            line["reduction"] = None
+        summary.append(line)
+    return summary
+
+def write_table(rows: list, output=sys.stdout):
+    writer = csv.DictWriter(output, fieldnames=COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(rows)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Sweep experiment hyperparameters over every core.")
+    parser.add_argument("--learning-rate", type=float, nargs="+", default=[0.3])
+    parser.add_argument("--discount-rate", type=float, nargs="+", default=[0.5])
+    parser.add_argument("--method", nargs="+", default=["q_learning"],
+                        choices=["q_learning", "sarsa", "sarsa_lambda", "q_lambda"])
+    parser.add_argument("--policies", nargs="+", default=["random:200,exploit:7800"],
+                        help="Policy schedules such as random:200,exploit:7800.")
+    parser.add_argument("--swap", choices=["no", "yes", "both"], default="no",
+                        help="Swap pickups and dropoffs after the second termination.")
+    parser.add_argument("--transfer", choices=["no", "yes", "both"], default="no",
+                        help="Transfer the q-table to the swapped layout, to compare recovery_steps.")
+    parser.add_argument("--shaping", choices=["no", "yes", "both"], default="no",
+                        help="Learn from shaped rewards.  With both and --converge, also print the reduction in "
+                             "episodes to convergence to stderr.")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0])
+    parser.add_argument("--backend", choices=["dict", "array"], default="dict")
+    parser.add_argument("--converge", action="store_true", default=False,
+                        help="Stop each run early once the q-table and greedy policy stop changing.")
+    parser.add_argument("--window", type=int, default=500, help="Steps between convergence checks.")
+    parser.add_argument("--max-delta", type=float, default=None,
+                        help="Largest change from any one q-value update per window that counts as converged.")
+    parser.add_argument("--mean-delta", type=float, default=0.3,
+                        help="Largest mean change per q-value update in a window that counts as converged.")
+    parser.add_argument("--policy-change", type=float, default=0.02,
+                        help="Largest share of states whose greedy action may change per window.")
+    parser.add_argument("--patience", type=int, default=3, help="Windows in a row that have to meet the thresholds.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes, defaults to every core.")
+    parser.add_argument("-o", "--output", default=None, help="Write the table to this CSV file instead of stdout.")
+    args = parser.parse_args()
+
+    swaps = {"no": [False], "yes": [True], "both": [False, True]}[args.swap]
+    transfers = {"no": [False], "yes": [True], "both": [False, True]}[args.transfer]
+    shapings = {"no": [False], "yes": [True], "both": [False, True]}[args.shaping]
+    convergence = None
+    if args.converge:
+        convergence = {"window": args.window, "max_delta_threshold": args.max_delta,
+                       "mean_delta_threshold": args.mean_delta, "policy_threshold": args.policy_change,
+                       "patience": args.patience}
+    rows = sweep(args.learning_rate, args.discount_rate, args.method, args.policies, swaps, args.seeds,
+                 backend=args.backend, workers=args.workers, convergence=convergence, transfers=transfers, shapings=shapings)
+    if args.output:
+        with open(args.output, "w", newline="") as output:
+            write_table(rows, output)
+    else:
+        write_table(rows)
+    if args.converge and len(shapings) > 1:
+        for line in shaping_summary(rows):
+            print(line["learning_method"] + " " + line["policies"] + (" swap" if line["swap"] else "") +
+                  (" transfer" if line["transfer"] else "") + ": median episodes to convergence " +
+                  str(line["unshaped_episodes"]) + " unshaped (" + str(line["unshaped_unconverged"]) +
+                  " never converged), " + str(line["shaped_episodes"]) + " shaped (" +
+                  str(line["shaped_unconverged"]) + " never converged)" +
+                  (", " + str(round(100 * line["reduction"], 1)) + "% fewer" if line["reduction"] is not None else ""),
+                  file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+__author__ = "Jackson Murrell"
+
+from typing import Tuple
+from world import World
+from agent import Agent, RandomStream, policy_greedy, PICKUP, DROPOFF
+
+class Team(object):
+    """
+        Several agents acting in the same World each tick, sharing its packages and its q-table.
+
+        Agents move one at a time in priority order, and the order rotates by one every tick so no agent
+        always goes first.  An agent plans its pickup or dropoff a step ahead, so by its turn an agent
+        with higher priority may have taken the last package, or filled the last slot.  The agent that
+        moves first keeps it, and the other plans a new move from where it stands, keeping the reward it
+        was given for moving in.  With the same seed, a run always resolves its conflicts the same way.
+
+        An episode ends when every pickup is empty and no agent is still carrying a package.
+    """
+    def __init__(self, world: World, start_coords: list, method, learning_rate: float=0.5,
+                 discount_rate: float=0.5, policy=policy_greedy, rng=None, trace_decay: float=0.9,
+                 seed=None):
+        """
+            start_coords: Where each agent starts, one per agent.
+            rng: Source of randomness shared by every agent, so their draws interleave in move order.
+                 Defaults to a RandomStream of seed.
+        """
+        self.world = world
+        rng = rng if rng is not None else RandomStream(seed)
+        self.agents = [Agent(world, coords, method, learning_rate, discount_rate, policy=policy, rng=rng,
+                             trace_decay=trace_decay)
+                       for coords in start_coords]
+        self.ticks = 0
+        # How many planned pickups and dropoffs were lost to an agent with higher priority.
+        self.conflicts = 0
+
+    @property
+    def policy(self):
+        return self.agents[0].policy
+
+    @policy.setter
+    def policy(self, policy):
+        for agent in self.agents:
+            agent.policy = policy
+
+    @property
+    def score(self) -> int:
+        return sum(agent.score for agent in self.agents)
+
+    def move(self) -> Tuple[bool, list]:
+        """
+            Move every agent once.
+
+            Returns whether the episode ended, and each agent's reward.  Once the episode ends, the
+            agents after that one in this tick's order don't move, and get a reward of 0.
+        """
+        rewards = [0] * len(self.agents)
+        terminated = False
+        for turn in range(len(self.agents)):
+            number = (self.ticks + turn) % len(self.agents)
+            agent = self.agents[number]
+            self._resolve(agent)
+            _, rewards[number] = agent.move()
+            # Agent.move only knows that the pickups are empty, not whether anyone is still carrying.
+            if self.check_termination():
+                terminated = True
+                break
+        self.ticks += 1
+        return (terminated, rewards)
+
+    def _resolve(self, agent: Agent):
+        action, _ = agent.next_move
+        if action not in (PICKUP, DROPOFF):
+            return
+        if action in self.world.get_valid_actions(agent.current_node, agent.carrying):
+            return
+        # Someone else got there first, so plan again from here.
+        self.conflicts += 1
+        agent.future_move = None
+        agent.next_move = agent.policy(agent.current_node, agent.carrying,
+                                       self.world.get_q_node_table(agent.current_node, agent.carrying), agent.rng)
+
+    def check_termination(self) -> bool:
+        return self.world.check_termination() and not any(agent.carrying for agent in self.agents)
+
+    def reset(self, policy=None):
+        # Packages still being carried go back to the pickups with the rest.
+        for agent in self.agents:
+            agent.carrying = False
+        for agent in self.agents:
+            agent.reset(policy)
+
+    def swap_pickup_dropoff(self, transfer: bool=False):
+        self.world.swap_pickup_dropoff()
+        if transfer:
+            self.world.transfer_q_table()
+        for agent in self.agents:
+            agent.layout_changed()
@@ -0,0 +1,70 @@
+__author__ = "Jackson Murrell"
+
+import numpy as np
+
+from typing import Tuple
+from world import World
+from compact import CompactWorld
+from agent import Agent, RandomStream, policy_greedy
+
+class WorldTemplate(object):
+    """
+        A PD World layout, built once, that stamps out fresh worlds and agents.
+
+        Building a World adds its nodes one at a time and compiles its tables.  A template does that
+        once, and world() clones the result with World.clone, which only copies the per-node state and
+        shares the compiled tables, so a fresh 5x5 world takes microseconds.  The template's own world
+        is never handed out, so it always stays as it was built.
+    """
+    def __init__(self, size: Tuple[int, int], pickup: list, dropoff: list, package_count: int=3, offset: int=1,
+                 backend: str="dict", compact: bool=False, dtype=np.float64):
+        """
+            size: A tuple containing rows and columns.
+            pickup, dropoff: Coordinates of the pickups and dropoffs.
+            package_count: Packages split evenly between the pickups.  Each dropoff holds the same share.
+            backend : The q-table backend to use, "dict" or "array".
+            compact : True to store the grid in arrays with a CompactWorld, for very large sizes.
+            dtype : Type of a CompactWorld's q-values.  float32 halves the q-table.
+        """
+        self.size = size
+        self.offset = offset
+        rows, columns = size
+        distribution = int(package_count / len(pickup))
+        if compact:
+            world = CompactWorld(size, offset, pickup, dropoff, packages=distribution, capacity=distribution,
+                                 backend=backend, dtype=dtype)
+        else:
+            world = World(size, offset, backend=backend)
+            # Offset the coordinates by a certain amount so we get better looking values.
+            for row in range(offset, rows+offset):
+                for column in range(offset, columns+offset):
+                    state = "None"
+                    coords = (row, column)
+                    packages = capacity = 0
+                    if coords in pickup:
+                        state = "Pickup"
+                        packages = distribution
+                    if coords in dropoff:
+                        state = "Dropoff"
+                        capacity = distribution
+                    world.add_node(coords, state, packages=packages, capacity=capacity)
+        world.compile()
+        self._world = world
+
+    def world(self) -> World:
+        # A fresh world in the starting state, with an empty q-table.
+        return self._world.clone()
+
+    def agent(self, method, start=None, learning_rate: float=0.5, discount_rate: float=0.5,
+              policy=policy_greedy, rng=None, seed=None, trace_decay: float=0.9) -> Agent:
+        """
+            A fresh agent on a fresh world.
+            start: Coordinates the agent starts at, drawn from rng if None.
+            rng: Source of randomness for the agent's policies.  Defaults to a RandomStream of seed.
+        """
+        rng = rng if rng is not None else RandomStream(seed)
+        if start is None:
+            rows, columns = self.size
+            start = (self.offset + int(rng.random() * rows), self.offset + int(rng.random() * columns))
+        return Agent(self.world(), start, method, learning_rate, discount_rate, policy=policy, rng=rng,
+                     trace_decay=trace_decay)
@@ -0,0 +1,363 @@
+__author__ = "Jackson Murrell"
+
+import json
+import os
+import struct
+
+import numpy as np
+
+from world import World, ALL_ACTIONS
+
+# File layout: MAGIC, a little-endian uint16 version and uint32 header length, and the JSON header.
+# After that come any number of chunks, each CHUNK, a uint32 row count, and then every column's raw
+# little-endian values for those rows, one column after another in COLUMNS order.
+MAGIC = b"PDTJ"
+VERSION = 1
+PREFIX = struct.Struct("<4sHI")
+CHUNK = struct.Struct("<4sI")
+CHUNK_MAGIC = b"CHNK"
+# Q-table history files are the same prefix with HISTORY_MAGIC and a JSON header, followed by fixed-size
+# records of a uint64 step count and the q-table array at that step.
+HISTORY_MAGIC = b"PDQH"
+
+# One row per Agent.move.
+# node, next_node: Node index the move started from and ended on.
+# action: Index of the action taken in ALL_ACTIONS.
+# reward: Reward the move was given.
+# carrying: Whether the agent is carrying after the action.
+# mask: The world's availability mask for that carrying status, after the action.
+# flags: TERMINATED if the move ended the episode, SWAPPED while pickups and dropoffs are swapped.
+COLUMNS = (("node", "<i4"),
+           ("next_node", "<i4"),
+           ("action", "<i1"),
+           ("reward", "<f4"),
+           ("carrying", "|b1"),
+           ("mask", "<u4"),
+           ("flags", "|u1"))
+TERMINATED = 1
+SWAPPED = 2
+ACTION_CODES = {action: index for index, action in enumerate(ALL_ACTIONS)}
+
+class TrajectoryRecorder(object):
+    """
+        Logs every move of an agent to an append-only columnar file.
+
+        Set agent.recorder to one to turn it on.  Moves are kept in a fixed-size buffer of NumPy columns,
+        and written out as one chunk whenever it fills, so memory stays the same however long the run
+        is.  Call flush() to write the moves so far as a chunk, such as alongside a checkpoint, and
+        close(), or use it as a context manager, to write the last partial chunk.
+    """
+    def __init__(self, path: str, world: World, method=None, buffer_size: int=65536, append: bool=False,
+                 qtable_every: int=0):
+        """
+            method: The learning method being recorded, stored for reference.
+            buffer_size: Moves to hold before writing a chunk.
+            append: Add to an existing trajectory file of the same layout instead of starting over.
+            qtable_every: If above 0, also save the q-table to history_path(path) every this many moves,
+                          for playback.
+        """
+        self.path = path
+        self.buffer_size = buffer_size
+        self.count = 0
+        self.steps = 0
+        self.buffers = tuple(np.zeros(buffer_size, dtype=dtype) for _, dtype in COLUMNS)
+        (self.nodes, self.next_nodes, self.actions, self.rewards, self.carrying, self.masks,
+         self.flags) = self.buffers
+
+        header = {"columns": [list(column) for column in COLUMNS],
+                  "actions": list(ALL_ACTIONS),
+                  "size": [world.rows, world.columns],
+                  "offset": world.offset,
+                  "pickups": [list(pickup.coords) for pickup in world.pickups],
+                  "dropoffs": [list(dropoff.coords) for dropoff in world.dropoffs],
+                  "packages": [pickup.starting_packages for pickup in world.pickups],
+                  "capacities": [dropoff.capacity for dropoff in world.dropoffs],
+                  "method": method}
+        append = append and os.path.exists(path)
+        if append:
+            existing = read_header(path)
+            for key in ("columns", "size", "offset", "pickups", "dropoffs"):
+                if existing[key] != header[key]:
+                    raise ValueError("Trajectory " + key + " " + str(existing[key]) + " does not match " +
+                                     str(header[key]))
+            self.steps = TrajectoryReader(path).length
+            self.output = open(path, "ab")
+        else:
+            self.output = open(path, "wb")
+            header_bytes = json.dumps(header).encode("utf-8")
+            self.output.write(PREFIX.pack(MAGIC, VERSION, len(header_bytes)))
+            self.output.write(header_bytes)
+            # So the file is readable even if the run is killed before the first chunk.
+            self.output.flush()
+        self.history = QTableHistory(history_path(path), world, qtable_every, append) if qtable_every else None
+        if self.history and not append:
+            self.history.snapshot(0)
+
+    def record(self, node, action: str, reward: float, carrying: bool, next_node, mask: int, terminated: bool,
+               swapped: bool):
+        i = self.count
+        self.nodes[i] = node.index
+        self.next_nodes[i] = next_node.index
+        self.actions[i] = ACTION_CODES[action]
+        self.rewards[i] = reward
+        self.carrying[i] = carrying
+        self.masks[i] = mask
+        self.flags[i] = (TERMINATED if terminated else 0) | (SWAPPED if swapped else 0)
+        self.count = i + 1
+        self.steps += 1
+        if self.count == self.buffer_size:
+            self.flush()
+        if self.history and self.steps % self.history.every == 0:
+            self.history.snapshot(self.steps)
+
+    def flush(self):
+        # Write out the buffered moves, so the file and its q-table history hold every move so far.
+        if self.history:
+            self.history.flush()
+        if not self.count:
+            return
+        self.output.write(CHUNK.pack(CHUNK_MAGIC, self.count))
+        for buffer in self.buffers:
+            self.output.write(buffer[:self.count].tobytes())
+        self.output.flush()
+        self.count = 0
+
+    def close(self):
+        if self.output.closed:
+            return
+        self.flush()
+        self.output.close()
+        if self.history:
+            self.history.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_header(path: str) -> dict:
+    """
+        Read just the header of a trajectory file.  The byte offset of the first chunk is in "data_offset".
+    """
+    with open(path, "rb") as source:
+        magic, version, length = PREFIX.unpack(source.read(PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError(path + " is not a trajectory file.")
+        if version != VERSION:
+            raise ValueError(path + " has unsupported trajectory file version " + str(version))
+        header = json.loads(source.read(length).decode("utf-8"))
+    header["data_offset"] = PREFIX.size + length
+    return header
+
+def iter_chunks(path: str):
+    """
+        Yield each chunk of a trajectory file in turn, as a dict of column name to array.
+        A chunk cut short at the end of the file, such as by a crash mid-write, is skipped.
+    """
+    header = read_header(path)
+    columns = [(name, np.dtype(dtype)) for name, dtype in header["columns"]]
+    row_size = sum(dtype.itemsize for _, dtype in columns)
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as source:
+        source.seek(header["data_offset"])
+        while source.tell() + CHUNK.size <= file_size:
+            magic, rows = CHUNK.unpack(source.read(CHUNK.size))
+            if magic != CHUNK_MAGIC:
+                raise ValueError(path + " has a corrupt chunk at byte " + str(source.tell() - CHUNK.size))
+            if source.tell() + rows * row_size > file_size:
+                return
+            yield {name: np.frombuffer(source.read(rows * dtype.itemsize), dtype=dtype) for name, dtype in columns}
+
+def iter_episodes(path: str):
+    """
+        Yield the moves of each episode in turn, as a dict of column name to array, reading only as many
+        chunks as it takes.  The last episode is yielded even if the run stopped before it terminated.
+    """
+    pieces = []
+    for chunk in iter_chunks(path):
+        ends = np.flatnonzero(chunk["flags"] & TERMINATED) + 1
+        start = 0
+        for end in ends:
+            pieces.append({name: column[start:end] for name, column in chunk.items()})
+            yield _join(pieces)
+            pieces = []
+            start = end
+        if start < len(chunk["flags"]):
+            pieces.append({name: column[start:] for name, column in chunk.items()})
+    if pieces:
+        yield _join(pieces)
+
+def _join(pieces: list) -> dict:
+    if len(pieces) == 1:
+        return pieces[0]
+    return {name: np.concatenate([piece[name] for piece in pieces]) for name in pieces[0]}
+
+class TrajectoryReader(object):
+    """
+        Reads any range of moves from a trajectory file without loading the rest of it.
+
+        Opening one only walks the chunk headers, to index where each chunk's columns sit in the file.
+        The file is memory-mapped, so reads only touch the pages of the moves asked for, and memory stays
+        the same however long the run was.  A chunk cut short at the end of the file is left out.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.header = read_header(path)
+        self.columns = [(name, np.dtype(dtype)) for name, dtype in self.header["columns"]]
+        row_size = sum(dtype.itemsize for _, dtype in self.columns)
+        file_size = os.path.getsize(path)
+        # Byte offset of each chunk's first column, and its row count.
+        offsets = []
+        rows = []
+        with open(path, "rb") as source:
+            position = self.header["data_offset"]
+            while position + CHUNK.size <= file_size:
+                source.seek(position)
+                magic, count = CHUNK.unpack(source.read(CHUNK.size))
+                if magic != CHUNK_MAGIC:
+                    raise ValueError(path + " has a corrupt chunk at byte " + str(position))
+                if position + CHUNK.size + count * row_size > file_size:
+                    break
+                offsets.append(position + CHUNK.size)
+                rows.append(count)
+                position += CHUNK.size + count * row_size
+        self.chunk_offsets = np.array(offsets, dtype=np.int64)
+        # Move each chunk starts at, followed by the total number of moves.
+        self.chunk_starts = np.concatenate(([0], np.cumsum(rows, dtype=np.int64)))
+        # Byte offset where the moves before each chunk start end, and where the last chunk ends.
+        self.chunk_ends = np.append(self.chunk_offsets - CHUNK.size, position).astype(np.int64)
+        self.length = int(self.chunk_starts[-1])
+        self.data = None
+
+    def _chunk(self, chunk: int, first: int, last: int) -> dict:
+        # Views of rows [first, last) of one chunk's columns.
+        if self.data is None:
+            self.data = np.memmap(self.path, dtype=np.uint8, mode="r")
+        offset = int(self.chunk_offsets[chunk])
+        rows = int(self.chunk_starts[chunk + 1] - self.chunk_starts[chunk])
+        columns = {}
+        for name, dtype in self.columns:
+            columns[name] = self.data[offset + first * dtype.itemsize:offset + last * dtype.itemsize].view(dtype)
+            offset += rows * dtype.itemsize
+        return columns
+
+    def iter_range(self, first: int, last: int):
+        """
+            Yield the moves in [first, last) as dicts of column name to array, one for each chunk they
+            span.  The arrays are read-only views of the file.
+        """
+        first = max(first, 0)
+        last = min(last, self.length)
+        chunk = int(np.searchsorted(self.chunk_starts, first, side="right")) - 1
+        while first < last:
+            start = int(self.chunk_starts[chunk])
+            end = min(last, int(self.chunk_starts[chunk + 1]))
+            yield self._chunk(chunk, first - start, end - start)
+            first = end
+            chunk += 1
+
+    def read(self, first: int, last: int) -> dict:
+        # The moves in [first, last) as one array per column.
+        pieces = list(self.iter_range(first, last))
+        if not pieces:
+            return {name: np.zeros(0, dtype=dtype) for name, dtype in self.columns}
+        return _join(pieces)
+
+def truncate(path: str, rows: int, snapshots: int=None):
+    """
+        Cut a trajectory back to its first rows moves, and its q-table history to its first snapshots
+        snapshots, such as to resume from a checkpoint taken at that point.  rows has to fall between
+        two chunks, as counts taken right after TrajectoryRecorder.flush do.
+    """
+    reader = TrajectoryReader(path)
+    chunk = int(np.searchsorted(reader.chunk_starts, rows))
+    if chunk >= len(reader.chunk_starts) or reader.chunk_starts[chunk] != rows:
+        raise ValueError(path + " has no chunk boundary at move " + str(rows))
+    size = int(reader.chunk_ends[chunk])
+    with open(path, "r+b") as output:
+        output.truncate(size)
+    qtable_path = history_path(path)
+    if snapshots is not None and os.path.exists(qtable_path):
+        header = read_history_header(qtable_path)
+        record_size = 8 + 8 * int(np.prod(header["shape"]))
+        with open(qtable_path, "r+b") as output:
+            output.truncate(header["data_offset"] + snapshots * record_size)
+
+def load_trajectory(path: str):
+    """
+        Read a whole trajectory file into memory.  Returns the header, and a dict of column name to array.
+        Use a TrajectoryReader for files too large to hold in memory.
+    """
+    header = read_header(path)
+    chunks = list(iter_chunks(path))
+    if not chunks:
+        return header, {name: np.zeros(0, dtype=dtype) for name, dtype in header["columns"]}
+    return header, _join(chunks)
+
+def history_path(path: str) -> str:
+    # Where a trajectory's q-table history is kept.
+    return path + ".qhist"
+
+class QTableHistory(object):
+    """
+        Appends snapshots of a world's q-table to a file, every so many moves.
+    """
+    def __init__(self, path: str, world: World, every: int=1000, append: bool=False):
+        self.path = path
+        self.world = world
+        self.every = every
+        values = world.get_q_array()
+        header = {"shape": list(values.shape), "dtype": "<f8",
+                  "layout": ["node", "carrying", "availability_mask", "action"]}
+        # Snapshots in the file.
+        self.count = 0
+        if append and os.path.exists(path):
+            existing = read_history_header(path)
+            if existing["shape"] != header["shape"]:
+                raise ValueError("Q-table history " + path + " does not match this world.")
+            record_size = 8 + values.size * 8
+            self.count = (os.path.getsize(path) - existing["data_offset"]) // record_size
+            self.output = open(path, "ab")
+            return
+        self.output = open(path, "wb")
+        header_bytes = json.dumps(header).encode("utf-8")
+        self.output.write(PREFIX.pack(HISTORY_MAGIC, VERSION, len(header_bytes)))
+        self.output.write(header_bytes)
+        self.output.flush()
+
+    def snapshot(self, step: int):
+        self.output.write(struct.pack("<Q", step))
+        self.output.write(np.ascontiguousarray(self.world.get_q_array(), dtype="<f8").tobytes())
+        self.output.flush()
+        self.count += 1
+
+    def flush(self):
+        self.output.flush()
+
+    def close(self):
+        self.output.close()
+
+def read_history_header(path: str) -> dict:
+    with open(path, "rb") as source:
+        magic, version, length = PREFIX.unpack(source.read(PREFIX.size))
+        if magic != HISTORY_MAGIC:
+            raise ValueError(path + " is not a q-table history file.")
+        if version != VERSION:
+            raise ValueError(path + " has unsupported q-table history version " + str(version))
+        header = json.loads(source.read(length).decode("utf-8"))
+    header["data_offset"] = PREFIX.size + length
+    return header
+
+def load_qtable_history(path: str):
+    """
+        Memory-map a q-table history.  Returns the step of each snapshot, and a (snapshots, ...) array
+        of the q-tables, which is only read as snapshots are used.
+    """
+    header = read_history_header(path)
+    record = np.dtype([("step", "<u8"), ("values", header["dtype"], tuple(header["shape"]))])
+    count = (os.path.getsize(path) - header["data_offset"]) // record.itemsize
+    if not count:
+        return np.zeros(0, dtype=np.uint64), np.zeros((0,) + tuple(header["shape"]))
+    records = np.memmap(path, dtype=record, mode="r", offset=header["data_offset"], shape=(count,))
+    return np.array(records["step"]), records["values"]
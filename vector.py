@@ -0,0 +1,248 @@
+__author__ = "Jackson Murrell"
+
+import numpy as np
+
+from typing import Tuple
+from world import World, ACTIONS, PICKUP_INDEX, DROPOFF_INDEX, INITIAL_Q_VALUE
+from agent import (q_learning, sarsa, policy_random, policy_greedy, policy_exploit,
+                   REWARDS, NONE, PICKUP, DROPOFF, INITIAL_SCORE)
+
+# How many random numbers to pre-generate per environment at a time.
+RANDOM_BLOCK = 1024
+
+class VectorWorld(object):
+    """
+        The package state of N copies of a World, stored as arrays with one row per environment.
+
+        The layout (nodes, transitions and valid actions) is shared with the template world, which is
+        never modified.  Swapping pickups and dropoffs is not supported.
+    """
+    def __init__(self, world: World, count: int):
+        world.compile()
+        self.template = world
+        self.count = count
+        self.transitions = world.transitions
+        self.action_masks = world.get_action_masks()
+        self.pickup_nodes = np.array([pickup.index for pickup in world.pickups], dtype=np.int64)
+        self.dropoff_nodes = np.array([dropoff.index for dropoff in world.dropoffs], dtype=np.int64)
+        self.starting_packages = np.array([pickup.starting_packages for pickup in world.pickups], dtype=np.int64)
+        self.capacities = np.array([dropoff.capacity for dropoff in world.dropoffs], dtype=np.int64)
+        # Map a node index to its bit in the availability masks.
+        self.slots = np.full(len(world.node_list), -1, dtype=np.int64)
+        self.slots[self.pickup_nodes] = np.arange(len(self.pickup_nodes))
+        self.slots[self.dropoff_nodes] = np.arange(len(self.dropoff_nodes))
+
+        self.pickup_packages = np.zeros((count, len(self.pickup_nodes)), dtype=np.int64)
+        self.dropoff_packages = np.zeros((count, len(self.dropoff_nodes)), dtype=np.int64)
+        self.empty_pickups = np.zeros(count, dtype=np.int64)
+        self.full_dropoffs = np.zeros(count, dtype=np.int64)
+        self.remaining_packages = np.zeros(count, dtype=np.int64)
+        self.reset()
+
+    def reset(self, envs=None):
+        """
+            envs: Indices of the environments to reset, or None for all of them.
+        """
+        envs = np.arange(self.count) if envs is None else envs
+        self.pickup_packages[envs] = self.starting_packages
+        self.dropoff_packages[envs] = 0
+        self.remaining_packages[envs] = self.starting_packages.sum()
+        bits = 1 << np.arange(max(len(self.pickup_nodes), len(self.dropoff_nodes)), dtype=np.int64)
+        self.empty_pickups[envs] = bits[:len(self.pickup_nodes)][self.starting_packages == 0].sum()
+        self.full_dropoffs[envs] = bits[:len(self.dropoff_nodes)][self.capacities == 0].sum()
+
+    def get_availability_mask(self, envs, carrying) -> np.ndarray:
+        return np.where(carrying, self.full_dropoffs[envs], self.empty_pickups[envs])
+
+    def pickup(self, envs, nodes):
+        slots = self.slots[nodes]
+        self.pickup_packages[envs, slots] -= 1
+        self.remaining_packages[envs] -= 1
+        empty = self.pickup_packages[envs, slots] == 0
+        self.empty_pickups[envs[empty]] |= 1 << slots[empty]
+
+    def dropoff(self, envs, nodes):
+        slots = self.slots[nodes]
+        self.dropoff_packages[envs, slots] += 1
+        full = self.dropoff_packages[envs, slots] == self.capacities[slots]
+        self.full_dropoffs[envs[full]] |= 1 << slots[full]
+
+    def check_termination(self, envs) -> np.ndarray:
+        return self.remaining_packages[envs] == 0
+
+class VectorAgent(object):
+    """
+        N independent agents, each on its own copy of a World, stepped together by move().
+
+        Environment i makes exactly the same moves and q-updates as a scalar Agent built on the same
+        world with rng=agent.RandomStream(seeds[i]), and is reset automatically when it terminates.
+    """
+    def __init__(self, world: World, count: int, start_coords: Tuple[int, int], method,
+                 learning_rate: float=0.5, discount_rate: float=0.5, carrying: bool=False,
+                 policy=policy_greedy, seeds=None):
+        """
+            world: The template world, its layout is shared by every environment.
+            seeds: One seed per environment, defaults to range(count).
+        """
+        if method not in ("q_learning", "sarsa"):
+            raise ValueError("Unknown learning method: " + str(method))
+        self.world = VectorWorld(world, count)
+        self.count = count
+        self.envs = np.arange(count)
+        self.start_index = world.nodes[start_coords].index
+        self.method = method
+        self.learning = learning_rate
+        self.discount = discount_rate
+        self.policy = policy
+
+        mask_bits = max(len(world.pickups), len(world.dropoffs))
+        # Moves off the grid are -inf, the same as ArrayQTable.
+        valid_moves = (self.world.transitions >= 0)[:, None, None, :]
+        self.qtable = np.empty((count, len(world.node_list), 2, 1 << mask_bits, len(ACTIONS)))
+        self.qtable[:] = np.where(valid_moves, INITIAL_Q_VALUE, -np.inf)
+
+        seeds = range(count) if seeds is None else seeds
+        self.rngs = [np.random.default_rng(seed) for seed in seeds]
+        self._random = np.zeros((count, RANDOM_BLOCK))
+        self._random_index = np.full(count, RANDOM_BLOCK, dtype=np.int64)
+
+        self.positions = np.full(count, self.start_index, dtype=np.int64)
+        self.carrying = np.full(count, carrying, dtype=bool)
+        self.scores = np.full(count, INITIAL_SCORE, dtype=np.int64)
+        self.terminations = np.zeros(count, dtype=np.int64)
+        self.next_action, self.next_carrying = self._policy(self.envs, self.positions, self.carrying)
+
+    def _draw(self, envs) -> np.ndarray:
+        # The next random number of each environment's stream, refilled a block at a time.
+        empty = envs[self._random_index[envs] >= RANDOM_BLOCK]
+        for env in empty:
+            self._random[env] = self.rngs[env].random(RANDOM_BLOCK)
+            self._random_index[env] = 0
+        values = self._random[envs, self._random_index[envs]]
+        self._random_index[envs] += 1
+        return values
+
+    def _choose(self, envs, candidates) -> np.ndarray:
+        # Pick uniformly among the True columns of candidates, only drawing when there is a choice.
+        counts = candidates.sum(1)
+        picks = np.zeros(len(envs), dtype=np.int64)
+        choice = counts > 1
+        if choice.any():
+            picks[choice] = (self._draw(envs[choice]) * counts[choice]).astype(np.int64)
+        return np.argmax(np.cumsum(candidates, 1) > picks[:, None], 1)
+
+    def _random_moves(self, envs, moves) -> np.ndarray:
+        # policy_random draws even when only one move is valid.
+        counts = moves.sum(1)
+        picks = (self._draw(envs) * counts).astype(np.int64)
+        return np.argmax(np.cumsum(moves, 1) > picks[:, None], 1)
+
+    def _greedy_moves(self, envs, moves, q_values) -> np.ndarray:
+        best = q_values.max(1)
+        return self._choose(envs, moves & (q_values == best[:, None]))
+
+    def _policy(self, envs, nodes, carrying) -> Tuple[np.ndarray, np.ndarray]:
+        """
+            Batched version of self.policy for the given environments, standing on nodes.
+            Returns the index of the action to take in ALL_ACTIONS, and the carrying flag after it.
+        """
+        masks = self.world.get_availability_mask(envs, carrying)
+        valid = self.world.action_masks[nodes, carrying.astype(np.int64), masks]
+        actions = np.zeros(len(envs), dtype=np.int64)
+        next_carrying = carrying.copy()
+
+        if self.policy is policy_exploit:
+            # The exploit roll happens before the pickup/dropoff check in policy_exploit.
+            explore = self._draw(envs) >= 0.8
+        elif self.policy is policy_random:
+            explore = np.ones(len(envs), dtype=bool)
+        elif self.policy is policy_greedy:
+            explore = np.zeros(len(envs), dtype=bool)
+        else:
+            raise ValueError("VectorAgent only supports policy_random, policy_greedy and policy_exploit.")
+
+        pickup = valid[:, PICKUP_INDEX]
+        dropoff = valid[:, DROPOFF_INDEX] & ~pickup
+        actions[pickup] = PICKUP_INDEX
+        next_carrying[pickup] = True
+        actions[dropoff] = DROPOFF_INDEX
+        next_carrying[dropoff] = False
+
+        moving = ~(pickup | dropoff)
+        random_envs = moving & explore
+        greedy_envs = moving & ~explore
+        moves = valid[:, :len(ACTIONS)]
+        if random_envs.any():
+            actions[random_envs] = self._random_moves(envs[random_envs], moves[random_envs])
+        if greedy_envs.any():
+            q_values = self.qtable[envs[greedy_envs], nodes[greedy_envs],
+                                   carrying[greedy_envs].astype(np.int64), masks[greedy_envs]]
+            actions[greedy_envs] = self._greedy_moves(envs[greedy_envs], moves[greedy_envs], q_values)
+        return actions, next_carrying
+
+    def move(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+            Step every environment once.  Returns arrays of the terminated flags and rewards.
+        """
+        envs = self.envs
+        current_action = self.next_action
+        self.carrying = self.next_carrying
+        is_move = current_action < len(ACTIONS)
+        next_nodes = self.positions.copy()
+        next_nodes[is_move] = self.world.transitions[self.positions[is_move], current_action[is_move]]
+
+        self.next_action, self.next_carrying = self._policy(envs, next_nodes, self.carrying)
+        rewards = np.select([self.next_action == PICKUP_INDEX, self.next_action == DROPOFF_INDEX],
+                            [REWARDS[PICKUP], REWARDS[DROPOFF]], REWARDS[NONE])
+
+        terminated = np.zeros(self.count, dtype=bool)
+        dropping = envs[current_action == DROPOFF_INDEX]
+        if len(dropping):
+            self.world.dropoff(dropping, self.positions[dropping])
+            terminated[dropping] = self.world.check_termination(dropping)
+        picking = envs[current_action == PICKUP_INDEX]
+        if len(picking):
+            self.world.pickup(picking, self.positions[picking])
+
+        moving = envs[is_move]
+        if len(moving):
+            nodes = self.positions[moving]
+            carrying = self.carrying[moving]
+            carrying_index = carrying.astype(np.int64)
+            masks = self.world.get_availability_mask(moving, carrying)
+            actions = current_action[moving]
+            current_q = self.qtable[moving, nodes, carrying_index, masks, actions]
+            if self.method == "sarsa":
+                future_carrying = self.next_carrying[moving]
+                future_nodes = next_nodes[moving]
+                future_action, _ = self._policy(moving, future_nodes, future_carrying)
+                future_masks = self.world.get_availability_mask(moving, future_carrying)
+                next_q = self.qtable[moving, future_nodes, future_carrying.astype(np.int64), future_masks,
+                                     future_action]
+                new_q_val = sarsa(rewards[moving], self.learning, self.discount, current_q, next_q)
+            else:
+                max_q = self.qtable[moving, nodes, carrying_index, masks].max(1)
+                new_q_val = q_learning(rewards[moving], self.learning, self.discount, current_q, max_q)
+            self.qtable[moving, nodes, carrying_index, masks, actions] = new_q_val
+
+        self.scores += rewards
+        self.positions = next_nodes
+
+        done = envs[terminated]
+        if len(done):
+            self.terminations[done] += 1
+            self.reset(done)
+        return terminated, rewards
+
+    def reset(self, envs=None, policy=None):
+        """
+            Send the given environments (all of them by default) back to the start, keeping their q-tables.
+        """
+        envs = self.envs if envs is None else envs
+        self.policy = policy if policy else self.policy
+        self.positions[envs] = self.start_index
+        self.scores[envs] = INITIAL_SCORE
+        self.world.reset(envs)
+        actions, carrying = self._policy(envs, self.positions[envs], self.carrying[envs])
+        self.next_action[envs] = actions
+        self.next_carrying[envs] = carrying
@@ -3,16 +3,39 @@ __email__ = "kimehta@uh.edu"
 
 import pygame
 import os
-import random
+import time
+from collections import OrderedDict, deque
 import numpy as np
 import agent
-from typing import Tuple
-from world import World
+from driver import EXPERIMENTS, get_world_agent
+from convergence import ConvergenceMonitor
+from playback import Playback
+from world import ACTIONS, ACTION_INDEX
 from agent import policy_exploit
 from agent import policy_random
 from agent import policy_greedy
 
 RESOLUTION = (1280, 800)
+# Frames drawn per second, however many steps run in between.
+TARGET_FPS = 30
+# Seconds to keep the final state on screen after an experiment finishes.
+FINISHED_LINGER = 30
+# Seconds a playback at full speed takes, however long the recording.
+PLAYBACK_SECONDS = 10
+# Most rendered strings to keep around, least recently used are dropped first.
+GLYPH_CACHE_SIZE = 2048
+# Most recent terminations listed under the grid; that's as many as fit across the screen.
+RECENT_TERMINATIONS = 24
+# Largest width and height of the q-table, in pixels.
+Q_TABLE_VIEWPORT = 500
+# Smallest q-table cell, in pixels, that still gets its q-values written on it.
+LABEL_MIN_CELL = 60
+# Smallest q-table cell, in pixels, that is split into a triangle per move.
+HEATMAP_MIN_CELL = 4
+# Color of the pickups or dropoffs the agent can still use, in the q-table.
+GOAL_COLOR = (0, 175, 0)
+# Keys 1-5 start the matching pre-defined experiment.
+EXPERIMENT_KEYS = {pygame.K_1: 1, pygame.K_2: 2, pygame.K_3: 3, pygame.K_4: 4, pygame.K_5: 5}
 
 # pygame borrowed from https://nerdparadise.com/programming/pygame
 _image_library = {}
@@ -31,7 +54,13 @@ def text_objects(text, font):
     return textSurface, textSurface.get_rect()
 
 class visualize_experiment:
-    def __init__(self,learning_rate = 0.3, discount_rate = 0.5, learning_method = "q_learning", policies = [(agent.policy_random, 200), (agent.policy_exploit, 7800)], swap=False):
+    def __init__(self,learning_rate = 0.3, discount_rate = 0.5, learning_method = "q_learning", policies = [(agent.policy_random, 200), (agent.policy_exploit, 7800)], swap=False, convergence=None, playback=None, qtable_history=None):
+        """
+            convergence: Arguments for a convergence.ConvergenceMonitor, to end each experiment early
+                         once its q-table converges.
+            playback: A trajectory file recorded by a headless run, to replay instead of running live.
+            qtable_history: The q-table history to show with playback, defaults to the one saved with it.
+        """
         pygame.init()
 
         self.screen = pygame.display.set_mode(RESOLUTION)
@@ -41,48 +70,28 @@ class visualize_experiment:
         self.bigFont = pygame.font.SysFont('Arial', 30, bold=True)
         self.hugeFont = pygame.font.SysFont('Arial', 80, bold=True)
 
-        self.run_speed_knob = (1, 10, 50, 100, 500, 1000)
-        self.run_speed_dial = 5
+        # Steps per second, None runs as fast as possible.
+        self.run_speed_knob = (1, 2, 10, 20, 100, 1000, 10000, None)
+        self.run_speed_dial = 0
         self.total_score = 0
+        self.glyphs = OrderedDict()
+        # Triangle maps for the q-table heatmap, by cell size, and its surface and pixel layout.
+        self.triangle_maps = {}
+        self.heatmap = None
+        # The static parts of the screen, rebuilt by draw_background when the layout changes.
+        self.background = None
+        self.convergence = convergence
+        self.monitor = None
+        self.termination_count = 0
         nextExperiment = 2
+        if playback:
+            chosen = self.play_back(playback, qtable_history)
+            if chosen is None:
+                return
+            learning_rate, discount_rate, learning_method, policies, swap = EXPERIMENTS[chosen]
 
         while (nextExperiment == 2):
             nextExperiment,learning_rate,discount_rate,learning_method, policies, swap = self.run_expirement(learning_rate,discount_rate,learning_method, policies, swap)
-            if nextExperiment == 1:
-                pygame.time.wait(30000)
-
-    def get_world_agent(self,size: Tuple[int, int], method, dropoff=None, pickup=None, package_count: int=3,
-                    even_split: bool=True, start=None, offset: int=1, capacity=None) -> agent.Agent:
-        """
-            Create a world of the specified size.
-            size: A tuple containing rows and columns.
-
-            even_split : True to make the dropoff and pickup points have the same amount of packages.
-        """
-        worldspace = World(size, offset)
-        rows, columns = size
-
-        # Offset the coordinates by a certain amount so we get better looking values.
-        for row in range(offset, rows+offset):
-            for column in range(offset, columns+offset):
-                state = "None"
-                coords = (row, column)
-                distribution = int(package_count / len(pickup))
-                packages = capacity = 0
-                if coords in pickup:
-                    state = "Pickup"
-                    packages = distribution
-                if coords in dropoff:
-                    state = "Dropoff"
-                    capacity = distribution
-                worldspace.add_node(coords, state, packages=packages, capacity=capacity)
-
-        if start == None:
-            start = (random.randint(1, rows), random.randint(1, columns))
-        else:
-            start = start
-
-        return agent.Agent(worldspace, start, method)
 
     def run_expirement(self,learning_rate: float, discount_rate: float, learning_method, policies: list, swap: bool=False):
 
@@ -91,97 +100,242 @@ class visualize_experiment:
         start = (1, 5)
         dropoff = [(5, 1), (5, 3), (2, 5)]
         pickup = [(1, 1), (3, 3), (5, 5)]
-        agent = self.get_world_agent(self.world_size, learning_method, dropoff=dropoff, pickup=pickup, package_count=15,
+        agent = get_world_agent(self.world_size, learning_method, dropoff=dropoff, pickup=pickup, package_count=15,
                                 even_split=True, start=start)
+        # The experiment's rates, as driver.experiment sets them, rather than the agent's defaults.
+        agent.learning = learning_rate
+        agent.discount = discount_rate
 
-        index = 0
-        policy, iterations = policies[index]
-        terminations = []
+        # Only the most recent are kept for the list, with their number, score and iteration.
+        terminations = deque(maxlen=RECENT_TERMINATIONS)
+        self.termination_count = 0
         done = False
+        pygame.display.set_caption('single agent RL in GRID world')
+        self.background = None
+        self.paused = False
+        clock = pygame.time.Clock()
+        step_budget = 0.0
+        self.monitor = ConvergenceMonitor(agent.world, **self.convergence) if self.convergence is not None else None
+        agent.monitor = self.monitor
 
         # Keep looping until we get all the way through without terminating.
         # We need to restart the expirement if we terminate.
-        for policy, iterations in policies:
-            agent.policy = policy
-            # Do a large number of iterations to seed the qtable.
-            for _ in range(0, iterations):
-                self.screen.fill((255, 255, 255))
-                pygame.display.set_caption('single agent RL in GRID world')
-                self.buttons()
-
-                pressed = pygame.key.get_pressed()
-                for event in pygame.event.get():
-
-                    if event.type == pygame.QUIT:
-                        return (0,learning_rate, discount_rate, learning_method, policies, swap)
-                    if event.type == pygame.KEYDOWN:
-                        if event.key == pygame.K_DOWN:
-                            self.run_speed_dial = min(max(self.run_speed_dial+1,0),5)
-                        elif event.key == pygame.K_UP:
-                            self.run_speed_dial = min(max(self.run_speed_dial-1,0),5)
-                        elif event.key == pygame.K_SPACE:
-                            pygame.time.wait(5000)
-                        elif event.key == pygame.K_1:
-                            return (2, 0.3, 0.5, "q_learning", [(policy_random, 4000), (policy_greedy, 4000)], False)
-                        elif event.key == pygame.K_2:
-                            return (2, 0.3, 0.5, "q_learning", [(policy_random, 200), (policy_exploit, 7800)], False)
-                        elif event.key == pygame.K_3:
-                            return (2, 0.3, 0.5, "sarsa", [(policy_random, 200), (policy_exploit, 7800)], False)
-                        elif event.key == pygame.K_4:
-                            return (2, 0.3, 1.0, "sarsa", [(policy_random, 200), (policy_exploit, 7800)], False)
-                        elif event.key == pygame.K_5:
-                            return (2, 0.3, 0.5, "q_learning", [(policy_random, 200), (policy_exploit, 7800)], True)
-
+        schedule = self.schedule(policies)
+        policy, iteration = policies[0][0], 0
+        # Once the schedule runs out, keep showing the result (and listening for keys) for a while.
+        finished_at = None
+        while finished_at is None or time.perf_counter() - finished_at < FINISHED_LINGER:
+            for event in pygame.event.get():
+
+                if event.type == pygame.QUIT:
+                    return (0,learning_rate, discount_rate, learning_method, policies, swap)
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_DOWN:
+                        self.run_speed_dial = max(self.run_speed_dial-1,0)
+                    elif event.key == pygame.K_UP:
+                        self.run_speed_dial = min(self.run_speed_dial+1,len(self.run_speed_knob)-1)
+                    elif event.key == pygame.K_SPACE:
+                        self.paused = not self.paused
+                    elif event.key in EXPERIMENT_KEYS:
+                        return (2,) + EXPERIMENTS[EXPERIMENT_KEYS[event.key]]
+
+            # The simulation runs in batches between frames, so the frame rate never limits learning.
+            frame_time = clock.tick(TARGET_FPS) / 1000.0
+            steps_per_second = self.run_speed_knob[self.run_speed_dial]
+            if self.paused or finished_at is not None:
+                steps, deadline = 0, None
+            elif steps_per_second is None:
+                # As fast as possible: keep stepping until it's time to draw the next frame.
+                steps, deadline = float("inf"), time.perf_counter() + 1.0/TARGET_FPS
+            else:
+                step_budget = min(step_budget + steps_per_second*frame_time, steps_per_second)
+                steps, deadline = int(step_budget), None
+                step_budget -= steps
+
+            while steps > 0:
+                try:
+                    policy, iteration = next(schedule)
+                except StopIteration:
+                    finished_at = time.perf_counter()
+                    break
+                agent.policy = policy
                 done,score = agent.move()
                 self.total_score += score
-                x_padding, y_padding = 50, 150
-
-                for row in range(self.world_size[0]):
-                    for col in range(self.world_size[1]):
-                        pygame.draw.rect(self.screen,(0,0,0),(x_padding+100*col,y_padding+100*row,100,100),5)
-                        #https://stackoverflow.com/questions/20620109/python-pygame-rendering-translucent-text/20622680
-                        if (agent.world.nodes[(row+self.offset,col+self.offset)].type == "Pickup"):
-                            textsurface=self.hugeFont.render('P', True, (0, 150, 0))
-                            surface=pygame.Surface((80, 80))
-                            surface.fill((255, 255, 255))
-                            surface.blit(textsurface,(0,0))
-                            surface.set_alpha(50)
-                            self.screen.blit(surface, (x_padding+100*col+25,y_padding+100*row))
-                        elif (agent.world.nodes[(row+self.offset,col+self.offset)].type == "Dropoff"):
-                            textsurface=self.hugeFont.render('D', True, (0, 150, 0))
-                            surface=pygame.Surface((80, 80))
-                            surface.fill((255, 255, 255))
-                            surface.blit(textsurface,(0,0))
-                            surface.set_alpha(50)
-                            self.screen.blit(surface, (x_padding+100*col+25,y_padding+100*row))
-                        coordinates = str(row+self.offset) + ', ' + str(col+self.offset)
-                        self.screen.blit(self.smallFont.render(coordinates, False, (0,0,0)),(5+x_padding+100*col,5+y_padding+100*row))
+                steps -= 1
+
                 if done:
-                    terminations.append((agent.score,_))
+                    terminations.append((self.termination_count,agent.score,iteration))
+                    self.termination_count += 1
                     agent.reset(qtable=False)
-                    if len(terminations) == 2 and swap:
-                        agent.world.swap_pickup_dropoff()
-
-                self.refresh_agent(agent)
-                self.refresh_boxes(agent)
-                self.refresh_q_table(agent)
-                self.refresh_stats(agent,_,policy,terminations)
-                self.refresh_path(agent)
+                    if self.termination_count == 2 and swap:
+                        # Through the agent, so it replans and drops its traces for the new layout.
+                        agent.swap_pickup_dropoff()
+                        # The P and D overlays moved, so the background has to be redrawn.
+                        self.background = None
+                        if self.monitor:
+                            self.monitor.restart()
+                if self.monitor and self.monitor.step() and (self.termination_count >= 2 or not swap):
+                    finished_at = time.perf_counter()
+                    break
+                if deadline and iteration % 64 == 0 and time.perf_counter() > deadline:
+                    break
+
+            if self.background is None:
+                self.background = self.draw_background(agent)
+                self.screen.blit(self.background, (0, 0))
                 pygame.display.flip()
-                pygame.time.wait(self.run_speed_knob[self.run_speed_dial])
+            regions = self.dynamic_regions()
+            for region in regions:
+                self.screen.blit(self.background, region, region)
+            self.refresh_agent(agent)
+            self.refresh_boxes(agent)
+            self.refresh_q_table(agent)
+            self.refresh_stats(agent,iteration,policy,terminations)
+            self.refresh_path(agent)
+            pygame.display.update(regions)
 
         return (1,learning_rate, discount_rate, learning_method, policies, swap)
 
-    def buttons(self):
+    def play_back(self, trajectory_path, qtable_path=None):
+        # Replay a recorded run.  SPACE pauses, UP and DOWN change speed, LEFT and RIGHT step one move,
+        # PAGE UP and PAGE DOWN jump an episode, and HOME and END jump to either end.  Returns the number
+        # of the experiment to run live next, or None to quit.
+        player = Playback(trajectory_path, qtable_path)
+        agent = player.agent
+        self.world_size = tuple(player.header["size"])
+        self.offset = player.header["offset"]
+        pygame.display.set_caption('Playback: ' + os.path.basename(trajectory_path) +
+                                   ' (Left/Right: step, Page Up/Down: episode, Home/End: start/end)')
+        self.background = None
+        self.paused = False
+        swapped = agent.world._swapped
+        clock = pygame.time.Clock()
+        step_budget = 0.0
+
+        while True:
+            target = player.position
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    return None
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_DOWN:
+                        self.run_speed_dial = max(self.run_speed_dial-1,0)
+                    elif event.key == pygame.K_UP:
+                        self.run_speed_dial = min(self.run_speed_dial+1,len(self.run_speed_knob)-1)
+                    elif event.key == pygame.K_SPACE:
+                        self.paused = not self.paused
+                    elif event.key in (pygame.K_LEFT, pygame.K_RIGHT):
+                        self.paused = True
+                        target += 1 if event.key == pygame.K_RIGHT else -1
+                    elif event.key == pygame.K_PAGEDOWN:
+                        target = player.starts[min(player.episode + 1, len(player.starts) - 1)]
+                    elif event.key == pygame.K_PAGEUP:
+                        target = player.starts[max(player.episode - 1, 0)]
+                    elif event.key == pygame.K_HOME:
+                        target = 0
+                    elif event.key == pygame.K_END:
+                        target = player.length
+                    elif event.key in EXPERIMENT_KEYS:
+                        return EXPERIMENT_KEYS[event.key]
+
+            # Fast forward by skipping straight to where this frame should be; only that state is drawn.
+            frame_time = clock.tick(TARGET_FPS) / 1000.0
+            steps_per_second = self.run_speed_knob[self.run_speed_dial]
+            if not self.paused and target < player.length:
+                if steps_per_second is None:
+                    # As fast as possible: the whole run in a few seconds, whatever its length.
+                    target += max(1, player.length // (TARGET_FPS * PLAYBACK_SECONDS))
+                else:
+                    step_budget = min(step_budget + steps_per_second*frame_time, steps_per_second)
+                    target += int(step_budget)
+                    step_budget -= int(step_budget)
+            if target != player.position:
+                player.seek(target)
+            terminations = player.terminations(RECENT_TERMINATIONS)
+            self.termination_count = player.episode
+            self.total_score = player.total_score()
+
+            if self.background is None or agent.world._swapped != swapped:
+                swapped = agent.world._swapped
+                self.background = self.draw_background(agent)
+                self.screen.blit(self.background, (0, 0))
+                pygame.display.flip()
+            regions = self.dynamic_regions()
+            for region in regions:
+                self.screen.blit(self.background, region, region)
+            self.refresh_agent(agent)
+            self.refresh_boxes(agent)
+            self.refresh_q_table(agent)
+            self.refresh_stats(agent,player.position,"Playback",terminations)
+            self.refresh_path(agent)
+            pygame.display.update(regions)
+
+    def schedule(self, policies):
+        # Yields the policy and iteration number for every step of the experiment.
+        for policy, iterations in policies:
+            for iteration in range(0, iterations):
+                yield policy, iteration
+
+    def speed_text(self):
+        steps_per_second = self.run_speed_knob[self.run_speed_dial]
+        return "max steps/s" if steps_per_second is None else str(steps_per_second) + " steps/s"
+
+    def render_text(self, font, text, color, antialias=False):
+        # Rendering text is slow, and the same strings come up every frame, so keep the surfaces.
+        key = (font, text, color, antialias)
+        glyph = self.glyphs.get(key)
+        if glyph is None:
+            glyph = font.render(text, antialias, color)
+            self.glyphs[key] = glyph
+            if len(self.glyphs) > GLYPH_CACHE_SIZE:
+                self.glyphs.popitem(last=False)
+        else:
+            self.glyphs.move_to_end(key)
+        return glyph
+
+    def dynamic_regions(self):
+        # The parts of the screen that change between frames: stats, grid, q-table and terminations list.
+        rows, columns = self.world_size
+        terminations_y = 100+100*(rows+self.offset)
+        return [pygame.Rect(0, 45, 500, 104),
+                pygame.Rect(50, 150, 100*columns, 100*rows),
+                self.q_table_rect(),
+                pygame.Rect(0, terminations_y, RESOLUTION[0], RESOLUTION[1] - terminations_y)]
+
+    def draw_background(self, agent):
+        # Everything that only changes when the layout does: the buttons, grid, coordinates and P/D overlays.
+        background = pygame.Surface(RESOLUTION)
+        background.fill((255, 255, 255))
+        self.buttons(background)
+        x_padding, y_padding = 50, 150
+
+        for row in range(self.world_size[0]):
+            for col in range(self.world_size[1]):
+                pygame.draw.rect(background,(0,0,0),(x_padding+100*col,y_padding+100*row,100,100),5)
+                #https://stackoverflow.com/questions/20620109/python-pygame-rendering-translucent-text/20622680
+                node_type = agent.world.nodes[(row+self.offset,col+self.offset)].type
+                if node_type in ("Pickup", "Dropoff"):
+                    textsurface=self.hugeFont.render(node_type[0], True, (0, 150, 0))
+                    surface=pygame.Surface((80, 80))
+                    surface.fill((255, 255, 255))
+                    surface.blit(textsurface,(0,0))
+                    surface.set_alpha(50)
+                    background.blit(surface, (x_padding+100*col+25,y_padding+100*row))
+                coordinates = str(row+self.offset) + ', ' + str(col+self.offset)
+                background.blit(self.smallFont.render(coordinates, False, (0,0,0)),(5+x_padding+100*col,5+y_padding+100*row))
+        return background
+
+    def buttons(self, surface=None):
+        surface = surface if surface else self.screen
         experiments_text = 'Pre-defined Experiments(Press #key on keyboard).'
-        experiments_display = self.normalFont.render(experiments_text, False, (0, 0, 0))
-        self.screen.blit(experiments_display, (500, 40))
+        experiments_display = self.render_text(self.normalFont, experiments_text, (0, 0, 0))
+        surface.blit(experiments_display, (500, 40))
 
         i = 500
         for b in range(5):
-            pygame.draw.rect(self.screen, (0,0,0),(i,70,50,50),3)
+            pygame.draw.rect(surface, (0,0,0),(i,70,50,50),3)
             buttons_display = self.bigFont.render(str(b+1), False, (0, 0, 0))
-            self.screen.blit(buttons_display, (i+5, 75))
+            surface.blit(buttons_display, (i+5, 75))
             #self.button(b+1,i,75,50,50,(0,200,0),(0,150,0))
             i+=60
 
@@ -201,49 +355,57 @@ class visualize_experiment:
 
     def refresh_stats(self,agnt,_,policy,terminations):
         iter_text = 'Learning Method: ' + str(agnt.method)
-        iter_display = self.normalFont.render(iter_text, False, (0, 0, 0))
+        iter_display = self.render_text(self.normalFont, iter_text, (0, 0, 0))
         self.screen.blit(iter_display, (50, 50))
 
-        if policy.__name__ == "policy_greedy":
+        policy_name = getattr(policy, "__name__", None)
+        if policy_name == "policy_greedy":
             policy = "Greedy"
-        elif policy.__name__ == "policy_random":
+        elif policy_name == "policy_random":
             policy = "Random"
-        elif policy.__name__ == "policy_exploit":
+        elif policy_name == "policy_exploit":
             policy = "Exploit"
 
         iter_text = 'Policy: ' + str(policy)
-        iter_display = self.normalFont.render(iter_text, False, (0, 0, 0))
+        iter_display = self.render_text(self.normalFont, iter_text, (0, 0, 0))
         self.screen.blit(iter_display, (50, 70))
 
-        info_display = self.normalFont.render("Press SPACE to pause for 5 seconds.", False, (0, 0, 0))
+        info_display = self.render_text(self.normalFont, "Paused, press SPACE to resume." if self.paused else "Press SPACE to pause.", (0, 0, 0))
         self.screen.blit(info_display, (50, 90))
 
-        info_display = self.normalFont.render("Use Up and Down arrow keys to adjust speed.", False, (0, 0, 0))
+        info_display = self.render_text(self.normalFont, "Use Up and Down arrow keys to adjust speed.", (0, 0, 0))
         self.screen.blit(info_display, (50, 110))
 
+        speed_display = self.render_text(self.normalFont, "Speed: " + self.speed_text(), (0, 0, 0))
+        self.screen.blit(speed_display, (50, 130))
+
         iter_text = 'Iteration: ' + str(_)
-        iter_display = self.normalFont.render(iter_text, False, (0, 0, 0))
+        iter_display = self.render_text(self.normalFont, iter_text, (0, 0, 0))
         self.screen.blit(iter_display, (350, 50))
 
         score = agnt.score
         score_text = 'Score: ' + str(score)
-        score_display = self.normalFont.render(score_text, False, (0, 0, 0))
+        score_display = self.render_text(self.normalFont, score_text, (0, 0, 0))
         self.screen.blit(score_display, (350 ,70))
 
         totalScore_text = 'Total Score: ' + str(self.total_score)
-        tScore_display = self.normalFont.render(totalScore_text, False, (0, 0, 0))
+        tScore_display = self.render_text(self.normalFont, totalScore_text, (0, 0, 0))
         self.screen.blit(tScore_display, (350 ,90))
 
-        term_text = 'Terminal States: ' + str(len(terminations))
-        term_display = self.normalFont.render(term_text, False, (0, 0, 0))
+        term_text = 'Terminal States: ' + str(self.termination_count)
+        term_display = self.render_text(self.normalFont, term_text, (0, 0, 0))
         self.screen.blit(term_display, (350 ,110))
 
+        if self.monitor and self.monitor.converged_at is not None:
+            converged_display = self.render_text(self.normalFont, 'Converged at step ' + str(self.monitor.converged_at), (0, 0, 0))
+            self.screen.blit(converged_display, (350 ,130))
+
         terminations_text = 'Terminations | Score | Iterations'
-        terminations_display = self.normalFont.render(terminations_text, False, (0, 0, 0))
+        terminations_display = self.render_text(self.normalFont, terminations_text, (0, 0, 0))
         self.screen.blit(terminations_display, (50, 100+100*(self.world_size[0]+self.offset)))
         for t in range(len(terminations)):
-            terminations_text = str(t) +'  | '+str(terminations[t][0]) + '      |   ' + str(terminations[t][1])
-            terminations_display = self.normalFont.render(terminations_text, False, (0, 0, 0))
+            terminations_text = str(terminations[t][0]) +'  | '+str(terminations[t][1]) + '      |   ' + str(terminations[t][2])
+            terminations_display = self.render_text(self.normalFont, terminations_text, (0, 0, 0))
             self.screen.blit(terminations_display, (50 +(200*(t//4)),120+100*(self.world_size[0]+self.offset) + (20*(t%4))))
 
     def refresh_boxes(self,agnt):
@@ -260,169 +422,130 @@ class visualize_experiment:
                 self.screen.blit(get_image('box.png'), (box_x+((d%5)*17), box_y))
 
     def refresh_q_table(self,agnt):
-        cell_size = 100
-
-        y_padding = 50 + 5*self.world_size[1] + 100*self.world_size[1] + 50
-        x_padding = 150
-
-        for x in range(self.world_size[0]):
-            for y in range(self.world_size[1]):
-                node_coords = (x + self.offset, y + self.offset)
-                goal = False
-                q_val = 1
-                actionType = ''
-                center = (y_padding + (y * cell_size) + cell_size//2 , x_padding + (x * cell_size) + cell_size//2)
-                if (not agnt.carrying
-                    and agnt.world.nodes[node_coords].type == "Pickup"
-                        and agnt.world.nodes[node_coords].packages > 0):
-                            goal = True
-                            actionType = "P"
-                elif (agnt.carrying
-                    and agnt.world.nodes[node_coords].type == "Dropoff"
-                        and agnt.world.nodes[node_coords].packages < 5):
-                            goal = True
-                            actionType = "D"
-                if goal:
-                    y_pos = y_padding + y * cell_size
-                    x_pos = x_padding + x * cell_size
-                    pygame.draw.rect(self.screen, (0,175,0), pygame.Rect(y_pos, x_pos, 100, 100))
-                    Q_display = self.hugeFont.render(actionType, False, (255, 255, 255))
-                    self.screen.blit(Q_display, (center[0] - Q_display.get_width() // 2, center[1] - Q_display.get_height() // 2 ))
-                    continue
-                TL_corner = [y_padding + y * cell_size , x_padding + x * cell_size]
-                TR_corner = [y_padding + (y+1) * cell_size , x_padding + x * cell_size]
-                BR_corner = [y_padding + (y+1) * cell_size , x_padding + (x+1) * cell_size]
-                BL_corner = [y_padding + y * cell_size , x_padding + (x+1) * cell_size]
-
-                for action in {"Up","Down","Right","Left"}:
-                    cornerA = None
-                    cornerB = None
-                    cornerC = center
-
-                    if action == "Up":
-                        cornerA = TR_corner
-                        cornerB = TL_corner
-                    elif action == "Down":
-                        cornerA = BR_corner
-                        cornerB = BL_corner
-                    elif action == "Right":
-                        cornerA = TR_corner
-                        cornerB = BR_corner
-                    elif action == "Left":
-                        cornerA = TL_corner
-                        cornerB = BL_corner
-
-                    if action == "Up" and "Up" in agnt.world.nodes[node_coords].actions:
-                        q_val = agnt.world.get_q_value(agnt.world.nodes[node_coords],"Up",agnt.carrying)
-                    elif action == "Down"  and "Down" in agnt.world.nodes[node_coords].actions:
-                        q_val = agnt.world.get_q_value(agnt.world.nodes[node_coords],"Down",agnt.carrying)
-                    elif action == "Right" and "Right" in agnt.world.nodes[node_coords].actions:
-                        q_val = agnt.world.get_q_value(agnt.world.nodes[node_coords],"Right",agnt.carrying)
-                    elif action == "Left"  and "Left" in agnt.world.nodes[node_coords].actions:
-                        q_val = agnt.world.get_q_value(agnt.world.nodes[node_coords],"Left",agnt.carrying)
-                    else:
-                        q_val = 0
-
-                    color = 0
-                    if q_val >= 0:
-                        color = (0,min(q_val*150, 255),0)
-                    else:
-                        color = (min(q_val*-150, 255),0,0)
-
-                    pygame.draw.polygon(self.screen, color, [cornerA, cornerB, cornerC], 0)
-
-                    text_center = np.mean([cornerA, cornerB, cornerC], 0)
-
-                    Q_text = str(round(q_val, 2))
-                    Q_display = self.smallFont.render(Q_text, False, (255, 255, 255))
-
-                    self.screen.blit(Q_display, (text_center[0] - Q_display.get_width() // 2, text_center[1] - Q_display.get_height() // 2 ))
-
-                    pygame.draw.polygon(self.screen, (255,255,255), [cornerA, cornerB, center], 1)
+        # The q-values for what the agent is carrying, drawn as one image: every cell is split into a
+        # triangle per move, green for positive values and red for negative, and the goals still
+        # available are solid green.  The values are written on top only when the cells are big enough.
+        # Cells too small to show triangles are filled with the color of their best move instead.
+        world = agnt.world
+        rows, columns = self.world_size
+        rect = self.q_table_rect()
+        cell_size = rect.width // columns
+        zoomed = cell_size >= LABEL_MIN_CELL
+        size = cell_size if cell_size >= HEATMAP_MIN_CELL else 1
+
+        q_values = world.get_q_slice(agnt.carrying).reshape(rows, columns, len(ACTIONS))
+        if size == 1:
+            # Pairwise is much quicker than max(axis=2) over such a short, strided axis.
+            shown = np.maximum(np.maximum(q_values[:, :, 0], q_values[:, :, 1]),
+                               np.maximum(q_values[:, :, 2], q_values[:, :, 3]))[:, :, None]
+        else:
+            # Moves off the grid show as 0, which is black.
+            shown = np.where(np.isfinite(q_values), q_values, 0.0)
+        # One color per move, and a last one for the lines between the triangles.
+        colors = np.zeros((rows, columns, shown.shape[2] + (size > 1), 3), dtype=np.uint8)
+        colors[:, :, :shown.shape[2], 0] = np.clip(-shown*150, 0, 255)
+        colors[:, :, :shown.shape[2], 1] = np.clip(shown*150, 0, 255)
+        colors[:, :, shown.shape[2]:] = 255
+        goals = self.available_goals(agnt)
+        colors[goals // columns, goals % columns] = GOAL_COLOR
+
+        # Every pixel is then one lookup of its cell and triangle's color.
+        heatmap, pixel_colors = self.heatmap_layout(rows, columns, size, zoomed)
+        mapped = pygame.surfarray.map_array(heatmap, colors.reshape(-1, 1, 3)).ravel()
+        pygame.surfarray.blit_array(heatmap, mapped[pixel_colors])
+        if heatmap.get_size() != rect.size:
+            heatmap = pygame.transform.scale(heatmap, rect.size)
+        self.screen.blit(heatmap, rect)
+
+        if not zoomed:
+            return
+        goals = set(goals.tolist())
+        # Labels go in the middle of each triangle, a third of the way from the center to the edge.
+        offsets = {"Up": (0, -cell_size/3), "Down": (0, cell_size/3),
+                   "Left": (-cell_size/3, 0), "Right": (cell_size/3, 0)}
+        for index in range(rows*columns):
+            row, column = divmod(index, columns)
+            center = (rect.x + column*cell_size + cell_size//2, rect.y + row*cell_size + cell_size//2)
+            if index in goals:
+                Q_display = self.render_text(self.hugeFont, "D" if agnt.carrying else "P", (255, 255, 255))
+                self.screen.blit(Q_display, (center[0] - Q_display.get_width() // 2, center[1] - Q_display.get_height() // 2 ))
+                continue
+            for action, q_val in zip(ACTIONS, q_values[row, column].tolist()):
+                Q_text = str(round(q_val, 2)) if np.isfinite(q_val) else "0"
+                Q_display = self.render_text(self.smallFont, Q_text, (255, 255, 255))
+                text_center = (center[0] + offsets[action][0], center[1] + offsets[action][1])
+                self.screen.blit(Q_display, (text_center[0] - Q_display.get_width() // 2, text_center[1] - Q_display.get_height() // 2 ))
+
+    def q_table_rect(self):
+        # Where the q-table goes, to the right of the grid.  Bigger worlds get smaller cells, so it
+        # stays on screen.
+        rows, columns = self.world_size
+        cell_size = min(100, Q_TABLE_VIEWPORT / max(rows, columns))
+        x = min(50 + 5*columns + 100*columns + 50, RESOLUTION[0] - Q_TABLE_VIEWPORT - 50)
+        return pygame.Rect(x, 150, round(cell_size*columns), round(cell_size*rows))
+
+    def heatmap_layout(self, rows, columns, size, lines):
+        # The surface the heatmap is drawn on, and for each of its pixels, by (x, y) like surfarray, the
+        # index of its color in the flattened (rows, columns, colors per cell) colors.  Rebuilt when the
+        # grid or cell size changes.
+        key = (rows, columns, size, lines)
+        if self.heatmap is None or self.heatmap[0] != key:
+            y, x = np.mgrid[0:rows*size, 0:columns*size]
+            cells = (y // size) * columns + x // size
+            # Cells of one pixel have a single color.
+            triangles = self.triangles(size, lines) if size > 1 else np.zeros((1, 1), dtype=np.int64)
+            slots = len(ACTIONS) + 1 if size > 1 else 1
+            pixel_colors = (cells * slots + triangles[y % size, x % size]).T.astype(np.int32)
+            self.heatmap = (key, pygame.Surface((columns*size, rows*size), depth=32), pixel_colors)
+        return self.heatmap[1], self.heatmap[2]
+
+    def triangles(self, size, lines):
+        # Which move's triangle each pixel of a size x size cell is in, by index in ACTIONS.  With lines,
+        # the edges and diagonals get len(ACTIONS), for the white lines between them.
+        key = (size, lines)
+        triangles = self.triangle_maps.get(key)
+        if triangles is None:
+            y, x = np.mgrid[0:size, 0:size]
+            flipped_x, flipped_y = size - 1 - x, size - 1 - y
+            # Pixels on a diagonal go to whichever triangle the loop reaches last, unless drawn as lines.
+            triangles = np.zeros((size, size), dtype=np.int64)
+            triangles[(y <= x) & (y <= flipped_x)] = ACTION_INDEX["Up"]
+            triangles[(y >= x) & (y >= flipped_x)] = ACTION_INDEX["Down"]
+            triangles[(x < y) & (x < flipped_y)] = ACTION_INDEX["Left"]
+            triangles[(x > y) & (x > flipped_y)] = ACTION_INDEX["Right"]
+            if lines:
+                triangles[(x == y) | (x == flipped_y)] = len(ACTIONS)
+                triangles[[0, -1], :] = len(ACTIONS)
+                triangles[:, [0, -1]] = len(ACTIONS)
+            self.triangle_maps[key] = triangles
+        return triangles
+
+    def available_goals(self, agnt):
+        # Node indices of the pickups (or dropoffs, when carrying) that can still be used.
+        world = agnt.world
+        mask = world.get_availability_mask(agnt.carrying)
+        goals = world.dropoffs if agnt.carrying else world.pickups
+        return np.array([goal.index for goal in goals if not (mask >> goal.slot) & 1], dtype=np.int64)
 
     def closest_goal(self,current_node,agnt):
-        dist = max(self.world_size)
-        nearestGoal = None
-        if agnt.carrying:
-            for dropoff in agnt.world.dropoffs:
-                if dropoff.packages <5:
-                    thisDist = abs(current_node.coords[0]-dropoff.coords[0]) + abs(current_node.coords[1]-dropoff.coords[1])
-                    if thisDist < dist:
-                        dist = thisDist
-                        nearestGoal = dropoff
-
-        elif not agnt.carrying:
-            for pickup in agnt.world.pickups:
-                if pickup.packages >0:
-                    thisDist = abs(current_node.coords[0]-pickup.coords[0]) + abs(current_node.coords[1]-pickup.coords[1])
-                    if thisDist < dist:
-                        dist = thisDist
-                        nearestGoal = pickup
-        return nearestGoal, dist
+        # Nearest pickup (or dropoff when carrying) that can still be used, and how many moves away it is,
+        # looked up from the world's cached distance fields.
+        return agnt.world.get_nearest_goal(current_node, agnt.carrying)
 
     def refresh_path(self,agnt):
-        current_coords = agnt.current_node.coords
         cell_size = 100
 
         y_padding = 50
         x_padding = 150
 
         nearestGoal, dist = self.closest_goal(agnt.current_node,agnt)
-        if nearestGoal != None:
-            nearest_coords = nearestGoal.coords
-
-        while (True):
-            a, dist = self.closest_goal(agnt.world.nodes[current_coords],agnt)
-            if (dist < 2):
-                break
-            if nearestGoal is None:
-                break
-            if (current_coords[0] < nearest_coords[0]
-                and agnt.world.nodes[(current_coords[0]+1,current_coords[1])].type not in {"Dropoff","Pickup"}):
-                    center1 = (y_padding + (current_coords[1]-1)*cell_size + cell_size//2, x_padding + (current_coords[0]-1)*cell_size + cell_size//2)
-                    center2 = (y_padding + (current_coords[1]-1)*cell_size + cell_size//2, x_padding + (current_coords[0]+0)*cell_size + cell_size//2)
-                    current_coords = (current_coords[0]+1,current_coords[1])
-                    pygame.draw.line(self.screen, (255,0,0), center1, center2, 5)
-            elif (current_coords[0] > nearest_coords[0]
-                and agnt.world.nodes[(current_coords[0]-1,current_coords[1])].type not in {"Dropoff","Pickup"}):
-                    center1 = (y_padding + (current_coords[1]-1)*cell_size + cell_size//2, x_padding + (current_coords[0]-1)*cell_size + cell_size//2)
-                    center2 = (y_padding + (current_coords[1]-1)*cell_size + cell_size//2, x_padding + (current_coords[0]-2)*cell_size + cell_size//2)
-                    current_coords = (current_coords[0]-1,current_coords[1])
-                    pygame.draw.line(self.screen, (255,0,0), center1, center2, 5)
-            elif (current_coords[1] < nearest_coords[1]
-                and agnt.world.nodes[(current_coords[0],current_coords[1]+1)].type not in {"Dropoff","Pickup"}):
-                    center1 = (y_padding + (current_coords[1]-1)*cell_size + cell_size//2, x_padding + (current_coords[0]-1)*cell_size + cell_size//2)
-                    center2 = (y_padding + (current_coords[1]+0)*cell_size + cell_size//2, x_padding + (current_coords[0]-1)*cell_size + cell_size//2)
-                    current_coords = (current_coords[0],current_coords[1]+1)
-                    pygame.draw.line(self.screen, (255,0,0), center1, center2, 5)
-            elif (current_coords[1] > nearest_coords[1]
-                and agnt.world.nodes[(current_coords[0],current_coords[1]-1)].type not in {"Dropoff","Pickup"}):
-                    center1 = (y_padding + (current_coords[1]-1)*cell_size + cell_size//2, x_padding + (current_coords[0]-1)*cell_size + cell_size//2)
-                    center2 = (y_padding + (current_coords[1]-2)*cell_size + cell_size//2, x_padding + (current_coords[0]-1)*cell_size + cell_size//2)
-                    current_coords = (current_coords[0],current_coords[1]-1)
-                    pygame.draw.line(self.screen, (255,0,0), center1, center2, 5)
-            else:
-                break
         if nearestGoal is None:
             return
-        if (current_coords[0] < nearest_coords[0]):
-                center1 = (y_padding + (current_coords[1]-1)*cell_size + cell_size//2, x_padding + (current_coords[0]-1)*cell_size + cell_size//2)
-                center2 = (y_padding + (current_coords[1]-1)*cell_size + cell_size//2, x_padding + (current_coords[0]+0)*cell_size + cell_size//2)
-                current_coords = (current_coords[0]+1,current_coords[1])
-                pygame.draw.line(self.screen, (255,0,0), center1, center2, 5)
-        elif (current_coords[0] > nearest_coords[0]):
-                center1 = (y_padding + (current_coords[1]-1)*cell_size + cell_size//2, x_padding + (current_coords[0]-1)*cell_size + cell_size//2)
-                center2 = (y_padding + (current_coords[1]-1)*cell_size + cell_size//2, x_padding + (current_coords[0]-2)*cell_size + cell_size//2)
-                current_coords = (current_coords[0]-1,current_coords[1])
-                pygame.draw.line(self.screen, (255,0,0), center1, center2, 5)
-        elif (current_coords[1] < nearest_coords[1]):
-                center1 = (y_padding + (current_coords[1]-1)*cell_size + cell_size//2, x_padding + (current_coords[0]-1)*cell_size + cell_size//2)
-                center2 = (y_padding + (current_coords[1]+0)*cell_size + cell_size//2, x_padding + (current_coords[0]-1)*cell_size + cell_size//2)
-                current_coords = (current_coords[0],current_coords[1]+1)
-                pygame.draw.line(self.screen, (255,0,0), center1, center2, 5)
-        elif (current_coords[1] > nearest_coords[1]):
-                center1 = (y_padding + (current_coords[1]-1)*cell_size + cell_size//2, x_padding + (current_coords[0]-1)*cell_size + cell_size//2)
-                center2 = (y_padding + (current_coords[1]-2)*cell_size + cell_size//2, x_padding + (current_coords[0]-1)*cell_size + cell_size//2)
-                current_coords = (current_coords[0],current_coords[1]-1)
-                pygame.draw.line(self.screen, (255,0,0), center1, center2, 5)
+        # Follow the goal's distance field downhill, which goes around the other pickups and dropoffs.
+        current_coords = agnt.current_node.coords
+        for node in agnt.world.get_path(agnt.current_node, nearestGoal):
+            center1 = (y_padding + (current_coords[1]-1)*cell_size + cell_size//2, x_padding + (current_coords[0]-1)*cell_size + cell_size//2)
+            center2 = (y_padding + (node.coords[1]-1)*cell_size + cell_size//2, x_padding + (node.coords[0]-1)*cell_size + cell_size//2)
+            pygame.draw.line(self.screen, (255,0,0), center1, center2, 5)
+            current_coords = node.coords
 
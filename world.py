@@ -1,15 +1,32 @@
 __author__ = "Jackson Murrell"
 
+import copy
 import random
 
+import numpy as np
+
 from typing import Tuple
 
 INITIAL_Q_VALUE = 0
 
+# Only the cardinal directions get q-values; Pickup and Dropoff are always taken when available.
+ACTIONS = ("Up", "Down", "Left", "Right")
+ACTION_INDEX = {action: index for index, action in enumerate(ACTIONS)}
+# Columns of World.action_masks.
+ALL_ACTIONS = ACTIONS + ("Pickup", "Dropoff")
+PICKUP_INDEX = ALL_ACTIONS.index("Pickup")
+DROPOFF_INDEX = ALL_ACTIONS.index("Dropoff")
+# Offsets for each cardinal direction, in (row, column).
+MOVES = {"Up": (-1, 0), "Down": (1, 0), "Left": (0, -1), "Right": (0, 1)}
+
 class Node(object):
     def __init__(self, coords: Tuple[int, int], node_type: str, packages: int, capacity: int,
-                 row_edge=None, column_edge=None):
+                 row_edge=None, column_edge=None, index: int=None):
         self.coords = coords
+        self.index = index
+        # Set by World.add_node: the owning world, and this node's bit in the world's availability masks.
+        self.world = None
+        self.slot = None
         self.y, self.x = coords
         self.row_edge = row_edge
         self.column_edge = column_edge
@@ -24,6 +41,10 @@ class Node(object):
             if (self.packages - packages) < 0:
                 raise ArithmeticError("Cannot have negative packages at a pickup.")
             self.packages -= packages
+            if self.world is not None:
+                self.world.remaining_packages -= packages
+                if self.packages == 0:
+                    self.world.empty_pickups |= 1 << self.slot
         else:
             raise TypeError("Cannot pickup from a non-pickup node.")
 
@@ -32,6 +53,8 @@ class Node(object):
             if (self.packages + packages) > self.capacity:
                 raise ArithmeticError("Cannot have packages over capacity at a dropoff.")
             self.packages += packages
+            if self.world is not None and self.packages == self.capacity:
+                self.world.full_dropoffs |= 1 << self.slot
         else:
             raise TypeError("Cannot dropoff from a non-dropoff node.")
 
@@ -77,17 +100,126 @@ class Node(object):
                 self.actions.pop("Dropoff", None)
         return self.actions
 
+class QRow(object):
+    """
+        A dict-like view of one row of an ArrayQTable, so policies can keep indexing by action name.
+
+        The row is read into a list once, since indexing a numpy array one scalar at a time costs
+        more than the dict lookups it replaces.  Writes go to both the list and the array.
+    """
+    __slots__ = ("values", "moves", "cache")
+
+    def __init__(self, values: np.ndarray, moves: tuple):
+        self.values = values
+        self.moves = moves
+        self.cache = values.tolist()
+
+    def __getitem__(self, action: str) -> float:
+        return self.cache[ACTION_INDEX[action]]
+
+    def __setitem__(self, action: str, q_value: float):
+        self.cache[ACTION_INDEX[action]] = q_value
+        self.values[ACTION_INDEX[action]] = q_value
+
+    def __contains__(self, action: str) -> bool:
+        return action in self.moves
+
+    def __iter__(self):
+        return iter(self.moves)
+
+    def __len__(self) -> int:
+        return len(self.moves)
+
+    def keys(self) -> tuple:
+        return self.moves
+
+    def items(self) -> list:
+        return [(action, self.cache[ACTION_INDEX[action]]) for action in self.moves]
+
+class ArrayQTable(object):
+    """
+        Stores every q-value of a world in one contiguous array.
+
+        The array is indexed by (node index, carrying, availability mask, action), where the
+        availability mask has bit i set when pickup i is empty (not carrying) or dropoff i is full
+        (carrying).  Moves off the edge of the grid are stored as -inf so they never win a max.
+
+        Single q-values are read and written through a flat view of the array with plain integer
+        offsets, which is several times cheaper than a 4 index lookup.
+    """
+    def __init__(self, world, initial_value: float=INITIAL_Q_VALUE, dtype=np.float64, values: np.ndarray=None):
+        """
+            values: An existing array to use, such as a memory-mapped checkpoint, instead of a fresh one.
+        """
+        self.world = world
+        self.mask_bits = max(len(world.pickups), len(world.dropoffs))
+        shape = (len(world.node_list), 2, 1 << self.mask_bits, len(ACTIONS))
+        if values is not None:
+            if values.shape != shape:
+                raise ValueError("Q-table of shape " + str(values.shape) + " does not fit this world " + str(shape))
+            self.values = values
+        else:
+            if world.transitions is None:
+                world.compile()
+            self.values = np.full(shape, initial_value, dtype=dtype)
+            # The transposed view puts the action axis next to the node axis, so the (nodes, 4) transition
+            # table can select the off-grid moves directly.
+            self.values.transpose(0, 3, 1, 2)[world.transitions < 0] = -np.inf
+        # reshape only copies arrays that aren't contiguous, and those have to be written through values.
+        self.flat = self.values.reshape(-1) if self.values.flags.c_contiguous else None
+        self.masks = shape[2]
+
+    def _offset(self, node: Node, carrying: bool, mask: int) -> int:
+        # Offset of the row in the flat view.
+        return ((node.index * 2 + carrying) * self.masks + mask) * len(ACTIONS)
+
+    def row(self, node: Node, carrying: bool, mask: int) -> QRow:
+        return QRow(self.values[node.index, int(carrying), mask], self.world.get_moves(node))
+
+    def get_q_value(self, node: Node, action: str, carrying: bool, mask: int) -> float:
+        if self.flat is None:
+            return float(self.values[node.index, int(carrying), mask, ACTION_INDEX[action]])
+        return self.flat.item(self._offset(node, carrying, mask) + ACTION_INDEX[action])
+
+    def update_q_table(self, q_value: float, node: Node, action: str, carrying: bool, mask: int):
+        if self.flat is None:
+            self.values[node.index, int(carrying), mask, ACTION_INDEX[action]] = q_value
+            return
+        self.flat[self._offset(node, carrying, mask) + ACTION_INDEX[action]] = q_value
+
+    def get_max_q_value(self, node: Node, carrying: bool, mask: int) -> float:
+        return max(self.values[node.index, int(carrying), mask].tolist())
+
 class World(object):
-    def __init__(self, size: Tuple[int, int], offset: Tuple[int, int]):
+    def __init__(self, size: Tuple[int, int], offset: Tuple[int, int], backend: str="dict"):
+        """
+            backend: "dict" for the nested dictionary q-table, or "array" for an ArrayQTable.
+        """
+        if backend not in ("dict", "array"):
+            raise ValueError("Unknown q-table backend: " + str(backend))
         self.rows, self.columns = size
         self.offset = offset
+        self.backend = backend
         self.nodes = {}
+        # Nodes in insertion order, so node.index can be used to look them up.
+        self.node_list = []
         self.pickups = []
         self.dropoffs = []
+        # Bit i is set when pickup i is empty, or dropoff i is full.  Kept up to date by Node.pickup and
+        # Node.dropoff, and rebuilt whenever package counts are changed wholesale.
+        self.empty_pickups = 0
+        self.full_dropoffs = 0
+        self.remaining_packages = 0
         # Set it to None, so if we try to update the q-table, we can know to initialize first.
         self.qtable = None
         # Marker to know if we need to swap back on reset.
         self._swapped = False
+        # Compiled transition and action tables.  Set to None whenever the layout changes, and
+        # rebuilt by compile() the next time they are needed.
+        self.transitions = None
+        self.action_masks = None
+        # Distances to every pickup and dropoff, built by get_distances when first needed.
+        self.distances = None
 
     def reset(self, qtable: bool=False, swap_back=False):
         if self._swapped and swap_back:
@@ -97,6 +229,7 @@ class World(object):
             dropoff.packages = 0
         for pickup in self.pickups:
             pickup.packages = pickup.starting_packages
+        self._rebuild_masks()
 
         if qtable:
             self._initialize_table()
@@ -114,12 +247,34 @@ class World(object):
         elif coords[1]+1 > self.columns:
             column_edge = "R"
         node = Node(coords, state, packages, capacity,
-                    row_edge=row_edge, column_edge=column_edge)
+                    row_edge=row_edge, column_edge=column_edge, index=len(self.node_list))
+        node.world = self
+        self.transitions = None
+        self.action_masks = None
+        self.distances = None
         self.nodes[coords] = node
+        self.node_list.append(node)
         if state == "Pickup":
+            node.slot = len(self.pickups)
             self.pickups.append(node)
         elif state == "Dropoff":
+            node.slot = len(self.dropoffs)
             self.dropoffs.append(node)
+        self._rebuild_masks()
+
+    def _rebuild_masks(self):
+        self.empty_pickups = 0
+        self.full_dropoffs = 0
+        self.remaining_packages = 0
+        for bit, pickup in enumerate(self.pickups):
+            pickup.slot = bit
+            self.remaining_packages += pickup.packages
+            if pickup.packages == 0:
+                self.empty_pickups |= 1 << bit
+        for bit, dropoff in enumerate(self.dropoffs):
+            dropoff.slot = bit
+            if dropoff.packages == dropoff.capacity:
+                self.full_dropoffs |= 1 << bit
 
     def swap_pickup_dropoff(self, reset_packages=True):
         # If we are switching fully loaded pickups for dropoffs,
@@ -147,11 +302,232 @@ class World(object):
         temp = self.pickups
         self.pickups = self.dropoffs
         self.dropoffs = temp
+        self._rebuild_masks()
+        self.transitions = None
+        self.action_masks = None
+        self.distances = None
 
         self._swapped = not self._swapped
 
+    def clone(self, qtable: bool=False):
+        """
+            A new world with the same layout, package counts and swap state, made by copying the nodes
+            rather than adding them one by one.  The compiled tables are shared with this world, as they
+            are only ever replaced, never changed in place.
+
+            qtable: Copy the q-table too, instead of leaving the clone to start an empty one.
+        """
+        if self.transitions is None:
+            self.compile()
+        world = type(self).__new__(type(self))
+        world.__dict__.update(self.__dict__)
+        world.nodes = {}
+        world.node_list = []
+        for node in self.node_list:
+            twin = Node.__new__(Node)
+            twin.__dict__.update(node.__dict__)
+            twin.world = world
+            # get_actions changes its dict in place, so the clone builds its own.
+            twin.actions = None
+            world.nodes[twin.coords] = twin
+            world.node_list.append(twin)
+        world.pickups = [world.node_list[pickup.index] for pickup in self.pickups]
+        world.dropoffs = [world.node_list[dropoff.index] for dropoff in self.dropoffs]
+        world.qtable = self._copy_qtable(self.qtable, world) if qtable else None
+        return world
+
+    @staticmethod
+    def _copy_qtable(qtable, world):
+        # A copy of a q-table of either backend, for world.
+        if qtable is None:
+            return None
+        if isinstance(qtable, ArrayQTable):
+            return ArrayQTable(world, values=qtable.values.copy())
+        return copy.deepcopy(qtable)
+
+    def snapshot(self, qtable: bool=True) -> dict:
+        """
+            The world's package counts and swap state, and unless qtable is False a copy of its q-table,
+            for restore() to put back later.  The layout itself is not saved, as it never changes.
+        """
+        return {"swapped": self._swapped,
+                "pickups": [pickup.packages for pickup in self.pickups],
+                "dropoffs": [dropoff.packages for dropoff in self.dropoffs],
+                "qtable": self._copy_qtable(self.qtable, self) if qtable else None,
+                "has_qtable": qtable}
+
+    def restore(self, snapshot: dict):
+        # Put the world back as it was at snapshot().  The snapshot can be restored again afterwards.
+        if self._swapped != snapshot["swapped"]:
+            self.swap_pickup_dropoff()
+        for pickup, packages in zip(self.pickups, snapshot["pickups"]):
+            pickup.packages = packages
+        for dropoff, packages in zip(self.dropoffs, snapshot["dropoffs"]):
+            dropoff.packages = packages
+        self._rebuild_masks()
+        if snapshot["has_qtable"]:
+            # Copy it again, so the snapshot can be restored more than once.
+            self.qtable = self._copy_qtable(snapshot["qtable"], self)
+
+    def transfer_q_table(self):
+        """
+            Carry what was learned over a swap_pickup_dropoff.  After a swap, the not-carrying agent heads
+            for the old dropoffs, which is what it learned to do while carrying, and the other way around.
+            The pickup and dropoff lists swap in order, so bit i of the availability mask still means
+            location i can't be used, and the carrying and not-carrying halves of the q-table just trade
+            places.
+        """
+        values = np.array(self.get_q_array())
+        self.set_q_array(np.ascontiguousarray(values[:, ::-1]))
+
+    def compile(self):
+        """
+            Build the static lookup tables for the current layout.
+
+            transitions: (nodes, 4) array with the index of the node each cardinal move leads to,
+                         or -1 if the move would leave the grid.
+            action_masks: (nodes, 2, 2**bits, 6) boolean array of the valid actions for every
+                          (node, carrying, availability mask), with columns in ALL_ACTIONS order.
+        """
+        self.transitions = np.full((len(self.node_list), len(ACTIONS)), -1, dtype=np.int64)
+        for node in self.node_list:
+            for action in node.get_actions():
+                if action in MOVES:
+                    row, column = MOVES[action]
+                    neighbour = self.nodes.get((node.y + row, node.x + column))
+                    if neighbour is not None:
+                        self.transitions[node.index, ACTION_INDEX[action]] = neighbour.index
+        self._compile_action_masks()
+
+        # Plain python mirrors of the tables for the single agent hot path.  Equal action tuples are
+        # shared, so there are only a handful of distinct objects.
+        interned = {}
+        self._next_index = self.transitions.tolist()
+        self._moves = [tuple(action for action, next_index in zip(ACTIONS, row) if next_index >= 0)
+                       for row in self._next_index]
+        self._valid_actions = []
+        for node_masks in self.action_masks.tolist():
+            node_actions = []
+            for carrying_masks in node_masks:
+                carrying_actions = []
+                for valid in carrying_masks:
+                    actions = tuple(action for action, ok in zip(ALL_ACTIONS, valid) if ok)
+                    carrying_actions.append(interned.setdefault(actions, actions))
+                node_actions.append(carrying_actions)
+            self._valid_actions.append(node_actions)
+
+    def _compile_action_masks(self):
+        masks = np.arange(1 << max(len(self.pickups), len(self.dropoffs)))
+        self.action_masks = np.zeros((len(self.node_list), 2, len(masks), len(ALL_ACTIONS)), dtype=bool)
+        self.action_masks[:, :, :, :len(ACTIONS)] = (self.transitions >= 0)[:, None, None, :]
+        for pickup in self.pickups:
+            # Only while not carrying, and only while the pickup still has packages.
+            self.action_masks[pickup.index, 0, :, PICKUP_INDEX] = (masks >> pickup.slot) & 1 == 0
+        for dropoff in self.dropoffs:
+            # Only while carrying, and only while the dropoff still has room.
+            self.action_masks[dropoff.index, 1, :, DROPOFF_INDEX] = (masks >> dropoff.slot) & 1 == 0
+
+    def get_action_masks(self) -> np.ndarray:
+        # The compiled action masks, building them first if the layout has changed.
+        if self.transitions is None:
+            self.compile()
+        if self.action_masks is None:
+            self._compile_action_masks()
+        return self.action_masks
+
+    def get_moves(self, node: Node) -> tuple:
+        # The cardinal moves that stay on the grid from this node.
+        if self.transitions is None:
+            self.compile()
+        return self._moves[node.index]
+
+    def get_valid_actions(self, node: Node, carrying: bool) -> tuple:
+        # Same actions as node.get_actions(carrying), without rebuilding a dict.
+        if self.transitions is None:
+            self.compile()
+        return self._valid_actions[node.index][carrying][self.get_availability_mask(carrying)]
+
+    def get_distances(self) -> np.ndarray:
+        """
+            (pickups + dropoffs, nodes) array of the fewest moves from every node to each pickup, then
+            each dropoff, without passing through any other pickup or dropoff on the way.  -1 where there
+            is no such path.
+
+            Found with one breadth first search from every pickup and dropoff at once, the first time it's
+            needed after the layout changes.
+        """
+        if self.distances is not None:
+            return self.distances
+        if self.transitions is None:
+            self.compile()
+        goals = np.array([node.index for node in self.pickups + self.dropoffs], dtype=np.int64)
+        count = len(self.node_list)
+        passable = np.ones(count, dtype=bool)
+        passable[goals] = False
+        # Distances are flattened to (goal, node), and the frontier holds flat indices into them.
+        distances = np.full(len(goals) * count, -1, dtype=np.int32)
+        frontier = np.arange(len(goals), dtype=np.int64) * count + goals
+        distances[frontier] = 0
+        step = 0
+        while frontier.size:
+            step += 1
+            cells = frontier % count
+            neighbours = self.transitions[cells]
+            reached = ((frontier - cells)[:, None] + neighbours)[neighbours >= 0]
+            reached = np.unique(reached[distances[reached] < 0])
+            distances[reached] = step
+            # Other pickups and dropoffs can be reached, but not walked through.
+            frontier = reached[passable[reached % count]]
+        self.distances = distances.reshape(len(goals), count)
+        return self.distances
+
+    def get_nearest_goal(self, node: Node, carrying: bool) -> Tuple[Node, int]:
+        # The closest pickup, or dropoff when carrying, that can still be used, and how many moves away.
+        # (None, -1) if none can be reached.
+        distances = self.get_distances()
+        goals, first = (self.dropoffs, len(self.pickups)) if carrying else (self.pickups, 0)
+        mask = self.get_availability_mask(carrying)
+        nearest, nearest_distance = None, -1
+        for goal in goals:
+            distance = int(distances[first + goal.slot, node.index])
+            if not (mask >> goal.slot) & 1 and distance >= 0 and (nearest is None or distance < nearest_distance):
+                nearest, nearest_distance = goal, distance
+        return nearest, nearest_distance
+
+    def get_path(self, node: Node, goal: Node) -> list:
+        """
+            The nodes along a shortest path from node to the pickup or dropoff goal, ending with the goal,
+            that doesn't pass through any other pickup or dropoff.  Empty if there is none.
+        """
+        distances = self.get_distances()[goal.slot + (len(self.pickups) if goal.type == "Dropoff" else 0)]
+        if distances[node.index] < 0:
+            return []
+        path = []
+        index = node.index
+        while distances[index] > 0:
+            for next_index in self.transitions[index]:
+                # A pickup or dropoff one step closer is a dead end, unless it's the goal.
+                if next_index >= 0 and distances[next_index] == distances[index] - 1 and \
+                        (next_index == goal.index or self.node_list[next_index].type not in ("Pickup", "Dropoff")):
+                    break
+            index = next_index
+            path.append(self.node_list[index])
+        return path
+
+    def get_next_node(self, node: Node, action: str) -> Node:
+        if self.transitions is None:
+            self.compile()
+        if action in ACTION_INDEX:
+            return self.node_list[self._next_index[node.index][ACTION_INDEX[action]]]
+        # Picking up and dropping off leave us where we are.
+        return node
+
     # Not to be used outside of this class.
     def _initialize_table(self):
+        if self.backend == "array":
+            self.qtable = ArrayQTable(self)
+            return
+
         def add_dict(sub_dict, length, actions):
             if length == 0:
                 for key in sub_dict:
@@ -179,9 +555,18 @@ class World(object):
             self.qtable[node] = {True: dropoff, False: pickup}
 
     def update_q_table(self, q_value: float, node: Node, action: str, carrying: bool):
+        if self.backend == "array":
+            if self.qtable is None:
+                self._initialize_table()
+            self.qtable.update_q_table(q_value, node, action, carrying, self.get_availability_mask(carrying))
+            return
         self.get_q_node_table(node, carrying)[action] = q_value
 
     def get_max_q_value(self, node: Node, carrying: bool) -> float:
+        if self.backend == "array":
+            if self.qtable is None:
+                self._initialize_table()
+            return self.qtable.get_max_q_value(node, carrying, self.get_availability_mask(carrying))
         # Returns a tuple of the best action and the q value for that action
         actions = self.get_q_node_table(node, carrying)
         best = (None, None)
@@ -193,29 +578,85 @@ class World(object):
         return best[1]
 
     def get_q_value(self, node: Node, action: str, carrying: bool) -> float:
+        if self.backend == "array":
+            if self.qtable is None:
+                self._initialize_table()
+            return self.qtable.get_q_value(node, action, carrying, self.get_availability_mask(carrying))
         return self.get_q_node_table(node, carrying)[action]
 
+    def get_availability_mask(self, carrying: bool) -> int:
+        # Bit i is set when dropoff i is full (carrying) or pickup i is empty (not carrying).
+        return self.full_dropoffs if carrying else self.empty_pickups
+
     def get_q_node_table(self, node: Node, carrying: bool) -> dict:
+        return self.get_q_state_table(node, carrying, self.get_availability_mask(carrying))
+
+    def get_q_state_table(self, node: Node, carrying: bool, mask: int) -> dict:
+        # Like get_q_node_table, for any availability mask rather than the world's current one.
         if self.qtable is None:
             self._initialize_table()
-        node_dict = self.qtable[node.coords][carrying]
-        temp = None
-        if carrying:
-            for dropoff in self.dropoffs:
-                temp = node_dict[False] if dropoff.packages == dropoff.capacity else node_dict[True]
-                node_dict = temp
+        if self.backend == "array":
+            return self.qtable.row(node, carrying, mask)
+        return self._get_dict_leaf(node, carrying, mask)
 
-        else:
-            for pickup in self.pickups:
-                temp = node_dict[False] if pickup.packages == 0 else node_dict[True]
-                node_dict = temp
+    def _get_dict_leaf(self, node: Node, carrying: bool, mask: int) -> dict:
+        # Walk the nested dict q-table down to the actions for the given availability mask.
+        node_dict = self.qtable[node.coords][carrying]
+        for bit in range(len(self.dropoffs) if carrying else len(self.pickups)):
+            node_dict = node_dict[not (mask >> bit) & 1]
         return node_dict
 
+    def get_q_slice(self, carrying: bool) -> np.ndarray:
+        """
+            The q-values of every node for the world's current availability mask, as a (nodes, 4) array
+            in ACTIONS order, with moves off the grid as -inf.  For the array backend this is a view.
+        """
+        if self.qtable is None:
+            self._initialize_table()
+        mask = self.get_availability_mask(carrying)
+        if self.backend == "array":
+            return self.qtable.values[:, int(carrying), mask]
+        values = np.full((len(self.node_list), len(ACTIONS)), -np.inf)
+        for node in self.node_list:
+            for action, q_value in self._get_dict_leaf(node, carrying, mask).items():
+                values[node.index, ACTION_INDEX[action]] = q_value
+        return values
+
+    def get_q_array(self) -> np.ndarray:
+        """
+            The q-table as an ArrayQTable style array, whichever backend is in use.
+            For the array backend this is the live array, not a copy.
+        """
+        if self.qtable is None:
+            self._initialize_table()
+        if self.backend == "array":
+            return self.qtable.values
+        values = ArrayQTable(self).values
+        for node in self.node_list:
+            for carrying in (False, True):
+                for mask in range(1 << (len(self.dropoffs) if carrying else len(self.pickups))):
+                    for action, q_value in self._get_dict_leaf(node, carrying, mask).items():
+                        values[node.index, int(carrying), mask, ACTION_INDEX[action]] = q_value
+        return values
+
+    def set_q_array(self, values: np.ndarray):
+        """
+            Replace the q-table with an ArrayQTable style array.  The array backend uses it directly,
+            so a memory-mapped array stays memory-mapped.
+        """
+        if self.backend == "array":
+            self.qtable = ArrayQTable(self, values=values)
+            return
+        self._initialize_table()
+        for node in self.node_list:
+            for carrying in (False, True):
+                for mask in range(1 << (len(self.dropoffs) if carrying else len(self.pickups))):
+                    leaf = self._get_dict_leaf(node, carrying, mask)
+                    for action in leaf:
+                        leaf[action] = float(values[node.index, int(carrying), mask, ACTION_INDEX[action]])
+
     def check_termination(self) -> bool:
-        for pickup in self.pickups:
-            if pickup.packages != 0:
-                return False
-        return True
+        return self.remaining_packages == 0
 
     def print_world(self):
         for node in self.nodes: